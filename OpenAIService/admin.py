@@ -13,8 +13,10 @@ from django.core.exceptions import ValidationError
 from docstring_parser import parse
 from codemirror2.widgets import CodeMirrorEditor
 from django_json_widget.widgets import JSONEditorWidget
+from .llm_classes.EmbeddingConfig import GLOBAL_LOADED_EMBEDDING_CONFIGS
 from .llm_classes.LLMConfig import GLOBAL_LOADED_LLM_CONFIGS
-from .models import OpenAIAssistant, ChatHistory, PromptTemplate, Tool, KnowledgeRepository, ContentReference
+from .models import OpenAIAssistant, ChatHistory, PromptTemplate, Tool, KnowledgeRepository, ContentReference, PromptUsageRollup, \
+    ChatTurnJob, ChatMessageFeedback
 from .serializers import OpenAIAssistantSerializer
 
 logger = logging.getLogger(__name__)
@@ -248,6 +250,21 @@ class PromptTemplateAdminForm(forms.ModelForm):
 
     def clean(self):
         cleaned_data = super().clean()
+        if cleaned_data.get("tool_selection_mode") == PromptTemplate.ToolSelectionMode.EMBEDDING and \
+                cleaned_data.get("tool_selection_embedding_config") not in GLOBAL_LOADED_EMBEDDING_CONFIGS:
+            raise ValidationError({'tool_selection_embedding_config': "Choose a loaded embedding config for embedding tool selection."})
+        pinned_tools = set(cleaned_data.get("pinned_tools") or [])
+        if not pinned_tools.issubset(set(cleaned_data.get("tools") or [])):
+            raise ValidationError({'pinned_tools': "Pinned tools must also be in tools."})
+        if cleaned_data.get("tool_selection_mode") != PromptTemplate.ToolSelectionMode.ALL and not pinned_tools and \
+                (cleaned_data.get("tool_selection_top_k") or 0) < 1:
+            raise ValidationError({'tool_selection_top_k': "Select at least one tool, or pin some."})
+        summarization_llm_config_name = cleaned_data.get("summarization_llm_config_name")
+        if summarization_llm_config_name and summarization_llm_config_name not in GLOBAL_LOADED_LLM_CONFIGS:
+            raise ValidationError({'summarization_llm_config_name': "Choose a loaded LLM config for summaries."})
+        cascade_llm_config_name = cleaned_data.get("cascade_llm_config_name")
+        if cascade_llm_config_name and cascade_llm_config_name not in GLOBAL_LOADED_LLM_CONFIGS:
+            raise ValidationError({'cascade_llm_config_name': "Choose a loaded LLM config for the cascade."})
         return cleaned_data
 
     def get_dynamic_choices(self):
@@ -260,12 +277,123 @@ class PromptTemplateAdmin(admin.ModelAdmin):
         models.JSONField: {'widget': JSONEditorWidget},
     }
 
+class PromptUsageRollupAdmin(admin.ModelAdmin):
+    list_display = ('hour', 'prompt_template_name', 'llm_config_name', 'message_count', 'tool_call_count',
+                    'prompt_tokens', 'completion_tokens', 'avg_latency_ms', 'p50_latency_ms', 'p95_latency_ms',
+                    'cascade_escalation_rate')
+    list_filter = ('prompt_template_name', 'llm_config_name')
+    date_hierarchy = 'hour'
+    ordering = ('-hour',)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @staticmethod
+    def get_summary(obj):
+        # Not imported at module level, so that admin autodiscovery does not pull the repositories into startup.
+        from .repositories import PromptUsageRollupRepository
+        bucket_counts = [getattr(obj, field) for field in PromptUsageRollup.LATENCY_BUCKET_FIELDS]
+        return PromptUsageRollupRepository.summarize(bucket_counts, {
+            "message_count": obj.message_count, "tool_call_count": obj.tool_call_count,
+            "prompt_tokens": obj.prompt_tokens, "completion_tokens": obj.completion_tokens,
+            "total_latency_ms": obj.total_latency_ms,
+            **{field: getattr(obj, field) for field in PromptUsageRollup.CASCADE_FIELDS}})
+
+    @admin.display(description='Avg latency (ms)')
+    def avg_latency_ms(self, obj):
+        value = self.get_summary(obj)["avg_latency_ms"]
+        return None if value is None else round(value)
+
+    @admin.display(description='p50 latency (ms)')
+    def p50_latency_ms(self, obj):
+        value = self.get_summary(obj)["p50_latency_ms"]
+        return None if value is None else round(value)
+
+    @admin.display(description='p95 latency (ms)')
+    def p95_latency_ms(self, obj):
+        value = self.get_summary(obj)["p95_latency_ms"]
+        return None if value is None else round(value)
+
+    @admin.display(description='Cascade escalation rate')
+    def cascade_escalation_rate(self, obj):
+        value = self.get_summary(obj)["cascade_escalation_rate"]
+        return None if value is None else f"{value:.0%}"
+
+class ChatHistorySizeFilter(admin.SimpleListFilter):
+    title = 'size'
+    parameter_name = 'size'
+    # Msg count ranges, upper bound exclusive.
+    SIZE_RANGES = {
+        'short': ('Under 10 msgs', 0, 10),
+        'medium': ('10 to 50 msgs', 10, 50),
+        'long': ('50 to 200 msgs', 50, 200),
+        'very_long': ('200 msgs or more', 200, None),
+    }
+
+    def lookups(self, request, model_admin):
+        return [(key, label) for key, (label, _, _) in self.SIZE_RANGES.items()]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.SIZE_RANGES:
+            return queryset
+        _, lower_bound, upper_bound = self.SIZE_RANGES[self.value()]
+        queryset = queryset.filter(message_count__gte=lower_bound)
+        if upper_bound is not None:
+            queryset = queryset.filter(message_count__lt=upper_bound)
+        return queryset
+
+
+class ChatHistoryAdmin(admin.ModelAdmin):
+    # Lists and filters on the metadata columns only, so that pages stay fast however many and long chats are.
+    list_display = ('id', 'prompt_template_name', 'owner_key', 'message_count', 'token_count', 'last_message_at',
+                    'created_at')
+    list_filter = ('prompt_template_name', ChatHistorySizeFilter)
+    search_fields = ('=owner_key',)
+    ordering = ('-id',)
+    show_full_result_count = False
+    readonly_fields = ('message_count', 'token_count', 'last_message_at', 'display_projected_upto', 'version')
+    formfield_overrides = {
+        models.JSONField: {'widget': JSONEditorWidget},
+    }
+
+    def get_queryset(self, request):
+        # The blob is only loaded when a chat is opened.
+        return super().get_queryset(request).defer('chat_history')
+
+class ChatTurnJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'locked_by', 'created_at', 'started_at', 'finished_at')
+    list_filter = ('status', 'kind')
+    search_fields = ('=idempotency_key',)
+    ordering = ('-id',)
+    show_full_result_count = False
+    formfield_overrides = {
+        models.JSONField: {'widget': JSONEditorWidget},
+    }
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+class ChatMessageFeedbackAdmin(admin.ModelAdmin):
+    list_display = ('id', 'chat_history_id', 'msg_id', 'rating', 'comment', 'updated_at')
+    list_filter = ('rating',)
+    ordering = ('-id',)
+    raw_id_fields = ('chat_history',)
+
 # Sanchit - TODO -  Always declare admin of models, for easier creation and reference/debug, unless deciding explicitly against or in
 # in case of through models
 
 admin.site.register(OpenAIAssistant, OpenAIAssistantAdmin)
-admin.site.register(ChatHistory)
+admin.site.register(ChatHistory, ChatHistoryAdmin)
 admin.site.register(KnowledgeRepository)
 admin.site.register(ContentReference)
 admin.site.register(PromptTemplate, PromptTemplateAdmin)
 admin.site.register(Tool, ToolAdmin)
+admin.site.register(PromptUsageRollup, PromptUsageRollupAdmin)
+admin.site.register(ChatTurnJob, ChatTurnJobAdmin)
+admin.site.register(ChatMessageFeedback, ChatMessageFeedbackAdmin)
@@ -1,3 +1,5 @@
+import multiprocessing
+
 from django.apps import AppConfig
 from django.conf import settings
 
@@ -6,10 +8,16 @@ class OpenAIConfig(AppConfig):
     name = 'OpenAIService'
 
     def ready(self) -> None:
-        from OpenAIService.repositories import ValidLLMConfigs,ValidPromptTemplates
         if not settings.DISABLE_PROMPT_VALIDATIONS:
-            ValidPromptTemplates().check_prompts_in_db()
-            ValidLLMConfigs.check_llm_configs_in_db()
+            from OpenAIService.startup_checks import validate_prompt_configuration_once
+            validate_prompt_configuration_once()
+        if getattr(settings, "PRELOAD_KNOWLEDGE_INDEXES", False):
+            from OpenAIService.rag.retrieval import KnowledgeIndexRegistry
+            KnowledgeIndexRegistry.preload()
+        # Tool workers run ready() too, and must not start pools of their own.
+        if getattr(settings, "PRELOAD_TOOL_PROCESS_POOL", False) and multiprocessing.parent_process() is None:
+            from OpenAIService.tool_executor import ToolProcessPool
+            ToolProcessPool.get()
 
 
 
@@ -0,0 +1,110 @@
+import json
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+
+from OpenAIService.models import PromptTemplate
+
+
+class CascadeVerifier:
+    """Decides whether an answer of the fast LLM config of a cascade is kept or the msgs are sent again to the strong
+    config. params are the cascade_verifier_params of the prompt template."""
+
+    def prepare_messages(self, msg_list: list, params: dict) -> list:
+        """Msgs sent to the fast config."""
+        return msg_list
+
+    def verify(self, content: str, params: dict) -> tuple:
+        """(accepted, reason) for the answer content of the fast config."""
+        raise NotImplementedError
+
+    def clean_response(self, content: str, params: dict) -> str:
+        """Content of an accepted answer as stored and returned."""
+        return content
+
+
+class SelfConfidenceVerifier(CascadeVerifier):
+    """Asks the fast model to rate its confidence on a last line and escalates below min_confidence (default 0.7) or
+    when the rating is missing."""
+
+    INSTRUCTION = ("After your answer, add a last line `CONFIDENCE: <number from 0 to 1>` rating how confident you are "
+                   "that the answer is correct and complete.")
+    CONFIDENCE_PATTERN = re.compile(r"\n?\s*CONFIDENCE:\s*([01](?:\.\d+)?)\s*$", re.IGNORECASE)
+
+    def prepare_messages(self, msg_list: list, params: dict) -> list:
+        return msg_list + [{"role": "system", "content": params.get("instruction", self.INSTRUCTION)}]
+
+    def verify(self, content: str, params: dict) -> tuple:
+        match = self.CONFIDENCE_PATTERN.search(content)
+        if match is None:
+            return False, "no confidence given"
+        confidence = float(match.group(1))
+        min_confidence = params.get("min_confidence", 0.7)
+        if confidence < min_confidence:
+            return False, f"confidence {confidence} below {min_confidence}"
+        return True, f"confidence {confidence}"
+
+    def clean_response(self, content: str, params: dict) -> str:
+        return self.CONFIDENCE_PATTERN.sub("", content)
+
+
+class JSONSchemaVerifier(CascadeVerifier):
+    """Escalates answers that are not JSON valid against params["schema"] (any JSON when no schema is given). A
+    fenced ```json block is accepted."""
+
+    FENCE_PATTERN = re.compile(r"^\s*```(?:json)?\s*(.*?)\s*```\s*$", re.DOTALL)
+
+    def verify(self, content: str, params: dict) -> tuple:
+        match = self.FENCE_PATTERN.match(content)
+        try:
+            value = json.loads(match.group(1) if match else content)
+        except ValueError as exc:
+            return False, f"invalid JSON: {exc}"
+        schema = params.get("schema")
+        if schema:
+            try:
+                import jsonschema
+            except ImportError:
+                raise ImproperlyConfigured("jsonschema is required for the JSON schema cascade verifier")
+            try:
+                jsonschema.validate(value, schema)
+            except jsonschema.ValidationError as exc:
+                return False, f"schema violation: {exc.message}"
+        return True, "valid JSON"
+
+
+class HeuristicVerifier(CascadeVerifier):
+    """Escalates answers shorter than params["min_length"] chars (default 1) or matching one of the case insensitive
+    regexes of params["refusal_patterns"] (default REFUSAL_PATTERNS)."""
+
+    REFUSAL_PATTERNS = (r"\bI(?:'m| am) not sure\b", r"\bI (?:can(?:no|')t|am unable to) (?:help|answer|assist)",
+                        r"\bI don't know\b", r"\bas an AI\b")
+
+    def verify(self, content: str, params: dict) -> tuple:
+        min_length = params.get("min_length", 1)
+        if len(content.strip()) < min_length:
+            return False, f"shorter than {min_length} chars"
+        for pattern in params.get("refusal_patterns", self.REFUSAL_PATTERNS):
+            if re.search(pattern, content, re.IGNORECASE):
+                return False, f"matches {pattern}"
+        return True, "passed heuristics"
+
+
+# Verifiers by PromptTemplate.CascadeVerifier value. Projects can swap in their own with register_cascade_verifier.
+CASCADE_VERIFIERS = {}
+
+
+def register_cascade_verifier(key: int, verifier: CascadeVerifier) -> None:
+    CASCADE_VERIFIERS[key] = verifier
+
+
+def get_cascade_verifier(key: int) -> CascadeVerifier:
+    try:
+        return CASCADE_VERIFIERS[key]
+    except KeyError:
+        raise ImproperlyConfigured(f"No cascade verifier registered for {key}")
+
+
+register_cascade_verifier(PromptTemplate.CascadeVerifier.SELF_CONFIDENCE, SelfConfidenceVerifier())
+register_cascade_verifier(PromptTemplate.CascadeVerifier.JSON_SCHEMA, JSONSchemaVerifier())
+register_cascade_verifier(PromptTemplate.CascadeVerifier.HEURISTIC, HeuristicVerifier())
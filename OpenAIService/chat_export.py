@@ -0,0 +1,146 @@
+import json
+import logging
+from datetime import datetime
+
+from django.core.exceptions import ImproperlyConfigured
+
+from OpenAIService.models import ChatHistory
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("jsonl", "parquet", "arrow")
+
+# Columns of the flattened rows, one per msg. context_vars and tool_calls are nested; columnar formats store them as
+# JSON strings so that the schema stays fixed.
+EXPORT_COLUMNS = ("chat_history_id", "prompt_template_name", "position", "role", "content", "timestamp",
+                  "message_generation_time", "system_generated", "context_vars", "tool_name", "tool_call_id",
+                  "tool_calls")
+JSON_COLUMNS = ("context_vars", "tool_calls")
+
+
+def get_message_row(chat_history_id: int, prompt_template_name: str, position: int, msg: dict) -> dict:
+    tool_calls = msg.get("tool_calls") or None
+    tool_name = msg.get("name")
+    if tool_name is None and tool_calls:
+        tool_name = tool_calls[0].get("function", {}).get("name")
+    return {
+        "chat_history_id": chat_history_id,
+        "prompt_template_name": prompt_template_name,
+        "position": position,
+        "role": msg.get("role"),
+        "content": msg.get("content"),
+        "timestamp": msg.get("timestamp"),
+        "message_generation_time": msg.get("message_generation_time"),
+        "system_generated": bool(msg.get("system_generated", False)),
+        "context_vars": msg.get("context_vars"),
+        "tool_name": tool_name,
+        "tool_call_id": msg.get("tool_call_id"),
+        "tool_calls": tool_calls,
+    }
+
+
+def iter_chat_history_rows(*, start: datetime | None = None, end: datetime | None = None,
+                           prompt_template_names: list | None = None, chunk_size: int = 200):
+    """Yields one row per msg of the chats matching the filters, reading chats chunk_size at a time so that memory
+    stays bounded by one chunk of chat blobs however many chats match.
+
+    :param start: only msgs at or after start, of chats updated since then
+    :param end: only msgs before end, of chats created before it
+    :param prompt_template_names: only chats of these prompt templates
+    :param chunk_size: chats fetched per DB round trip (server side cursor on PostgreSQL)
+    """
+    chat_histories = ChatHistory.objects.order_by("id")
+    if start is not None:
+        chat_histories = chat_histories.filter(updated_at__gte=start)
+    if end is not None:
+        chat_histories = chat_histories.filter(created_at__lt=end)
+    if prompt_template_names:
+        chat_histories = chat_histories.filter(prompt_template_name__in=prompt_template_names)
+    start_timestamp = start.timestamp() if start is not None else None
+    end_timestamp = end.timestamp() if end is not None else None
+
+    for chat_history_id, prompt_template_name, chat_history in chat_histories.values_list(
+            "id", "prompt_template_name", "chat_history").iterator(chunk_size=chunk_size):
+        for position, msg in enumerate(chat_history):
+            timestamp = msg.get("timestamp")
+            if timestamp is not None:
+                if start_timestamp is not None and timestamp < start_timestamp:
+                    continue
+                if end_timestamp is not None and timestamp >= end_timestamp:
+                    continue
+            yield get_message_row(chat_history_id, prompt_template_name, position, msg)
+
+
+def write_jsonl(rows, output) -> int:
+    row_count = 0
+    for row in rows:
+        output.write(json.dumps(row, default=str))
+        output.write("\n")
+        row_count += 1
+    return row_count
+
+
+def write_columnar(rows, output_path: str, export_format: str, batch_size: int = 10000) -> int:
+    """Writes rows as Parquet or an Arrow IPC file, batch_size rows at a time."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImproperlyConfigured(f"pyarrow is required for {export_format} export, use jsonl or install pyarrow")
+    schema = pa.schema([
+        ("chat_history_id", pa.int64()),
+        ("prompt_template_name", pa.string()),
+        ("position", pa.int32()),
+        ("role", pa.string()),
+        ("content", pa.string()),
+        ("timestamp", pa.float64()),
+        ("message_generation_time", pa.float64()),
+        ("system_generated", pa.bool_()),
+        ("context_vars", pa.string()),
+        ("tool_name", pa.string()),
+        ("tool_call_id", pa.string()),
+        ("tool_calls", pa.string()),
+    ])
+    if export_format == "parquet":
+        writer = pq.ParquetWriter(output_path, schema)
+    else:
+        writer = pa.ipc.new_file(output_path, schema)
+    row_count = 0
+    batch = {column: [] for column in EXPORT_COLUMNS}
+
+    def flush():
+        if batch["chat_history_id"]:
+            writer.write_batch(pa.record_batch([batch[column] for column in EXPORT_COLUMNS], schema=schema))
+            for column in EXPORT_COLUMNS:
+                batch[column].clear()
+
+    try:
+        for row in rows:
+            for column in EXPORT_COLUMNS:
+                value = row[column]
+                if column in JSON_COLUMNS and value is not None:
+                    value = json.dumps(value, default=str)
+                elif column == "content" and value is not None and not isinstance(value, str):
+                    value = json.dumps(value, default=str)
+                batch[column].append(value)
+            row_count += 1
+            if len(batch["chat_history_id"]) >= batch_size:
+                flush()
+        flush()
+    finally:
+        writer.close()
+    return row_count
+
+
+def export_chat_histories(output, export_format: str = "jsonl", **filters) -> int:
+    """Streams the msgs of the chats matching filters (see iter_chat_history_rows) to output, a text stream for jsonl
+    or a file path for parquet and arrow. Returns the number of rows written."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format: {export_format}")
+    rows = iter_chat_history_rows(**filters)
+    if export_format == "jsonl":
+        row_count = write_jsonl(rows, output)
+    else:
+        row_count = write_columnar(rows, output, export_format)
+    logger.info(f"Exported {row_count} chat msgs as {export_format}")
+    return row_count
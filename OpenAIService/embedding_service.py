@@ -0,0 +1,207 @@
+import hashlib
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+from django.conf import settings
+
+from OpenAIService.llm_classes.EmbeddingConfig import GLOBAL_LOADED_EMBEDDING_CONFIGS, EmbeddingConfig
+from OpenAIService.models import EmbeddingCacheEntry
+
+logger = logging.getLogger(__name__)
+
+# Keeps IN (...) lookups under the SQLite bound parameter limit.
+DB_LOOKUP_CHUNK_SIZE = 500
+
+
+class EmbeddingBatcher:
+    """Coalesces texts submitted from concurrent threads into backend calls of at most max_batch_size texts. A batch
+    is sent as soon as it is full, or max_wait_seconds after its first text arrived."""
+
+    def __init__(self, embedding_config: EmbeddingConfig, *, max_batch_size: int, max_wait_seconds: float):
+        self.embedding_config = embedding_config
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_seconds
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        self._queue.put((text, future))
+        self._ensure_thread()
+        return future
+
+    def _ensure_thread(self) -> None:
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"embedding-batcher-{self.embedding_config.name}",
+                                                daemon=True)
+                self._thread.start()
+
+    def _collect_batch(self) -> list:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_seconds
+        while len(batch) < self.max_batch_size:
+            try:
+                # Whatever is already queued is always taken, waiting only while the deadline allows.
+                batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect_batch()
+            try:
+                embeddings = self.embedding_config.embed([text for text, _ in batch])
+                if len(embeddings) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, the backend returned {len(embeddings)}")
+                for (_, future), embedding in zip(batch, embeddings):
+                    future.set_result(np.asarray(embedding, dtype=np.float32))
+            except Exception as exc:
+                logger.error(f"Embedding batch of {len(batch)} texts failed for {self.embedding_config.name}: {exc}")
+                # Every future must be resolved, callers and waiters on the same texts block on them.
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+
+class EmbeddingService:
+    """Embeds texts with an EmbeddingConfig, behind a two level cache keyed by (config name, sha256 of text):
+    an in-process LRU and the EmbeddingCacheEntry table shared by all workers. Texts missing from both are sent
+    through an EmbeddingBatcher, and a text already being embedded for another thread is waited for instead of
+    being sent again."""
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, embedding_config: EmbeddingConfig, *, memory_cache_size: int | None = None,
+                 max_batch_size: int | None = None, max_wait_seconds: float | None = None):
+        self.embedding_config = embedding_config
+        self.name = embedding_config.name
+        self.memory_cache_size = memory_cache_size or getattr(settings, "EMBEDDING_MEMORY_CACHE_SIZE", 10000)
+        self.batcher = EmbeddingBatcher(
+            embedding_config,
+            max_batch_size=max_batch_size or embedding_config.batch_size,
+            max_wait_seconds=max_wait_seconds if max_wait_seconds is not None else
+            getattr(settings, "EMBEDDING_BATCH_MAX_WAIT_MS", 10) / 1000,
+        )
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0}
+        self._memory_cache = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls, embedding_config_name: str) -> "EmbeddingService":
+        """Process wide service for a config, so that every caller shares its cache and batches. Replaced when the
+        config was reloaded with changes."""
+        embedding_config = GLOBAL_LOADED_EMBEDDING_CONFIGS[embedding_config_name]
+        instance = cls._instances.get(embedding_config_name)
+        if instance is None or instance.embedding_config is not embedding_config:
+            with cls._instances_lock:
+                instance = cls._instances.get(embedding_config_name)
+                if instance is None or instance.embedding_config is not embedding_config:
+                    instance = cls(embedding_config)
+                    cls._instances[embedding_config_name] = instance
+        return instance
+
+    @staticmethod
+    def get_content_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _get_from_memory(self, content_hashes) -> dict:
+        found = {}
+        with self._lock:
+            for content_hash in content_hashes:
+                embedding = self._memory_cache.get(content_hash)
+                if embedding is not None:
+                    self._memory_cache.move_to_end(content_hash)
+                    found[content_hash] = embedding
+        return found
+
+    def _add_to_memory(self, embeddings: dict) -> None:
+        with self._lock:
+            self._memory_cache.update(embeddings)
+            while len(self._memory_cache) > self.memory_cache_size:
+                self._memory_cache.popitem(last=False)
+
+    def _get_from_db(self, content_hashes: list) -> dict:
+        found = {}
+        for start in range(0, len(content_hashes), DB_LOOKUP_CHUNK_SIZE):
+            entries = EmbeddingCacheEntry.objects.filter(
+                embedding_config_name=self.name,
+                content_hash__in=content_hashes[start:start + DB_LOOKUP_CHUNK_SIZE],
+            ).values_list("content_hash", "embedding")
+            for content_hash, embedding in entries:
+                found[content_hash] = np.frombuffer(bytes(embedding), dtype="<f4")
+        return found
+
+    def _save_to_db(self, embeddings: dict) -> None:
+        EmbeddingCacheEntry.objects.bulk_create(
+            [EmbeddingCacheEntry(embedding_config_name=self.name, content_hash=content_hash,
+                                 embedding=embedding.astype("<f4").tobytes())
+             for content_hash, embedding in embeddings.items()],
+            batch_size=DB_LOOKUP_CHUNK_SIZE,
+            ignore_conflicts=True,
+        )
+
+    def _embed_missing(self, texts_by_hash: dict) -> dict:
+        owned_futures = {}
+        futures = {}
+        embeddings = {}
+        with self._lock:
+            for content_hash, text in texts_by_hash.items():
+                # Checked again under the lock: another thread may have finished embedding this text since our
+                # cache lookups. Finished texts are cached before they leave _in_flight, so one of them has it.
+                embedding = self._memory_cache.get(content_hash)
+                if embedding is not None:
+                    embeddings[content_hash] = embedding
+                    continue
+                future = self._in_flight.get(content_hash)
+                if future is None:
+                    future = self.batcher.submit(text)
+                    self._in_flight[content_hash] = future
+                    owned_futures[content_hash] = future
+                futures[content_hash] = future
+        try:
+            embeddings.update({content_hash: future.result() for content_hash, future in futures.items()})
+            # Only the thread that submitted a text persists it.
+            owned_embeddings = {content_hash: embeddings[content_hash] for content_hash in owned_futures}
+            self._save_to_db(owned_embeddings)
+            self._add_to_memory(owned_embeddings)
+        finally:
+            with self._lock:
+                for content_hash in owned_futures:
+                    self._in_flight.pop(content_hash, None)
+        return embeddings
+
+    def embed(self, texts: list) -> np.ndarray:
+        """Returns a (len(texts), dim) float32 array."""
+        content_hashes = [self.get_content_hash(text) for text in texts]
+        texts_by_hash = dict(zip(content_hashes, texts))
+        found = self._get_from_memory(texts_by_hash)
+        self.stats["memory_hits"] += len(found)
+        missing = [content_hash for content_hash in texts_by_hash if content_hash not in found]
+        if missing:
+            from_db = self._get_from_db(missing)
+            self.stats["db_hits"] += len(from_db)
+            found.update(from_db)
+            missing = [content_hash for content_hash in missing if content_hash not in from_db]
+            if missing:
+                self.stats["misses"] += len(missing)
+                found.update(self._embed_missing({content_hash: texts_by_hash[content_hash]
+                                                  for content_hash in missing}))
+            self._add_to_memory({content_hash: found[content_hash] for content_hash in texts_by_hash})
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack([found[content_hash] for content_hash in content_hashes])
+
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.embed([text])[0]
@@ -0,0 +1,281 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.utils import timezone
+
+from OpenAIService.models import ChatTurnJob
+from OpenAIService.spawned_process import django_process_main
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = (ChatTurnJob.Status.SUCCEEDED, ChatTurnJob.Status.FAILED)
+
+
+def get_visibility_timeout() -> float:
+    return getattr(settings, "CHAT_TURN_JOB_VISIBILITY_TIMEOUT", 300)
+
+
+def run_chat_turn(job: ChatTurnJob) -> dict:
+    from OpenAIService.repositories import LLMCommunicationWrapper
+    payload = job.payload
+    chat_history_id = payload.get("chat_history_id")
+    context_vars = payload.get("context_vars") or {}
+    llm_wrapper = LLMCommunicationWrapper(prompt_name=payload["prompt_name"], chat_history_id=chat_history_id,
+                                          initialize=chat_history_id is None, initializing_context_vars=context_vars,
+                                          owner_key=payload.get("owner_key", ""))
+    if chat_history_id is None:
+        # Retries of the job continue in the chat created here instead of creating another one.
+        payload["chat_history_id"] = llm_wrapper.get_chat_history_object().id
+        ChatTurnJobQueue.save_payload(job)
+    # A retry after the turn was committed, but before the job was completed, gets the committed response.
+    response = llm_wrapper.send_user_message_and_get_response(payload["user_msg"], context_vars,
+                                                              idempotency_key=f"chat_turn_job:{job.id}")
+    return {"chat_history_id": llm_wrapper.get_chat_history_object().id, "response": response}
+
+
+def run_assistant_file(job: ChatTurnJob) -> dict:
+    from OpenAIService.wrappers import OpenAIAssistantWrapper
+    payload = job.payload
+    response = OpenAIAssistantWrapper(payload["assistant_name"]).get_response_using_file(payload["file_path"],
+                                                                                       payload["prompt"])
+    return {"response": response}
+
+
+JOB_HANDLERS = {
+    ChatTurnJob.Kind.CHAT_TURN: run_chat_turn,
+    ChatTurnJob.Kind.ASSISTANT_FILE: run_assistant_file,
+}
+
+
+class ChatTurnJobQueue:
+    """Job queue on the ChatTurnJob table. Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED and hold a lease
+    until visible_at, extended while the job runs; a job whose worker died is claimed again once its lease expires,
+    up to max_attempts times."""
+
+    @staticmethod
+    def submit(kind: int, payload: dict, *, idempotency_key: str | None = None,
+               max_attempts: int | None = None) -> ChatTurnJob:
+        """Queues a job, or returns the job already submitted with idempotency_key."""
+        job = ChatTurnJob(kind=kind, payload=json.loads(json.dumps(payload, cls=DjangoJSONEncoder)),
+                          idempotency_key=idempotency_key or None, visible_at=timezone.now(),
+                          max_attempts=max_attempts or getattr(settings, "CHAT_TURN_JOB_MAX_ATTEMPTS", 3))
+        if idempotency_key is None:
+            job.save()
+            return job
+        try:
+            with transaction.atomic():
+                job.save()
+        except IntegrityError:
+            return ChatTurnJob.objects.get(idempotency_key=idempotency_key)
+        return job
+
+    @staticmethod
+    def submit_chat_turn(*, prompt_name: str, user_msg: str, chat_history_id: int | None = None,
+                         context_vars: dict | None = None, owner_key: str = "",
+                         idempotency_key: str | None = None) -> ChatTurnJob:
+        """Queues LLMCommunicationWrapper.send_user_message_and_get_response, creating the chat first when
+        chat_history_id is None. The result holds the chat_history_id and the response."""
+        return ChatTurnJobQueue.submit(ChatTurnJob.Kind.CHAT_TURN, {
+            "prompt_name": prompt_name, "user_msg": user_msg, "chat_history_id": chat_history_id,
+            "context_vars": context_vars or {}, "owner_key": owner_key}, idempotency_key=idempotency_key)
+
+    @staticmethod
+    def submit_assistant_file(*, assistant_name: str, file_path: str, prompt: str,
+                              idempotency_key: str | None = None) -> ChatTurnJob:
+        return ChatTurnJobQueue.submit(ChatTurnJob.Kind.ASSISTANT_FILE, {
+            "assistant_name": assistant_name, "file_path": file_path, "prompt": prompt},
+            idempotency_key=idempotency_key)
+
+    @staticmethod
+    def claim(worker_id: str) -> ChatTurnJob | None:
+        now = timezone.now()
+        with transaction.atomic():
+            job = ChatTurnJob.objects.select_for_update(skip_locked=True).filter(
+                status__in=(ChatTurnJob.Status.QUEUED, ChatTurnJob.Status.RUNNING), visible_at__lte=now,
+            ).order_by("visible_at").first()
+            if job is None:
+                return None
+            if job.attempts >= job.max_attempts:
+                # Its last worker died while running it.
+                job.status = ChatTurnJob.Status.FAILED
+                job.error = job.error or f"Gave up after {job.attempts} attempts, the worker was lost"
+                job.finished_at = now
+                job.save(update_fields=["status", "error", "finished_at"])
+                return None
+            job.status = ChatTurnJob.Status.RUNNING
+            job.attempts += 1
+            job.locked_by = worker_id
+            job.started_at = now
+            job.visible_at = now + timedelta(seconds=get_visibility_timeout())
+            job.save(update_fields=["status", "attempts", "locked_by", "started_at", "visible_at"])
+        return job
+
+    @staticmethod
+    def _get_owned_job(job: ChatTurnJob, worker_id: str):
+        return ChatTurnJob.objects.filter(id=job.id, locked_by=worker_id, status=ChatTurnJob.Status.RUNNING)
+
+    @staticmethod
+    def extend_lease(job: ChatTurnJob, worker_id: str) -> bool:
+        return bool(ChatTurnJobQueue._get_owned_job(job, worker_id).update(
+            visible_at=timezone.now() + timedelta(seconds=get_visibility_timeout())))
+
+    @staticmethod
+    def save_payload(job: ChatTurnJob) -> bool:
+        """Stores the payload of a running job, changed by its handler, for the next attempts. False if the lease was
+        lost."""
+        return bool(ChatTurnJobQueue._get_owned_job(job, job.locked_by).update(payload=job.payload))
+
+    @staticmethod
+    def complete(job: ChatTurnJob, worker_id: str, result) -> bool:
+        """False if the lease was lost and the job was claimed by another worker meanwhile."""
+        return bool(ChatTurnJobQueue._get_owned_job(job, worker_id).update(
+            status=ChatTurnJob.Status.SUCCEEDED, result=json.loads(json.dumps(result, cls=DjangoJSONEncoder)),
+            error="", finished_at=timezone.now()))
+
+    @staticmethod
+    def fail(job: ChatTurnJob, worker_id: str, error: str) -> bool:
+        """Queues the job again with exponential backoff, or fails it after max_attempts."""
+        now = timezone.now()
+        if job.attempts < job.max_attempts:
+            updates = {"status": ChatTurnJob.Status.QUEUED, "visible_at": now + timedelta(seconds=2 ** job.attempts)}
+        else:
+            updates = {"status": ChatTurnJob.Status.FAILED, "finished_at": now}
+        return bool(ChatTurnJobQueue._get_owned_job(job, worker_id).update(error=error, **updates))
+
+    @staticmethod
+    def wait(job_id: int, timeout: float | None = None) -> ChatTurnJob:
+        """Long poll: returns the job once it has finished, or as it is after timeout seconds (default
+        CHAT_TURN_JOB_LONG_POLL_TIMEOUT, 25). Polls the status only, backing off from 0.1 to 1 second."""
+        if timeout is None:
+            timeout = getattr(settings, "CHAT_TURN_JOB_LONG_POLL_TIMEOUT", 25)
+        deadline = time.monotonic() + timeout
+        poll_interval = 0.1
+        while True:
+            status = ChatTurnJob.objects.filter(id=job_id).values_list("status", flat=True).get()
+            remaining = deadline - time.monotonic()
+            if status in FINISHED_STATUSES or remaining <= 0:
+                return ChatTurnJob.objects.get(id=job_id)
+            time.sleep(min(poll_interval, remaining))
+            poll_interval = min(poll_interval * 2, 1.0)
+
+    @staticmethod
+    def run_job(job: ChatTurnJob, worker_id: str) -> None:
+        """Runs a claimed job, extending its lease every third of the visibility timeout while it runs."""
+        finished = threading.Event()
+
+        def extend_lease_until_finished():
+            try:
+                while not finished.wait(get_visibility_timeout() / 3):
+                    try:
+                        if not ChatTurnJobQueue.extend_lease(job, worker_id):
+                            logger.warning(f"Lost the lease of job {job.id}")
+                            return
+                    except Exception as exc:
+                        # Tried again at the next beat, before the lease runs out.
+                        logger.error(f"Failed to extend the lease of job {job.id}, retrying: {exc}")
+                        connections.close_all()
+            finally:
+                connections.close_all()
+
+        heartbeat = threading.Thread(target=extend_lease_until_finished, daemon=True)
+        heartbeat.start()
+        try:
+            result = JOB_HANDLERS[job.kind](job)
+        except Exception as exc:
+            logger.error(f"Job {job.id} failed on attempt {job.attempts}: {exc}")
+            error = "".join(traceback.format_exception(exc))
+            finished.set()
+            heartbeat.join()
+            ChatTurnJobQueue.fail(job, worker_id, error)
+            return
+        finished.set()
+        heartbeat.join()
+        if not ChatTurnJobQueue.complete(job, worker_id, result):
+            logger.warning(f"Job {job.id} finished after its lease was lost, result dropped")
+
+
+def run_worker(worker_id: str, stop_event, poll_interval: float) -> None:
+    """Claims and runs jobs until stop_event is set, finishing the job in progress."""
+    if threading.current_thread() is threading.main_thread():
+        # A Ctrl-C reaches the whole process group; the pool sets stop_event instead.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while not stop_event.is_set():
+        close_old_connections()
+        try:
+            job = ChatTurnJobQueue.claim(worker_id)
+        except Exception as exc:
+            logger.error(f"Worker {worker_id} failed to claim a job: {exc}")
+            job = None
+        if job is None:
+            stop_event.wait(poll_interval)
+            continue
+        logger.info(f"Worker {worker_id} running job {job.id} (attempt {job.attempts})")
+        ChatTurnJobQueue.run_job(job, worker_id)
+
+
+class ChatTurnWorkerPool:
+    """Worker processes running queued jobs, started with the spawn method like the tool process pool. Dead workers
+    are replaced. Workers are not daemonic, so that jobs can use the tool process pool; on shutdown they are told to
+    stop through the stop event and terminated if they do not exit within CHAT_TURN_JOB_SHUTDOWN_TIMEOUT seconds
+    (default the visibility timeout)."""
+
+    def __init__(self, size: int, poll_interval: float = 1.0):
+        self.size = size
+        self.poll_interval = poll_interval
+        self._context = multiprocessing.get_context("spawn")
+        self._stop_event = self._context.Event()
+        self._stopping = False
+        self._processes = {}
+
+    def _start_worker(self, index: int) -> None:
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{index}"
+        process = self._context.Process(target=django_process_main, name=f"chat-turn-worker-{index}", daemon=False,
+                                        args=(os.environ["DJANGO_SETTINGS_MODULE"], "OpenAIService.job_queue.run_worker",
+                                              worker_id, self._stop_event, self.poll_interval))
+        process.start()
+        self._processes[index] = process
+
+    def run(self) -> None:
+        """Starts the workers and replaces dead ones until stop is called."""
+        try:
+            for index in range(self.size):
+                self._start_worker(index)
+            while not self._stopping:
+                time.sleep(self.poll_interval)
+                for index, process in list(self._processes.items()):
+                    if not process.is_alive() and not self._stopping:
+                        logger.error(f"Chat turn worker {process.pid} exited with code {process.exitcode}, "
+                                     f"restarting it")
+                        self._start_worker(index)
+        finally:
+            self._shutdown()
+
+    def _shutdown(self) -> None:
+        self._stopping = True
+        self._stop_event.set()
+        deadline = time.monotonic() + getattr(settings, "CHAT_TURN_JOB_SHUTDOWN_TIMEOUT", get_visibility_timeout())
+        for process in self._processes.values():
+            process.join(max(deadline - time.monotonic(), 0))
+        for process in self._processes.values():
+            if process.is_alive():
+                # Its job is claimed again once its lease expires.
+                logger.warning(f"Terminating chat turn worker {process.pid}, still running after the shutdown timeout")
+                process.terminate()
+                process.join()
+
+    def stop(self) -> None:
+        """Lets each worker finish its current job and exit. Safe to call from a signal handler: run only checks a
+        flag, so the handler never waits on the lock of the shared event held by the interrupted main thread."""
+        self._stopping = True
+        self._stop_event.set()
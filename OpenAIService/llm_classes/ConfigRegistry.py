@@ -0,0 +1,90 @@
+import logging
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE_EXTENSIONS = ('.yaml', '.yml')
+
+
+def get_config_directory_fingerprint(directory: str | None) -> tuple | None:
+    """Name, size and mtime of each config file in directory. Changes whenever a file is added, removed or edited."""
+    if not directory:
+        return None
+    return tuple(sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+                        for entry in os.scandir(directory) if entry.name.endswith(CONFIG_FILE_EXTENSIONS)))
+
+
+class ConfigRegistry(Mapping):
+    """Read only name to config mapping over the YAML files of a directory, loaded on first use.
+
+    The directory is polled at most every CONFIG_RELOAD_INTERVAL seconds (default 5, None never polls again) and,
+    when its fingerprint changed, all files are parsed and validated again and swapped in as a whole. Callers that
+    already hold a config object keep using it, so in-flight requests are not affected. If the new files are
+    invalid, the error is logged and the previous configs stay in use."""
+
+    def __init__(self, load_configs, get_directory):
+        """
+        :param load_configs: callable parsing and validating the configs of a directory into a name to config dict
+        :param get_directory: callable returning the directory, read on each poll so settings are not touched at import
+        """
+        self._load_configs = load_configs
+        self._get_directory = get_directory
+        self._configs = None
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_reload_interval() -> float | None:
+        return getattr(settings, "CONFIG_RELOAD_INTERVAL", 5)
+
+    def _is_fresh(self) -> bool:
+        if self._configs is None:
+            return False
+        reload_interval = self.get_reload_interval()
+        return reload_interval is None or time.monotonic() - self._checked_at < reload_interval
+
+    def get_configs(self) -> dict:
+        configs = self._configs
+        if self._is_fresh():
+            return configs
+        with self._lock:
+            if self._is_fresh():
+                return self._configs
+            directory = self._get_directory()
+            fingerprint = get_config_directory_fingerprint(directory)
+            if self._configs is None or fingerprint != self._fingerprint:
+                try:
+                    new_configs = self._load_configs(directory)
+                except Exception as exc:
+                    # Broken YAML also surfaces as parser, attribute or key errors from the loaders.
+                    if self._configs is None:
+                        raise
+                    logger.error(f"Failed to reload configs from {directory}, keeping the previous ones: {exc}")
+                else:
+                    if self._configs is not None:
+                        logger.info(f"Reloaded configs from {directory}: {sorted(new_configs)}")
+                    self._configs = new_configs
+                # Also recorded after a failure, so that broken files are not parsed again on every poll.
+                self._fingerprint = fingerprint
+            self._checked_at = time.monotonic()
+            return self._configs
+
+    def reload(self) -> dict:
+        with self._lock:
+            self._configs = None
+        return self.get_configs()
+
+    def __getitem__(self, name):
+        return self.get_configs()[name]
+
+    def __iter__(self):
+        return iter(self.get_configs())
+
+    def __len__(self):
+        return len(self.get_configs())
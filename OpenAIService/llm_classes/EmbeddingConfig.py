@@ -0,0 +1,105 @@
+import abc
+import hashlib
+import os
+import re
+
+import yaml
+from django.core.exceptions import ImproperlyConfigured
+from django.conf import settings
+
+from OpenAIService.llm_classes.ConfigRegistry import ConfigRegistry
+
+
+class EmbeddingConfig:
+    def __init__(self, name: str, batch_size: int = 64):
+        self.name = name
+        self.batch_size = batch_size
+
+    @classmethod
+    def load_configs(cls, directory=None):
+        directory = directory or getattr(settings, "EMBEDDING_CONFIGS_PATH", None)
+        configs = {}
+        if not directory:
+            return configs
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.yaml') or filename.endswith('.yml'):
+                with open(os.path.join(directory, filename), 'r') as file:
+                    config = yaml.safe_load(file)
+                    name = config.get('name')
+                    embedding_config_class = config.pop('embedding_config_class', None)
+                    if not name or not embedding_config_class:
+                        raise ImproperlyConfigured(f"Invalid configuration in {filename}")
+                    embedding_class = cls.get_embedding_class(embedding_config_class)
+                    configs[name] = embedding_class(**config)
+        return configs
+
+    @staticmethod
+    def get_embedding_class(name):
+        """Return the appropriate EmbeddingConfig subclass based on type."""
+        if name == 'AzureOpenAIEmbeddingConfig':
+            return AzureOpenAIEmbeddingConfig
+        elif name == 'LocalHashEmbeddingConfig':
+            return LocalHashEmbeddingConfig
+        else:
+            raise ImproperlyConfigured(f"Unsupported EmbeddingConfig type: {name}")
+
+    @abc.abstractmethod
+    def embed(self, texts: list) -> list:
+        """Returns one embedding per text, calling the backend once."""
+        raise NotImplementedError
+
+
+class AzureOpenAIEmbeddingConfig(EmbeddingConfig):
+    def __init__(self, **kwargs):
+        super().__init__(kwargs.get("name"), batch_size=kwargs.get("batch_size", 64))
+        errors = []
+        required_params = {"endpoint": str, "deployment_name": str, "api_key": str, "api_version": str}
+        for param, rp_type in required_params.items():
+            if param not in kwargs or rp_type != type(kwargs.get(param)):
+                errors.append(f"{param} is required and must be a {rp_type}")
+        if errors:
+            raise ImproperlyConfigured(", ".join(errors))
+        self.endpoint = kwargs.get("endpoint")
+        self.deployment_name = kwargs.get("deployment_name")
+        self.api_key = kwargs.get("api_key")
+        self.api_version = kwargs.get("api_version")
+
+    def get_config_dict(self):
+        return {
+            "api_base": self.endpoint,
+            "model": f"azure/{self.deployment_name}",
+            "api_key": self.api_key,
+            "api_version": self.api_version
+        }
+
+    def embed(self, texts: list) -> list:
+        from OpenAIService.openai_service import OpenAIService
+        return OpenAIService.get_embeddings(texts, self.get_config_dict())
+
+
+class LocalHashEmbeddingConfig(EmbeddingConfig):
+    """Deterministic, dependency free embedder hashing word tokens into a fixed number of signed buckets.
+    Meant for tests and local development, it only captures lexical overlap."""
+
+    _TOKEN_RE = re.compile(r"\w+")
+
+    def __init__(self, **kwargs):
+        super().__init__(kwargs.get("name"), batch_size=kwargs.get("batch_size", 256))
+        self.dim = kwargs.get("dim", 256)
+        if type(self.dim) != int or self.dim <= 0:
+            raise ImproperlyConfigured("dim must be a positive int")
+
+    def embed(self, texts: list) -> list:
+        # Imported here so that loading the configs (e.g. by the admin at startup) does not import numpy.
+        import numpy as np
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for token in self._TOKEN_RE.findall(text.lower()):
+                digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.dim
+                embeddings[i, bucket] += 1.0 if digest[4] & 1 else -1.0
+        return embeddings.tolist()
+
+
+GLOBAL_LOADED_EMBEDDING_CONFIGS = ConfigRegistry(EmbeddingConfig.load_configs,
+                                                 lambda: getattr(settings, "EMBEDDING_CONFIGS_PATH", None))
@@ -4,6 +4,8 @@ import yaml
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
+from OpenAIService.llm_classes.ConfigRegistry import ConfigRegistry
+
 class LLMConfig:
     def __init__(self, name:str, tools_enabled:bool=False):
         self.name = name
@@ -13,9 +15,10 @@ class LLMConfig:
         return self.tools_enabled
 
     @classmethod
-    def load_configs(cls, directory=settings.LLM_CONFIGS_PATH):
+    def load_configs(cls, directory=None):
+        directory = directory or settings.LLM_CONFIGS_PATH
         configs = {}
-        for filename in os.listdir(directory):
+        for filename in sorted(os.listdir(directory)):
             if filename.endswith('.yaml') or filename.endswith('.yml'):
                 with open(os.path.join(directory, filename), 'r') as file:
                     config = yaml.safe_load(file)
@@ -142,4 +145,5 @@ class GroqConfig(LLMConfig):
             "model": f"groq/{self.model_name}",
             "api_key": self.api_key
         }
-GLOBAL_LOADED_LLM_CONFIGS = LLMConfig.load_configs()
+# Loaded on first use and reloaded when files in LLM_CONFIGS_PATH change, see ConfigRegistry.
+GLOBAL_LOADED_LLM_CONFIGS = ConfigRegistry(LLMConfig.load_configs, lambda: settings.LLM_CONFIGS_PATH)
@@ -0,0 +1,109 @@
+from itertools import islice
+
+from OpenAIService.summarization import SUMMARY_RANGE_KEY
+
+# Key of user msgs that ask a turn again, holding the [start, end) range of chat_history positions of the turn they
+# replace. The replaced msgs stay in the history but are no longer sent to the LLM or displayed.
+REPLACED_RANGE_KEY = "replaces"
+
+
+def get_replaced_positions(chat_history: list) -> set:
+    """Positions of the msgs of chat_history replaced by a later msg."""
+    replaced_positions = set()
+    for msg in chat_history:
+        if REPLACED_RANGE_KEY in msg:
+            replaced_positions.update(range(*msg[REPLACED_RANGE_KEY]))
+    return replaced_positions
+
+
+class LLMMessage:
+    """LLM facing view of a chat history msg. Refers to the values of the msg instead of copying them, and builds its
+    request payload once; payloads are shared between requests, so callers must not modify them."""
+
+    __slots__ = ("role", "content", "tool_call_id", "name", "tool_calls", "_payload")
+
+    def __init__(self, role: str, content, *, tool_call_id: str | None = None, name: str | None = None,
+                 tool_calls: list | None = None):
+        self.role = role
+        self.content = content
+        self.tool_call_id = tool_call_id
+        self.name = name
+        self.tool_calls = tool_calls
+        self._payload = None
+
+    @classmethod
+    def from_history_msg(cls, msg: dict) -> "LLMMessage":
+        role = msg["role"]
+        if role in ("user", "assistant", "system"):
+            return cls(role, msg["content"], tool_calls=msg.get("tool_calls"))
+        if role == "tool":
+            return cls(role, msg["content"], tool_call_id=msg["tool_call_id"], name=msg["name"],
+                       tool_calls=msg.get("tool_calls"))
+        raise ValueError(f"Unexpected msg role: {role}")
+
+    def to_payload(self) -> dict:
+        if self._payload is None:
+            payload = {"content": self.content, "role": self.role}
+            if self.role == "tool":
+                payload["tool_call_id"] = self.tool_call_id
+                payload["name"] = self.name
+            if self.tool_calls is not None:
+                payload["tool_calls"] = self.tool_calls
+            self._payload = payload
+        return self._payload
+
+
+class LLMMessageProjection:
+    """LLMMessages of a chat history by position, extended with the msgs appended to the history since the last
+    sync instead of being rebuilt per request. Summary msgs are tracked separately: the latest one replaces the range
+    of positions it covers. Msgs replaced by a later ask of their turn are dropped."""
+
+    __slots__ = ("_msgs", "_summary")
+
+    def __init__(self):
+        # LLMMessage per position of the history, None for summary msgs.
+        self._msgs = []
+        # (LLMMessage, start, end) of the latest summary msg.
+        self._summary = None
+
+    def __len__(self) -> int:
+        return len(self._msgs)
+
+    def reset(self) -> None:
+        self._msgs = []
+        self._summary = None
+
+    def sync(self, chat_history: list) -> None:
+        if len(self._msgs) > len(chat_history):
+            # The history was rewritten.
+            self.reset()
+        for position in range(len(self._msgs), len(chat_history)):
+            msg = chat_history[position]
+            if SUMMARY_RANGE_KEY in msg:
+                start, end = msg[SUMMARY_RANGE_KEY]
+                self._summary = (LLMMessage("system", msg["content"]), start, end)
+                self._msgs.append(None)
+            else:
+                if REPLACED_RANGE_KEY in msg:
+                    start, end = msg[REPLACED_RANGE_KEY]
+                    for replaced_position in range(start, min(end, position)):
+                        self._msgs[replaced_position] = None
+                self._msgs.append(LLMMessage.from_history_msg(msg))
+
+    def refresh(self, chat_history: list, position: int) -> None:
+        """Projects the msg at position again after it was changed in place."""
+        if position < len(self._msgs) and self._msgs[position] is not None:
+            self._msgs[position] = LLMMessage.from_history_msg(chat_history[position])
+
+    def get_payloads(self, upto: int | None = None) -> list:
+        """New list of the request payloads of the msgs before position upto (all by default), with the covered
+        range replaced by the latest summary."""
+        if upto is None:
+            upto = len(self._msgs)
+        if self._summary is None or self._summary[1] >= upto:
+            return [msg.to_payload() for msg in islice(self._msgs, upto) if msg is not None]
+        summary, start, end = self._summary
+        payloads = [msg.to_payload() for msg in islice(self._msgs, start) if msg is not None]
+        payloads.append(summary.to_payload())
+        payloads.extend(msg.to_payload() for msg in islice(self._msgs, end, upto) if msg is not None)
+        return payloads
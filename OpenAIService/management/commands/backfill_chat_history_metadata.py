@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from OpenAIService.models import ChatHistory
+from OpenAIService.repositories import ChatHistoryRepository
+
+METADATA_FIELDS = ["message_count", "token_count", "last_message_at"]
+
+
+class Command(BaseCommand):
+    help = ("Fills in the msg count, token count and last msg time of chats saved before they were kept. Chats "
+            "are otherwise updated on their next commit. Safe to run while chats are in use, and to run again.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="Chats locked and updated per transaction.")
+        parser.add_argument("--all", action="store_true", help="Recompute every chat, not only those without counts.")
+
+    def handle(self, *args, **options):
+        chat_histories = ChatHistory.objects.all() if options["all"] else ChatHistory.objects.filter(message_count=0)
+        last_id = 0
+        updated_count = 0
+        while True:
+            with transaction.atomic():
+                batch = list(chat_histories.select_for_update().filter(id__gt=last_id).order_by("id")
+                             .only("id", "chat_history", "display_projected_upto", *METADATA_FIELDS)
+                             [:options["batch_size"]])
+                if not batch:
+                    break
+                for chat_history_obj in batch:
+                    ChatHistoryRepository.update_metadata(chat_history_obj, full=True)
+                ChatHistory.objects.bulk_update(batch, METADATA_FIELDS)
+            last_id = batch[-1].id
+            updated_count += len(batch)
+            self.stdout.write(f"Updated {updated_count} chats, up to id {last_id}")
+        self.stdout.write(self.style.SUCCESS(f"Backfilled the metadata of {updated_count} chats."))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from OpenAIService.models import KnowledgeRepository
+from OpenAIService.rag.ingestion import IngestionPipeline
+from OpenAIService.rag.vector_index import SUPPORTED_DTYPES
+
+
+class Command(BaseCommand):
+    help = "Parses, chunks and embeds the content references of a knowledge repository into its index_path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("knowledge_repository_id", type=int)
+        parser.add_argument("--embedding-config", required=True,
+                            help="Name of the embedding config (from EMBEDDING_CONFIGS_PATH).")
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--chunk-overlap", type=int, default=200)
+        parser.add_argument("--embed-batch-size", type=int, default=64)
+        parser.add_argument("--workers", type=int, default=None, help="Parser processes. Defaults to CPU count.")
+        parser.add_argument("--dtype", choices=SUPPORTED_DTYPES, default="float32",
+                            help="Storage type of the embedding matrix. int8 is quantized per row.")
+        parser.add_argument("--full", action="store_true",
+                            help="Rebuild from scratch instead of only re-indexing new and changed content references.")
+
+    def handle(self, *args, **options):
+        knowledge_repository = KnowledgeRepository.objects.get(id=options["knowledge_repository_id"])
+        pipeline = IngestionPipeline.for_embedding_config(
+            knowledge_repository,
+            options["embedding_config"],
+            chunk_size=options["chunk_size"],
+            chunk_overlap=options["chunk_overlap"],
+            embed_batch_size=options["embed_batch_size"],
+            max_workers=options["workers"],
+            index_dtype=options["dtype"],
+        )
+        stats = pipeline.run() if options["full"] else pipeline.reindex()
+        self.stdout.write(self.style.SUCCESS(
+            f"Indexed {stats['documents']} documents into {stats['chunks']} chunks ({stats['failed_documents']} failed, "
+            f"{stats['unchanged_documents']} unchanged, {stats['deleted_documents']} deleted). "
+            f"Index has {stats['rows']} rows, {stats['tombstones']} tombstoned."))
+        if pipeline.compaction_thread is not None:
+            self.stdout.write("Compacting tombstoned rows in the background...")
+            pipeline.compaction_thread.join()
+            self.stdout.write(self.style.SUCCESS("Compaction done."))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from OpenAIService.startup_checks import validate_prompt_configuration
+
+
+class Command(BaseCommand):
+    help = ("Checks that the prompt templates required by code and the LLM configs exist, e.g. as a deployment step "
+            "with DISABLE_PROMPT_VALIDATIONS set so that workers skip the check.")
+
+    def handle(self, *args, **options):
+        try:
+            validate_prompt_configuration()
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(self.style.SUCCESS("Prompt templates and LLM configs are valid."))
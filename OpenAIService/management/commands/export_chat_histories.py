@@ -0,0 +1,53 @@
+import sys
+from datetime import datetime, time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from OpenAIService.chat_export import EXPORT_FORMATS, export_chat_histories
+
+
+def parse_date(value: str) -> datetime:
+    """YYYY-MM-DD (midnight) or an ISO datetime, in the current timezone unless it carries one."""
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid date: {value}")
+    if len(value) == 10:
+        parsed = datetime.combine(parsed.date(), time.min)
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Command(BaseCommand):
+    help = "Streams chat histories as one row per msg to JSONL, Parquet or Arrow, in bounded memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output", default="-", help="Output file, - writes JSONL to stdout.")
+        parser.add_argument("--format", choices=EXPORT_FORMATS, default="jsonl")
+        parser.add_argument("--start", type=parse_date, help="Only msgs at or after this date, YYYY-MM-DD or ISO.")
+        parser.add_argument("--end", type=parse_date, help="Only msgs before this date, YYYY-MM-DD or ISO.")
+        parser.add_argument("--prompt", action="append", dest="prompts",
+                            help="Only chats of this prompt template. Can be repeated.")
+        parser.add_argument("--chunk-size", type=int, default=200, help="Chats read per DB round trip.")
+
+    def handle(self, *args, **options):
+        export_format = options["format"]
+        output = options["output"]
+        if output == "-" and export_format != "jsonl":
+            raise CommandError(f"{export_format} export needs an --output file")
+        filters = {"start": options["start"], "end": options["end"], "prompt_template_names": options["prompts"],
+                   "chunk_size": options["chunk_size"]}
+        try:
+            if export_format != "jsonl":
+                row_count = export_chat_histories(output, export_format, **filters)
+            elif output == "-":
+                row_count = export_chat_histories(sys.stdout, export_format, **filters)
+            else:
+                with open(output, "w", encoding="utf-8") as output_file:
+                    row_count = export_chat_histories(output_file, export_format, **filters)
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+        self.stderr.write(f"Exported {row_count} msgs")
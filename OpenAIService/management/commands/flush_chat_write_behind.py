@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from OpenAIService.write_behind import get_write_behind_queue
+
+
+class Command(BaseCommand):
+    help = ("Writes the chat commits queued by CHAT_WRITE_BEHIND_QUEUE_PATH to the DB, e.g. before a deploy or after "
+            "a crash of the workers of a host.")
+
+    def handle(self, *args, **options):
+        write_behind_queue = get_write_behind_queue()
+        if write_behind_queue is None:
+            raise CommandError("CHAT_WRITE_BEHIND_QUEUE_PATH is not set.")
+        flushed = write_behind_queue.flush(blocking=True)
+        self.stdout.write(self.style.SUCCESS(f"Flushed {flushed} queued chat commits, "
+                                             f"{write_behind_queue.pending_count()} left."))
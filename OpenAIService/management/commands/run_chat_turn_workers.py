@@ -0,0 +1,25 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from OpenAIService.job_queue import ChatTurnWorkerPool
+
+
+class Command(BaseCommand):
+    help = ("Runs worker processes for the chat turns and assistant runs queued with OpenAIService.job_queue. On "
+            "SIGTERM or SIGINT, the workers finish their current job and exit.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=getattr(settings, "CHAT_TURN_JOB_WORKERS", 2),
+                            help="Worker processes, default CHAT_TURN_JOB_WORKERS (2).")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds an idle worker waits before looking for queued jobs again.")
+
+    def handle(self, *args, **options):
+        pool = ChatTurnWorkerPool(options["processes"], options["poll_interval"])
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: pool.stop())
+        self.stdout.write(f"Running {options['processes']} chat turn workers")
+        pool.run()
+        self.stdout.write(self.style.SUCCESS("Chat turn workers stopped."))
@@ -0,0 +1,59 @@
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+STARTUP_SCRIPT = """
+import time
+start = time.perf_counter()
+import django
+django.setup()
+setup_done = time.perf_counter()
+import OpenAIService.repositories
+print(f"{setup_done - start:.6f} {time.perf_counter() - setup_done:.6f}")
+"""
+
+
+class Command(BaseCommand):
+    help = ("Measures cold startup of a fresh interpreter: django.setup() (including OpenAIConfig.ready()) and the "
+            "import of OpenAIService.repositories, with the slowest imports reported by python -X importtime.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=15, help="Number of slowest imports listed.")
+
+    @staticmethod
+    def parse_import_times(importtime_output: str) -> list:
+        """(cumulative microseconds, module, nesting level) per line of -X importtime output."""
+        import_times = []
+        for line in importtime_output.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, module = line[len("import time:"):].split("|", 2)
+            if cumulative.strip().isdigit():
+                module = module.rstrip()
+                import_times.append((int(cumulative), module.strip(), len(module) - len(module.lstrip()) - 1))
+        return import_times
+
+    def handle(self, *args, **options):
+        if not os.environ.get("DJANGO_SETTINGS_MODULE"):
+            raise CommandError("DJANGO_SETTINGS_MODULE must be set for the child interpreter.")
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_SCRIPT], capture_output=True,
+                                text=True, env=os.environ.copy())
+        if result.returncode != 0:
+            raise CommandError(f"Startup failed:\n{result.stderr[-2000:]}")
+        setup_seconds, import_seconds = (float(value) for value in result.stdout.split()[-2:])
+        import_times = self.parse_import_times(result.stderr)
+        # Top level modules only, their cumulative times add up to the total.
+        total_import_us = sum(cumulative for cumulative, _, level in import_times if level == 0)
+
+        self.stdout.write(f"django.setup():                      {setup_seconds * 1000:9.1f} ms")
+        self.stdout.write(f"import OpenAIService.repositories:   {import_seconds * 1000:9.1f} ms")
+        self.stdout.write(f"total import time:                   {total_import_us / 1000:9.1f} ms")
+        self.stdout.write("\nSlowest imports (cumulative):")
+        for cumulative, module, _ in sorted(import_times, reverse=True)[:options["top"]]:
+            self.stdout.write(f"{cumulative / 1000:9.1f} ms  {module}")
+        imported_modules = {module for _, module, _ in import_times}
+        for heavy_module in ("litellm", "openai"):
+            self.stdout.write(f"{heavy_module} imported at startup: "
+                              f"{'yes' if heavy_module in imported_modules else 'no'}")
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.15 on 2024-10-21 10:12
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0005_knowledgerepository_contentreference'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='display_projected_upto',
+            field=models.IntegerField(default=0, help_text='Number of msgs of chat_history already materialized as ChatDisplayMessage rows.'),
+        ),
+        migrations.CreateModel(
+            name='ChatDisplayMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.IntegerField(help_text='Index of the source msg in ChatHistory.chat_history. Used as the pagination cursor.')),
+                ('type', models.CharField(max_length=20)),
+                ('message', models.TextField(blank=True, default='')),
+                ('tool_data', models.JSONField(blank=True, default=dict)),
+                ('chat_history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='display_messages', to='OpenAIService.chathistory')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatdisplaymessage',
+            constraint=models.UniqueConstraint(fields=('chat_history', 'position'), name='unique_chat_display_message_position'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2024-10-24 08:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0006_chathistory_display_projected_upto_chatdisplaymessage'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='knowledgerepository',
+            name='source_type',
+            field=models.IntegerField(choices=[(1, 'Azure Blob'), (2, 'Amazon S3'), (3, 'Google Drive'), (4, 'Local Filesystem')]),
+        ),
+        migrations.AlterField(
+            model_name='knowledgerepository',
+            name='type',
+            field=models.IntegerField(choices=[(1, 'Course')]),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2024-10-28 11:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0007_alter_knowledgerepository_source_type_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='knowledgerepository',
+            name='course_id',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='contentreference',
+            name='course_id',
+            field=models.IntegerField(blank=True, help_text='Defaults to the course of the knowledge repository.', null=True),
+        ),
+    ]
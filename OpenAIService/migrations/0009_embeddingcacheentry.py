@@ -0,0 +1,27 @@
+# Generated by Django 4.2.15 on 2024-11-04 09:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0008_knowledgerepository_course_id_contentreference_course_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('embedding_config_name', models.CharField(max_length=100)),
+                ('content_hash', models.CharField(help_text='sha256 of the embedded text.', max_length=64)),
+                ('embedding', models.BinaryField(help_text='float32 little endian vector.')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='embeddingcacheentry',
+            constraint=models.UniqueConstraint(fields=('embedding_config_name', 'content_hash'), name='unique_embedding_cache_entry'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.15 on 2024-10-28 11:05
+
+from django.db import migrations
+
+TOOL_NAME = "search_course_knowledge"
+
+TOOL_CODE = '''def search_course_knowledge(__course_id__: int, query: str):
+    """Searches the course material for passages relevant to the question of the student.
+
+    :param __course_id__: id of the course of the chat
+    :param query: self contained search query, e.g. the question of the student together with its topic
+    """
+    from OpenAIService.rag.retrieval import search_course_knowledge as search
+    return search(query, int(__course_id__))
+'''
+
+TOOL_JSON_SPEC = {
+    "name": TOOL_NAME,
+    "description": "Searches the course material for passages relevant to the question of the student.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "query": {
+                "type": "string",
+                "description": "self contained search query, e.g. the question of the student together with its topic",
+            },
+        },
+        "required": ["query"],
+    },
+}
+
+
+def create_tool(apps, schema_editor):
+    Tool = apps.get_model("OpenAIService", "Tool")
+    if not Tool.objects.filter(name=TOOL_NAME).exists():
+        Tool.objects.create(name=TOOL_NAME, tool_code=TOOL_CODE, tool_json_spec=TOOL_JSON_SPEC,
+                            context_params=["__course_id__"])
+
+
+def delete_tool(apps, schema_editor):
+    Tool = apps.get_model("OpenAIService", "Tool")
+    Tool.objects.filter(name=TOOL_NAME).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0009_embeddingcacheentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_tool, delete_tool),
+    ]
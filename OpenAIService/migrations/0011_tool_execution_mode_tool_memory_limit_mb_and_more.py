@@ -0,0 +1,28 @@
+# Generated by Django 4.2.15 on 2024-10-29 09:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0010_search_course_knowledge_tool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tool',
+            name='execution_mode',
+            field=models.IntegerField(choices=[(1, 'In Thread'), (2, 'Process Pool')], default=1, help_text='In thread is cheapest, use the process pool for slow, CPU heavy or untrusted tools.'),
+        ),
+        migrations.AddField(
+            model_name='tool',
+            name='memory_limit_mb',
+            field=models.IntegerField(blank=True, help_text='Memory a call may allocate on top of the idle worker. Process pool only.', null=True),
+        ),
+        migrations.AddField(
+            model_name='tool',
+            name='timeout_seconds',
+            field=models.FloatField(default=30, help_text='Wall clock limit of a call. Process pool only.'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.15 on 2024-10-30 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0011_tool_execution_mode_tool_memory_limit_mb_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tool',
+            name='cache_key_context_params',
+            field=models.JSONField(blank=True, help_text='Context params that are part of the cache key, e.g. ["__course_id__"]. All of them are when left empty, none with [].', null=True),
+        ),
+        migrations.AddField(
+            model_name='tool',
+            name='cache_scope',
+            field=models.IntegerField(choices=[(1, 'Chat'), (2, 'Global')], default=1, help_text='Whether cached results are shared within a chat or across all chats.'),
+        ),
+        migrations.AddField(
+            model_name='tool',
+            name='cache_ttl_seconds',
+            field=models.IntegerField(default=0, help_text='Seconds a result is reused for calls with the same arguments. 0 disables caching; only enable it for pure lookups.'),
+        ),
+    ]
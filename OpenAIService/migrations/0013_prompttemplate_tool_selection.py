@@ -0,0 +1,33 @@
+# Generated by Django 4.2.15 on 2024-11-04 10:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0012_tool_cache_key_context_params_tool_cache_scope_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='pinned_tools',
+            field=models.ManyToManyField(blank=True, help_text='Tools always sent when tool selection is on. Must also be in tools.', related_name='pinned_in_prompt_templates', to='OpenAIService.tool'),
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='tool_selection_embedding_config',
+            field=models.CharField(blank=True, help_text='Embedding config used in embedding mode.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='tool_selection_mode',
+            field=models.IntegerField(choices=[(1, 'All'), (2, 'Keyword'), (3, 'Embedding')], default=1, help_text='All sends every tool spec with each completion. Keyword and embedding only send the tools most relevant to the user msg and recent turns, plus pinned tools.'),
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='tool_selection_top_k',
+            field=models.IntegerField(default=5, help_text='Number of selected tools sent, besides pinned tools.'),
+        ),
+    ]
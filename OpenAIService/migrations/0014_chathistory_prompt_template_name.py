@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2024-11-06 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0013_prompttemplate_tool_selection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='prompt_template_name',
+            field=models.CharField(blank=True, db_index=True, help_text='Prompt template of the chat. Empty for chats created before it was recorded.', max_length=100),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.15 on 2024-11-08 15:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0014_chathistory_prompt_template_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PromptUsageRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prompt_template_name', models.CharField(max_length=100)),
+                ('llm_config_name', models.CharField(max_length=100)),
+                ('hour', models.DateTimeField(help_text='Start of the hour bucket.')),
+                ('message_count', models.IntegerField(default=0)),
+                ('tool_call_count', models.IntegerField(default=0)),
+                ('prompt_tokens', models.BigIntegerField(default=0)),
+                ('completion_tokens', models.BigIntegerField(default=0)),
+                ('total_latency_ms', models.BigIntegerField(default=0)),
+                ('latency_le_100ms', models.IntegerField(default=0)),
+                ('latency_le_250ms', models.IntegerField(default=0)),
+                ('latency_le_500ms', models.IntegerField(default=0)),
+                ('latency_le_1000ms', models.IntegerField(default=0)),
+                ('latency_le_2000ms', models.IntegerField(default=0)),
+                ('latency_le_4000ms', models.IntegerField(default=0)),
+                ('latency_le_8000ms', models.IntegerField(default=0)),
+                ('latency_le_16000ms', models.IntegerField(default=0)),
+                ('latency_le_32000ms', models.IntegerField(default=0)),
+                ('latency_le_64000ms', models.IntegerField(default=0)),
+                ('latency_gt_64000ms', models.IntegerField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['hour'], name='OpenAIServi_hour_421851_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='promptusagerollup',
+            constraint=models.UniqueConstraint(fields=('prompt_template_name', 'llm_config_name', 'hour'), name='unique_prompt_usage_rollup'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2024-11-11 10:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0015_promptusagerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='version',
+            field=models.IntegerField(default=0, help_text='Incremented by every commit of msgs to the chat.'),
+        ),
+    ]
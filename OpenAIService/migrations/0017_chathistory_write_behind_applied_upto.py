@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2024-11-13 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0016_chathistory_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='write_behind_applied_upto',
+            field=models.BigIntegerField(default=0, help_text='Sequence number of the last write behind queue entry applied to the chat.'),
+        ),
+    ]
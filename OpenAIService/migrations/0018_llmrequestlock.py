@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2024-11-14 11:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0017_chathistory_write_behind_applied_upto'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMRequestLock',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(help_text='sha256 of the msgs and LLM params.', max_length=64, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True, help_text='While response is empty, the call is presumed lost after this. Afterwards, the row can be deleted.')),
+                ('response', models.JSONField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.15 on 2024-11-15 14:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0018_llmrequestlock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='summarization_keep_recent_msgs',
+            field=models.IntegerField(default=6, help_text='Number of most recent msgs always sent as is.'),
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='summarization_llm_config_name',
+            field=models.CharField(blank=True, help_text='LLM config writing the summaries, usually a cheaper model. Defaults to llm_config_name.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='summarization_threshold_tokens',
+            field=models.IntegerField(blank=True, help_text='When the msgs sent to the LLM exceed about this many tokens, older turns are summarized in the background and the summary is sent instead of them. Empty disables summarization.', null=True),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.15 on 2024-11-18 10:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0019_prompttemplate_summarization'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chathistory',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chathistory',
+            name='message_count',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='chathistory',
+            name='owner_key',
+            field=models.CharField(blank=True, help_text='Key of the user owning the chat, given by the caller when the chat is created.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='chathistory',
+            name='token_count',
+            field=models.IntegerField(default=0, help_text='Estimated tokens of all msgs, at 4 chars per token.'),
+        ),
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['owner_key', '-last_message_at'], name='OpenAIServi_owner_k_d7eca3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chathistory',
+            index=models.Index(fields=['prompt_template_name', '-last_message_at'], name='OpenAIServi_prompt__79984f_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.15 on 2024-11-19 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0020_chathistory_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='cascade_llm_config_name',
+            field=models.CharField(blank=True, help_text='Fast LLM config answering first. Its answers failing the cascade verifier are sent again to llm_config_name. Empty disables the cascade.', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='cascade_verifier',
+            field=models.IntegerField(choices=[(1, 'Self reported confidence'), (2, 'JSON schema'), (3, 'Length and refusal heuristic')], default=1),
+        ),
+        migrations.AddField(
+            model_name='prompttemplate',
+            name='cascade_verifier_params',
+            field=models.JSONField(blank=True, default=dict, help_text="Verifier options, e.g. {'min_confidence': 0.8}, {'schema': {...}} or {'min_length': 20, 'refusal_patterns': [...]}."),
+        ),
+        migrations.AddField(
+            model_name='promptusagerollup',
+            name='cascade_accepted_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='promptusagerollup',
+            name='cascade_accepted_latency_ms',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='promptusagerollup',
+            name='cascade_escalated_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='promptusagerollup',
+            name='cascade_escalated_fast_latency_ms',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='promptusagerollup',
+            name='cascade_escalated_strong_latency_ms',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
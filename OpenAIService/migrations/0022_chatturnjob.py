@@ -0,0 +1,35 @@
+# Generated by Django 4.2.15 on 2024-11-21 09:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0021_prompttemplate_cascade'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatTurnJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('idempotency_key', models.CharField(blank=True, help_text='Given by the caller, so that a retried submission returns the existing job instead of running the turn again.', max_length=200, null=True, unique=True)),
+                ('kind', models.IntegerField(choices=[(1, 'Chat turn'), (2, 'Assistant response using file')])),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.IntegerField(choices=[(1, 'Queued'), (2, 'Running'), (3, 'Succeeded'), (4, 'Failed')], default=1)),
+                ('visible_at', models.DateTimeField(help_text='A queued job is claimed after this. A running job whose worker did not extend it by then is claimed again.')),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=3)),
+                ('locked_by', models.CharField(blank=True, help_text='Worker running the job.', max_length=100)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'visible_at'], name='OpenAIServi_status_3a1070_idx')],
+            },
+        ),
+    ]
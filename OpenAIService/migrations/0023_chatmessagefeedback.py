@@ -0,0 +1,30 @@
+# Generated by Django 4.2.15 on 2024-11-22 11:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0022_chatturnjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatMessageFeedback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('msg_id', models.IntegerField(help_text='Id of the rated answer in ChatHistory.chat_history, its position + 1.')),
+                ('rating', models.IntegerField(choices=[(1, 'Helpful'), (-1, 'Not helpful')])),
+                ('comment', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chat_history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feedback', to='OpenAIService.chathistory')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatmessagefeedback',
+            constraint=models.UniqueConstraint(fields=('chat_history', 'msg_id'), name='unique_chat_message_feedback'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.15 on 2024-11-22 14:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('OpenAIService', '0023_chatmessagefeedback'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='chathistory',
+            name='write_behind_applied_upto',
+        ),
+        migrations.CreateModel(
+            name='ChatWriteBehindMarker',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('queue_id', models.CharField(help_text='Id of the write behind queue, kept in its SQLite file.', max_length=100)),
+                ('applied_upto', models.BigIntegerField(default=0, help_text='Sequence number of the last entry of the queue applied to the chat.')),
+                ('chat_history', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='write_behind_markers', to='OpenAIService.chathistory')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='chatwritebehindmarker',
+            constraint=models.UniqueConstraint(fields=('queue_id', 'chat_history'), name='unique_chat_write_behind_marker'),
+        ),
+    ]
@@ -11,6 +11,14 @@ class OpenAIAssistant(models.Model):
 
 
 class Tool(models.Model):
+    class ExecutionMode(models.IntegerChoices):
+        IN_THREAD = 1, "In Thread"
+        PROCESS_POOL = 2, "Process Pool"
+
+    class CacheScope(models.IntegerChoices):
+        CHAT = 1, "Chat"
+        GLOBAL = 2, "Global"
+
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
     tool_code = models.TextField()
@@ -18,12 +26,28 @@ class Tool(models.Model):
     tool_json_spec = models.JSONField(default=dict,blank=True)
     name = models.CharField(max_length=100)
     context_params = models.JSONField(default=list, blank=True)
+    execution_mode = models.IntegerField(choices=ExecutionMode.choices, default=ExecutionMode.IN_THREAD, help_text="In thread is cheapest, use the process pool for slow, CPU heavy or untrusted tools.")
+    timeout_seconds = models.FloatField(default=30, help_text="Wall clock limit of a call. Process pool only.")
+    memory_limit_mb = models.IntegerField(null=True, blank=True, help_text="Memory a call may allocate on top of the idle worker. Process pool only.")
+    cache_ttl_seconds = models.IntegerField(default=0, help_text="Seconds a result is reused for calls with the same arguments. 0 disables caching; only enable it for pure lookups.")
+    cache_scope = models.IntegerField(choices=CacheScope.choices, default=CacheScope.CHAT, help_text="Whether cached results are shared within a chat or across all chats.")
+    cache_key_context_params = models.JSONField(null=True, blank=True, help_text="Context params that are part of the cache key, e.g. [\"__course_id__\"]. All of them are when left empty, none with [].")
     def __str__(self):
         return self.name
 
 
 
 class PromptTemplate(models.Model):
+    class ToolSelectionMode(models.IntegerChoices):
+        ALL = 1, "All"
+        KEYWORD = 2, "Keyword"
+        EMBEDDING = 3, "Embedding"
+
+    class CascadeVerifier(models.IntegerChoices):
+        SELF_CONFIDENCE = 1, "Self reported confidence"
+        JSON_SCHEMA = 2, "JSON schema"
+        HEURISTIC = 3, "Length and refusal heuristic"
+
     name = models.CharField(max_length=100)
     llm_config_name = models.CharField(max_length=100)
     type = models.CharField(max_length=100, blank=True, null=True)
@@ -33,12 +57,80 @@ class PromptTemplate(models.Model):
     user_prompt_template = models.TextField(blank=True, default="")
     logged_context_vars = models.JSONField(blank=True,default=list, help_text="Context variables to be logged in the chat log along with each user message, for later analysis.")
     tools = models.ManyToManyField(Tool,blank=True)
+    tool_selection_mode = models.IntegerField(choices=ToolSelectionMode.choices, default=ToolSelectionMode.ALL, help_text="All sends every tool spec with each completion. Keyword and embedding only send the tools most relevant to the user msg and recent turns, plus pinned tools.")
+    tool_selection_top_k = models.IntegerField(default=5, help_text="Number of selected tools sent, besides pinned tools.")
+    tool_selection_embedding_config = models.CharField(max_length=100, blank=True, help_text="Embedding config used in embedding mode.")
+    pinned_tools = models.ManyToManyField(Tool, blank=True, related_name="pinned_in_prompt_templates", help_text="Tools always sent when tool selection is on. Must also be in tools.")
+    summarization_threshold_tokens = models.IntegerField(null=True, blank=True, help_text="When the msgs sent to the LLM exceed about this many tokens, older turns are summarized in the background and the summary is sent instead of them. Empty disables summarization.")
+    summarization_llm_config_name = models.CharField(max_length=100, blank=True, help_text="LLM config writing the summaries, usually a cheaper model. Defaults to llm_config_name.")
+    summarization_keep_recent_msgs = models.IntegerField(default=6, help_text="Number of most recent msgs always sent as is.")
+    cascade_llm_config_name = models.CharField(max_length=100, blank=True, help_text="Fast LLM config answering first. Its answers failing the cascade verifier are sent again to llm_config_name. Empty disables the cascade.")
+    cascade_verifier = models.IntegerField(choices=CascadeVerifier.choices, default=CascadeVerifier.SELF_CONFIDENCE)
+    cascade_verifier_params = models.JSONField(blank=True, default=dict, help_text="Verifier options, e.g. {'min_confidence': 0.8}, {'schema': {...}} or {'min_length': 20, 'refusal_patterns': [...]}.")
 
 
 class ChatHistory(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     created_at = models.DateTimeField(auto_now_add=True)
     chat_history = models.JSONField(default=list)
+    display_projected_upto = models.IntegerField(default=0, help_text="Number of msgs of chat_history already materialized as ChatDisplayMessage rows.")
+    prompt_template_name = models.CharField(max_length=100, blank=True, db_index=True, help_text="Prompt template of the chat. Empty for chats created before it was recorded.")
+    version = models.IntegerField(default=0, help_text="Incremented by every commit of msgs to the chat.")
+    # Kept up to date on every commit, so that chats can be listed and filtered without reading chat_history.
+    owner_key = models.CharField(max_length=100, blank=True, help_text="Key of the user owning the chat, given by the caller when the chat is created.")
+    message_count = models.IntegerField(default=0, db_index=True)
+    token_count = models.IntegerField(default=0, help_text="Estimated tokens of all msgs, at 4 chars per token.")
+    last_message_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner_key', '-last_message_at']),
+            models.Index(fields=['prompt_template_name', '-last_message_at']),
+        ]
+
+
+class ChatDisplayMessage(models.Model):
+    chat_history = models.ForeignKey(ChatHistory, on_delete=models.CASCADE, related_name='display_messages')
+    position = models.IntegerField(help_text="Index of the source msg in ChatHistory.chat_history. Used as the pagination cursor.")
+    type = models.CharField(max_length=20)
+    message = models.TextField(blank=True, default="")
+    tool_data = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat_history', 'position'], name='unique_chat_display_message_position'),
+        ]
+
+
+class ChatMessageFeedback(models.Model):
+    class Rating(models.IntegerChoices):
+        HELPFUL = 1, "Helpful"
+        NOT_HELPFUL = -1, "Not helpful"
+
+    chat_history = models.ForeignKey(ChatHistory, on_delete=models.CASCADE, related_name='feedback')
+    msg_id = models.IntegerField(help_text="Id of the rated answer in ChatHistory.chat_history, its position + 1.")
+    rating = models.IntegerField(choices=Rating.choices)
+    comment = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['chat_history', 'msg_id'], name='unique_chat_message_feedback'),
+        ]
+
+
+class ChatWriteBehindMarker(models.Model):
+    """Last entry of a write behind queue applied to a chat. Sequence numbers only grow within one queue, so the
+    marker is kept per queue: the clocks of different hosts are not in step."""
+    queue_id = models.CharField(max_length=100, help_text="Id of the write behind queue, kept in its SQLite file.")
+    chat_history = models.ForeignKey(ChatHistory, on_delete=models.CASCADE, related_name='write_behind_markers')
+    applied_upto = models.BigIntegerField(default=0, help_text="Sequence number of the last entry of the queue applied to the chat.")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['queue_id', 'chat_history'], name='unique_chat_write_behind_marker'),
+        ]
 
 
 class KnowledgeRepository(models.Model):
@@ -46,6 +138,7 @@ class KnowledgeRepository(models.Model):
         AZURE_BLOB = 1, "Azure Blob"
         AMAZON_S3 = 2, "Amazon S3"
         GOOGLE_DRIVE = 3, "Google Drive"
+        LOCAL_FILESYSTEM = 4, "Local Filesystem"
     
     class Type(models.IntegerChoices):
         COURSE = 1, "Course"
@@ -54,6 +147,7 @@ class KnowledgeRepository(models.Model):
     source_type = models.IntegerField(choices=SourceType.choices) 
     index_path = models.CharField(max_length=255, blank=True) 
     sas_token = models.CharField(max_length=255, blank=True) 
+    course_id = models.IntegerField(null=True, blank=True, db_index=True)
     
 
 
@@ -63,4 +157,109 @@ class ContentReference(models.Model):
         YOUTUBE_VIDEO = 2, "YouTube Video"    
     content_type = models.IntegerField(choices=ContentType.choices)    
     path = models.CharField(max_length=255)  
+    course_id = models.IntegerField(null=True, blank=True, help_text="Defaults to the course of the knowledge repository.")
     knowledge_repository_id = models.ForeignKey('KnowledgeRepository', on_delete=models.CASCADE, to_field='id')
+
+
+class EmbeddingCacheEntry(models.Model):
+    created_at = models.DateTimeField(auto_now_add=True)
+    embedding_config_name = models.CharField(max_length=100)
+    content_hash = models.CharField(max_length=64, help_text="sha256 of the embedded text.")
+    embedding = models.BinaryField(help_text="float32 little endian vector.")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['embedding_config_name', 'content_hash'],
+                                    name='unique_embedding_cache_entry'),
+        ]
+
+
+class PromptUsageRollup(models.Model):
+    """Usage of a prompt template with an LLM config during one hour, updated with every user msg so that dashboards
+    read these rows instead of chat histories. Response latency is kept as a histogram: latency_le_<n>ms counts
+    responses slower than the previous bound and at most n ms."""
+    # Upper bounds of the latency histogram buckets, in ms. Slower responses go to latency_gt_64000ms.
+    LATENCY_BUCKET_BOUNDS_MS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+    LATENCY_BUCKET_FIELDS = tuple(f"latency_le_{bound}ms" for bound in LATENCY_BUCKET_BOUNDS_MS) + ("latency_gt_64000ms",)
+    CASCADE_FIELDS = ("cascade_accepted_count", "cascade_accepted_latency_ms", "cascade_escalated_count",
+                      "cascade_escalated_fast_latency_ms", "cascade_escalated_strong_latency_ms")
+
+    prompt_template_name = models.CharField(max_length=100)
+    llm_config_name = models.CharField(max_length=100)
+    hour = models.DateTimeField(help_text="Start of the hour bucket.")
+    message_count = models.IntegerField(default=0)
+    tool_call_count = models.IntegerField(default=0)
+    prompt_tokens = models.BigIntegerField(default=0)
+    completion_tokens = models.BigIntegerField(default=0)
+    total_latency_ms = models.BigIntegerField(default=0)
+    latency_le_100ms = models.IntegerField(default=0)
+    latency_le_250ms = models.IntegerField(default=0)
+    latency_le_500ms = models.IntegerField(default=0)
+    latency_le_1000ms = models.IntegerField(default=0)
+    latency_le_2000ms = models.IntegerField(default=0)
+    latency_le_4000ms = models.IntegerField(default=0)
+    latency_le_8000ms = models.IntegerField(default=0)
+    latency_le_16000ms = models.IntegerField(default=0)
+    latency_le_32000ms = models.IntegerField(default=0)
+    latency_le_64000ms = models.IntegerField(default=0)
+    latency_gt_64000ms = models.IntegerField(default=0)
+    # Completions of cascade templates: answers of the fast config kept, and escalations to the strong one with the
+    # time spent on the rejected fast answer and on the strong one.
+    cascade_accepted_count = models.IntegerField(default=0)
+    cascade_accepted_latency_ms = models.BigIntegerField(default=0)
+    cascade_escalated_count = models.IntegerField(default=0)
+    cascade_escalated_fast_latency_ms = models.BigIntegerField(default=0)
+    cascade_escalated_strong_latency_ms = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['prompt_template_name', 'llm_config_name', 'hour'],
+                                    name='unique_prompt_usage_rollup'),
+        ]
+        indexes = [
+            models.Index(fields=['hour']),
+        ]
+
+
+class LLMRequestLock(models.Model):
+    """Lock of an LLM request in flight, for coalescing identical requests across workers (LLM_SINGLE_FLIGHT set to
+    "database"). The worker that created the row makes the call and stores its response, which other workers with the
+    same request poll for."""
+    fingerprint = models.CharField(max_length=64, unique=True, help_text="sha256 of the msgs and LLM params.")
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True, help_text="While response is empty, the call is presumed lost "
+                                                               "after this. Afterwards, the row can be deleted.")
+    response = models.JSONField(null=True, blank=True)
+
+
+class ChatTurnJob(models.Model):
+    """Chat turn or assistant run submitted to the DB backed job queue, for work that can outlast an HTTP request.
+    Processed by the run_chat_turn_workers command; see OpenAIService.job_queue."""
+    class Kind(models.IntegerChoices):
+        CHAT_TURN = 1, "Chat turn"
+        ASSISTANT_FILE = 2, "Assistant response using file"
+
+    class Status(models.IntegerChoices):
+        QUEUED = 1, "Queued"
+        RUNNING = 2, "Running"
+        SUCCEEDED = 3, "Succeeded"
+        FAILED = 4, "Failed"
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    idempotency_key = models.CharField(max_length=200, unique=True, null=True, blank=True, help_text="Given by the caller, so that a retried submission returns the existing job instead of running the turn again.")
+    kind = models.IntegerField(choices=Kind.choices)
+    payload = models.JSONField(default=dict)
+    status = models.IntegerField(choices=Status.choices, default=Status.QUEUED)
+    visible_at = models.DateTimeField(help_text="A queued job is claimed after this. A running job whose worker did not extend it by then is claimed again.")
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    locked_by = models.CharField(max_length=100, blank=True, help_text="Worker running the job.")
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'visible_at']),
+        ]
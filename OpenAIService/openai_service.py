@@ -1,19 +1,40 @@
-from openai import AzureOpenAI
+from __future__ import annotations
+
+import json
 import time
-from speechai.settings import AZURE_OPENAI_API_KEY,AZURE_OPENAI_API_VERSION,AZURE_OPENAI_AZURE_ENDPOINT
-from openai.types.beta.assistant import Assistant
-from openai.types.beta.thread import Thread
-from openai.types import FileObject
-from openai.types.beta.threads.run import Run
 import logging
-import litellm
+import threading
+import typing
+
+# openai and litellm take seconds to import, so they are only imported on first use instead of by every process that
+# loads the app.
+if typing.TYPE_CHECKING:
+    from openai.types.beta.assistant import Assistant
+    from openai.types.beta.thread import Thread
+    from openai.types import FileObject
+    from openai.types.beta.threads.run import Run
 
 class OpenAIService:
+    _client = None
+    _client_lock = threading.Lock()
+
     def __init__(self):
-        self.client = AzureOpenAI(api_key=AZURE_OPENAI_API_KEY,api_version=AZURE_OPENAI_API_VERSION,azure_endpoint=AZURE_OPENAI_AZURE_ENDPOINT)
+        self.client = self.get_client()
         self.assistant_id: str = None
         self.logger = logging.getLogger(__name__)
 
+    @classmethod
+    def get_client(cls):
+        """Process wide Azure OpenAI client, so that its HTTP connections are kept alive and shared by all instances
+        and threads instead of being opened again per call."""
+        if cls._client is None:
+            with cls._client_lock:
+                if cls._client is None:
+                    from openai import AzureOpenAI
+                    from speechai.settings import AZURE_OPENAI_API_KEY,AZURE_OPENAI_API_VERSION,AZURE_OPENAI_AZURE_ENDPOINT
+                    cls._client = AzureOpenAI(api_key=AZURE_OPENAI_API_KEY,api_version=AZURE_OPENAI_API_VERSION,azure_endpoint=AZURE_OPENAI_AZURE_ENDPOINT)
+        return cls._client
+
     def get_assistant(self, id: str) -> Assistant:
         """
         Retrieve an assistant by its ID.
@@ -119,6 +140,39 @@ class OpenAIService:
             self.logger.error(f"An error occurred while running the assistant: {e}")
             return None
 
+    def create_thread_and_run(self, assistant_id: str, prompt: str) -> Run:
+        """
+        Create a thread with the prompt as its first message and run the assistant on it in a single request, then
+        wait for the run to finish.
+        """
+        try:
+            if assistant_id is None:
+                raise ValueError("Assistant ID is not set.")
+
+            run = self.client.beta.threads.create_and_run(
+                assistant_id=assistant_id,
+                thread={"messages": [{"role": "user", "content": prompt}]},
+            )
+            run = self.client.beta.threads.runs.poll(run.id, run.thread_id)
+            if run.status != "completed":
+                self.logger.error(f"Run {run.id} {run.status}: {run.last_error}")
+            return run
+        except Exception as e:
+            self.logger.error(f"An error occurred while running the assistant: {e}")
+            return None
+
+    def list_run_messages(self, thread_id: str, run_id: str) -> str:
+        """
+        Concatenate the assistant messages created by the given run.
+        """
+        try:
+            messages = self.client.beta.threads.messages.list(thread_id=thread_id, run_id=run_id, order="asc",
+                                                          limit=100)
+            return "".join(message.content[0].text.value for message in messages.data if message.role == "assistant")
+        except Exception as e:
+            self.logger.error(f"An error occurred while listing the messages: {e}")
+            return None
+
     def list_messages(self, thread_id: str) -> str:
         """
         List all messages in the given thread.
@@ -135,9 +189,91 @@ class OpenAIService:
             return None
         
     @staticmethod
-    def send_messages_and_get_response(messages: list, llm_config_params: dict):
-        response = litellm.completion(
-           **llm_config_params,
+    def dump_completion(response) -> dict:
+        if hasattr(response, "model_dump"):
+            response = response.model_dump()
+        return json.loads(json.dumps(response, default=str))
+
+    @staticmethod
+    def load_completion(data: dict):
+        import litellm
+        return litellm.ModelResponse(**data)
+
+    @staticmethod
+    def get_completion(messages: list, llm_config_params: dict):
+        """Full completion response, including usage. Concurrent identical requests share one call, see
+        LLM_SINGLE_FLIGHT."""
+        import litellm
+        from OpenAIService.single_flight import get_request_fingerprint, run_single_flight
+        return run_single_flight(
+            get_request_fingerprint(messages, llm_config_params),
+            lambda: litellm.completion(
+                **llm_config_params,
+                messages=messages,
+            ),
+            dump=OpenAIService.dump_completion, load=OpenAIService.load_completion,
+        )
+
+    @staticmethod
+    async def get_completion_async(messages: list, llm_config_params: dict):
+        import litellm
+        from OpenAIService.single_flight import get_request_fingerprint, run_single_flight_async
+        return await run_single_flight_async(
+            get_request_fingerprint(messages, llm_config_params),
+            lambda: litellm.acompletion(
+                **llm_config_params,
+                messages=messages,
+            ),
+            dump=OpenAIService.dump_completion, load=OpenAIService.load_completion,
+        )
+
+    @staticmethod
+    def stream_completion(messages: list, llm_config_params: dict):
+        """Iterator over the chunks of a streamed completion. Not coalesced like get_completion, since each caller
+        consumes its own stream."""
+        import litellm
+        return litellm.completion(
+            **llm_config_params,
             messages=messages,
+            stream=True,
         )
+
+    @staticmethod
+    def get_streamed_token_usage(chunks: list, messages: list) -> tuple:
+        """(prompt_tokens, completion_tokens) of a streamed completion, counted by litellm where the provider did not
+        report them. (0, 0) if they cannot be worked out."""
+        import litellm
+        try:
+            return OpenAIService.get_token_usage(litellm.stream_chunk_builder(chunks, messages=messages))
+        except Exception as exc:
+            logging.getLogger(__name__).error(f"Failed to count the tokens of a streamed completion: {exc}")
+            return 0, 0
+
+    @staticmethod
+    def send_messages_and_get_response(messages: list, llm_config_params: dict):
+        response = OpenAIService.get_completion(messages, llm_config_params)
+        return response["choices"][0]
+
+    @staticmethod
+    async def send_messages_and_get_response_async(messages: list, llm_config_params: dict):
+        response = await OpenAIService.get_completion_async(messages, llm_config_params)
         return response["choices"][0]
+
+    @staticmethod
+    def get_token_usage(response) -> tuple:
+        """(prompt_tokens, completion_tokens) of a completion response, 0 when the provider did not report them."""
+        usage = response.get("usage") if isinstance(response, dict) else getattr(response, "usage", None)
+        if usage is None:
+            return 0, 0
+        if isinstance(usage, dict):
+            return usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0
+        return getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0
+
+    @staticmethod
+    def get_embeddings(texts: list, llm_config_params: dict) -> list:
+        import litellm
+        response = litellm.embedding(
+            **llm_config_params,
+            input=texts,
+        )
+        return [item["embedding"] for item in response["data"]]
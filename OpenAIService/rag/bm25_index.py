@@ -0,0 +1,153 @@
+import array
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+HEADER_FILE = "bm25.json"
+VOCAB_FILE = "bm25_vocab.json"
+OFFSETS_FILE = "bm25_offsets.i64"
+DOCS_FILE = "bm25_docs.i32"
+TERM_FREQUENCIES_FILE = "bm25_tfs.u16"
+DOC_LENGTHS_FILE = "bm25_doc_lengths.i32"
+
+_WORD_RE = re.compile(r"[A-Za-z0-9_]+")
+_CAMEL_CASE_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+
+def tokenize(text: str) -> list:
+    """Lower cased word tokens. Identifiers like binary_search, binarySearch or IndexError are kept whole, so exact
+    matches rank first, and are also split into their parts so that "binary search" still matches them."""
+    tokens = []
+    for word in _WORD_RE.findall(text):
+        lower_word = word.lower()
+        tokens.append(lower_word)
+        parts = [part.lower() for piece in word.split("_") for part in _CAMEL_CASE_RE.findall(piece)]
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class BM25IndexWriter:
+    """Builds an inverted index stored as CSR style postings arrays in a generation directory:
+        bm25.json              - header with document count, average document length, k1 and b
+        bm25_vocab.json        - term to term id
+        bm25_offsets.i64       - postings of term t are [offsets[t], offsets[t + 1])
+        bm25_docs.i32          - row ids, sorted per term
+        bm25_tfs.u16           - term frequency of the term in each posting
+        bm25_doc_lengths.i32   - token count per row
+    Documents are rows of the vector index in the same directory, added in the same order."""
+
+    def __init__(self, generation_path: str, k1: float = 1.2, b: float = 0.75):
+        self.generation_path = generation_path
+        self.k1 = k1
+        self.b = b
+        self.vocab = {}
+        self.count = 0
+        self._term_ids = array.array("i")
+        self._doc_ids = array.array("i")
+        self._term_frequencies = array.array("H")
+        self._doc_lengths = array.array("i")
+
+    def add(self, texts: list) -> None:
+        for text in texts:
+            tokens = tokenize(text)
+            for term, term_frequency in Counter(tokens).items():
+                term_id = self.vocab.setdefault(term, len(self.vocab))
+                self._term_ids.append(term_id)
+                self._doc_ids.append(self.count)
+                self._term_frequencies.append(min(term_frequency, 65535))
+            self._doc_lengths.append(len(tokens))
+            self.count += 1
+
+    def start_from(self, index: "BM25Index", row_mask: np.ndarray | None = None) -> None:
+        """Starts from the rows of index, with its postings copied instead of tokenizing the texts again. Rows where
+        row_mask is False are kept empty, so row ids stay aligned. Call before add."""
+        if self.count:
+            raise ValueError("start_from must be called on an empty writer")
+        term_ids = np.repeat(np.arange(len(index.vocab), dtype=np.int32), np.diff(index.offsets))
+        docs = np.asarray(index.docs, dtype=np.int32)
+        term_frequencies = np.asarray(index.term_frequencies, dtype=np.uint16)
+        doc_lengths = np.asarray(index.doc_lengths, dtype=np.int32)
+        if row_mask is not None:
+            keep = row_mask[docs]
+            term_ids, docs, term_frequencies = term_ids[keep], docs[keep], term_frequencies[keep]
+            doc_lengths = np.where(row_mask, doc_lengths, 0).astype(np.int32)
+        self.vocab = dict(index.vocab)
+        self._term_ids.frombytes(term_ids.tobytes())
+        self._doc_ids.frombytes(docs.tobytes())
+        self._term_frequencies.frombytes(term_frequencies.tobytes())
+        self._doc_lengths.frombytes(doc_lengths.tobytes())
+        self.count = index.count
+
+    def close(self) -> None:
+        term_ids = np.frombuffer(self._term_ids, dtype=np.int32)
+        # Stable sort keeps postings of a term in row order.
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.zeros(len(self.vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(self.vocab)), out=offsets[1:])
+        np.frombuffer(self._doc_ids, dtype=np.int32)[order].tofile(os.path.join(self.generation_path, DOCS_FILE))
+        np.frombuffer(self._term_frequencies, dtype=np.uint16)[order].tofile(
+            os.path.join(self.generation_path, TERM_FREQUENCIES_FILE))
+        offsets.tofile(os.path.join(self.generation_path, OFFSETS_FILE))
+        doc_lengths = np.frombuffer(self._doc_lengths, dtype=np.int32)
+        doc_lengths.tofile(os.path.join(self.generation_path, DOC_LENGTHS_FILE))
+        with open(os.path.join(self.generation_path, VOCAB_FILE), "w", encoding="utf-8") as file:
+            json.dump(self.vocab, file, ensure_ascii=False)
+        with open(os.path.join(self.generation_path, HEADER_FILE), "w") as file:
+            json.dump({"count": self.count, "avg_doc_length": float(doc_lengths.mean()) if self.count else 0.0,
+                       "k1": self.k1, "b": self.b}, file)
+
+
+def _load_array(path: str, dtype) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class BM25Index:
+    def __init__(self, generation_path: str):
+        with open(os.path.join(generation_path, HEADER_FILE)) as file:
+            header = json.load(file)
+        with open(os.path.join(generation_path, VOCAB_FILE), encoding="utf-8") as file:
+            self.vocab = json.load(file)
+        self.count = header["count"]
+        self.avg_doc_length = header["avg_doc_length"] or 1.0
+        self.k1 = header["k1"]
+        self.b = header["b"]
+        self.offsets = _load_array(os.path.join(generation_path, OFFSETS_FILE), np.int64)
+        self.docs = _load_array(os.path.join(generation_path, DOCS_FILE), np.int32)
+        self.term_frequencies = _load_array(os.path.join(generation_path, TERM_FREQUENCIES_FILE), np.uint16)
+        self.doc_lengths = _load_array(os.path.join(generation_path, DOC_LENGTHS_FILE), np.int32)
+
+    def search(self, query: str, k: int = 10, row_mask: np.ndarray | None = None) -> tuple:
+        """Returns (scores, row_ids) of the k best matching rows, sorted by descending score. Rows matching none of
+        the query terms are never returned, so fewer than k rows can come back."""
+        term_ids = {self.vocab[term] for term in tokenize(query) if term in self.vocab}
+        matched_docs = []
+        contributions = []
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.docs[start:end]
+            term_frequencies = self.term_frequencies[start:end].astype(np.float32)
+            document_frequency = end - start
+            idf = math.log(1 + (self.count - document_frequency + 0.5) / (document_frequency + 0.5))
+            length_norm = 1 - self.b + self.b * self.doc_lengths[docs] / self.avg_doc_length
+            matched_docs.append(docs)
+            contributions.append(idf * term_frequencies * (self.k1 + 1) / (term_frequencies + self.k1 * length_norm))
+        if not matched_docs:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        # Only rows containing at least one query term are scored, instead of a dense array over all rows.
+        row_ids, inverse = np.unique(np.concatenate(matched_docs), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(contributions)).astype(np.float32)
+        if row_mask is not None:
+            keep = row_mask[row_ids]
+            row_ids, scores = row_ids[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            row_ids, scores = row_ids[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return scores[order], row_ids[order].astype(np.int64)
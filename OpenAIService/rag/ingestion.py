@@ -0,0 +1,209 @@
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from OpenAIService.embedding_service import EmbeddingService
+from OpenAIService.models import KnowledgeRepository, ContentReference
+from OpenAIService.rag.parsers import parse_and_chunk, get_file_hash
+from OpenAIService.rag.sources import get_knowledge_source
+from OpenAIService.rag.vector_index import VectorIndex, VectorIndexWriter, compact_index, index_write_lock
+
+logger = logging.getLogger(__name__)
+
+SOURCE_STATE_FIELDS = ("path", "size", "mtime", "etag")
+
+
+class IngestionPipeline:
+    """Builds the index of a KnowledgeRepository at its index_path.
+
+    Documents are parsed and chunked in a process pool, since PDF text extraction is CPU bound, while chunks are
+    embedded in batches in the parent process as parsed documents come back.
+
+    The index keeps a manifest entry per content reference (source path, size, mtime/etag, content hash, course and
+    row range), which reindex() uses to only re-parse and re-embed new or changed references."""
+
+    def __init__(self, knowledge_repository: KnowledgeRepository, *, embedder, embedding_model: str,
+                 chunk_size: int = 1000, chunk_overlap: int = 200, embed_batch_size: int = 64,
+                 max_workers: int | None = None, index_dtype: str = "float32",
+                 compaction_threshold: float | None = None):
+        if not knowledge_repository.index_path:
+            raise ValueError(f"index_path is not set for knowledge repository {knowledge_repository.id}")
+        self.knowledge_repository = knowledge_repository
+        self.index_path = knowledge_repository.index_path
+        self.source = get_knowledge_source(knowledge_repository)
+        self.embedder = embedder
+        self.embedding_model = embedding_model
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.embed_batch_size = embed_batch_size
+        self.max_workers = max_workers
+        self.index_dtype = index_dtype
+        self.compaction_threshold = compaction_threshold if compaction_threshold is not None else \
+            getattr(settings, "KNOWLEDGE_INDEX_COMPACTION_THRESHOLD", 0.2)
+        self.compaction_thread = None
+
+    @classmethod
+    def for_embedding_config(cls, knowledge_repository: KnowledgeRepository, embedding_config_name: str, **kwargs):
+        embedding_service = EmbeddingService.get(embedding_config_name)
+        return cls(knowledge_repository, embedder=embedding_service.embed, embedding_model=embedding_config_name,
+                   **kwargs)
+
+    def get_content_references(self):
+        return ContentReference.objects.filter(knowledge_repository_id=self.knowledge_repository).order_by('id')
+
+    def _get_course_id(self, content_reference: ContentReference) -> int | None:
+        if content_reference.course_id is not None:
+            return content_reference.course_id
+        return self.knowledge_repository.course_id
+
+    def _get_parse_task(self, content_reference: ContentReference, path: str) -> tuple:
+        return (content_reference.id, path, int(content_reference.content_type), self.chunk_size,
+                self.chunk_overlap)
+
+    def _iter_parsed(self, tasks: list):
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from executor.map(parse_and_chunk, tasks, chunksize=4)
+
+    def _embed_and_write(self, writer: VectorIndexWriter, pending: list) -> None:
+        for batch_start in range(0, len(pending), self.embed_batch_size):
+            batch = pending[batch_start:batch_start + self.embed_batch_size]
+            writer.add(self.embedder([chunk["text"] for chunk in batch]), batch)
+
+    def _index_documents(self, writer: VectorIndexWriter, tasks: list, manifest_entries: dict, stats: dict) -> None:
+        """Parses, embeds and appends the documents of tasks. manifest_entries holds the source state and course of
+        each content reference id, completed here with the content hash and row range."""
+        pending = []
+        for content_reference_id, chunks, content_hash, error in self._iter_parsed(tasks):
+            if error:
+                logger.error(f"Failed to parse content reference {content_reference_id}: {error}")
+                stats["failed_documents"] += 1
+                continue
+            stats["documents"] += 1
+            manifest_key = str(content_reference_id)
+            previous_entry = writer.manifest.get(manifest_key)
+            if previous_entry is not None:
+                # Old rows are only dropped once the new version parsed fine.
+                writer.tombstone(previous_entry["row_start"], previous_entry["row_end"])
+            entry = manifest_entries[content_reference_id]
+            row_start = writer.count + len(pending)
+            writer.manifest[manifest_key] = {**entry, "content_hash": content_hash, "row_start": row_start,
+                                             "row_end": row_start + len(chunks)}
+            pending.extend({"content_reference_id": content_reference_id, "course_id": entry["course_id"],
+                            "start": start, "end": end, "text": text} for start, end, text in chunks)
+            if len(pending) >= self.embed_batch_size:
+                full_batches_length = len(pending) - len(pending) % self.embed_batch_size
+                self._embed_and_write(writer, pending[:full_batches_length])
+                pending = pending[full_batches_length:]
+                stats["chunks"] += full_batches_length
+        self._embed_and_write(writer, pending)
+        stats["chunks"] += len(pending)
+
+    def _build(self, stats: dict) -> VectorIndexWriter:
+        tasks = []
+        manifest_entries = {}
+        for content_reference in self.get_content_references():
+            try:
+                path = self.source.fetch(content_reference)
+                source_state = self.source.stat(content_reference)
+            except Exception as exc:
+                logger.error(f"Skipping content reference {content_reference.id}: {exc}")
+                stats["failed_documents"] += 1
+                continue
+            tasks.append(self._get_parse_task(content_reference, path))
+            manifest_entries[content_reference.id] = {**source_state,
+                                                      "course_id": self._get_course_id(content_reference)}
+        writer = VectorIndexWriter(self.index_path, embedding_model=self.embedding_model, dtype=self.index_dtype)
+        self._index_documents(writer, tasks, manifest_entries, stats)
+        writer.close()
+        return writer
+
+    @staticmethod
+    def _get_empty_stats() -> dict:
+        return {"documents": 0, "failed_documents": 0, "unchanged_documents": 0, "deleted_documents": 0,
+                "chunks": 0, "rows": 0, "tombstones": 0, "compaction_started": False}
+
+    def _finish(self, stats: dict, rows: int, tombstones: int) -> dict:
+        stats["rows"] = rows
+        stats["tombstones"] = tombstones
+        logger.info(f"Indexed knowledge repository {self.knowledge_repository.id} at {self.index_path}: {stats}")
+        return stats
+
+    def run(self) -> dict:
+        """Rebuilds the whole index."""
+        stats = self._get_empty_stats()
+        with index_write_lock(self.index_path):
+            writer = self._build(stats)
+        return self._finish(stats, writer.count, writer.tombstone_count)
+
+    def reindex(self) -> dict:
+        """Re-parses and re-embeds only new or changed content references, tombstones the rows of deleted or
+        replaced ones, and starts a background compaction once tombstones exceed compaction_threshold of the rows.
+        Falls back to a full build when there is no index yet or it was built with another embedding model."""
+        stats = self._get_empty_stats()
+        with index_write_lock(self.index_path):
+            try:
+                base = VectorIndex.open(self.index_path)
+            except FileNotFoundError:
+                base = None
+            if base is None or base.embedding_model != self.embedding_model:
+                writer = self._build(stats)
+                return self._finish(stats, writer.count, writer.tombstone_count)
+
+            tasks = []
+            manifest_entries = {}
+            refreshed_entries = {}
+            current_keys = set()
+            for content_reference in self.get_content_references():
+                manifest_key = str(content_reference.id)
+                # Added first, so that a reference failing to be read, e.g. on a transient storage error, keeps its
+                # rows instead of being taken as deleted.
+                current_keys.add(manifest_key)
+                course_id = self._get_course_id(content_reference)
+                entry = base.manifest.get(manifest_key)
+                try:
+                    source_state = self.source.stat(content_reference)
+                    path = None
+                    if entry is not None and entry["course_id"] == course_id:
+                        if all(entry[field] == source_state[field] for field in SOURCE_STATE_FIELDS):
+                            stats["unchanged_documents"] += 1
+                            continue
+                        path = self.source.fetch(content_reference)
+                        if get_file_hash(path) == entry["content_hash"]:
+                            # Touched but not modified, only the change markers need updating.
+                            refreshed_entries[manifest_key] = {**entry, **source_state}
+                            stats["unchanged_documents"] += 1
+                            continue
+                    path = path or self.source.fetch(content_reference)
+                except Exception as exc:
+                    logger.error(f"Skipping content reference {content_reference.id}: {exc}")
+                    stats["failed_documents"] += 1
+                    continue
+                tasks.append(self._get_parse_task(content_reference, path))
+                manifest_entries[content_reference.id] = {**source_state, "course_id": course_id}
+            deleted_keys = [manifest_key for manifest_key in base.manifest if manifest_key not in current_keys]
+
+            if not tasks and not deleted_keys and not refreshed_entries:
+                return self._finish(stats, base.count, base.tombstone_count)
+            writer = VectorIndexWriter(self.index_path, embedding_model=self.embedding_model, base=base)
+            for manifest_key in deleted_keys:
+                entry = writer.manifest.pop(manifest_key)
+                writer.tombstone(entry["row_start"], entry["row_end"])
+                stats["deleted_documents"] += 1
+            writer.manifest.update(refreshed_entries)
+            self._index_documents(writer, tasks, manifest_entries, stats)
+            writer.close()
+
+        if writer.count and writer.tombstone_count > self.compaction_threshold * writer.count:
+            self.compaction_thread = threading.Thread(target=self._compact, name=f"compact-{self.index_path}")
+            self.compaction_thread.start()
+            stats["compaction_started"] = True
+        return self._finish(stats, writer.count, writer.tombstone_count)
+
+    def _compact(self) -> None:
+        try:
+            result = compact_index(self.index_path)
+            logger.info(f"Compacted index {self.index_path}: {result}")
+        except Exception as exc:
+            logger.error(f"Compaction of index {self.index_path} failed: {exc}")
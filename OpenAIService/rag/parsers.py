@@ -0,0 +1,84 @@
+import hashlib
+import re
+
+# Same values as ContentReference.ContentType. Kept here so that parsing in pool workers does not need Django models.
+PDF_CONTENT_TYPE = 1
+YOUTUBE_VIDEO_CONTENT_TYPE = 2
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_SUBTITLE_TIMESTAMP_RE = re.compile(r"-->")
+
+
+def extract_pdf_text(path: str) -> str:
+    # pypdf is only needed by ingestion workers, not by the request path.
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def extract_transcript_text(path: str) -> str:
+    """Reads a plain text, .srt or .vtt transcript, dropping cue numbers and timestamps."""
+    with open(path, "r", encoding="utf-8", errors="replace") as file:
+        lines = file.read().splitlines()
+    if not path.lower().endswith((".srt", ".vtt")):
+        return "\n".join(lines)
+    text_lines = []
+    for line in lines:
+        stripped = line.strip()
+        if not stripped or stripped == "WEBVTT" or stripped.isdigit() or _SUBTITLE_TIMESTAMP_RE.search(stripped):
+            continue
+        text_lines.append(stripped)
+    return "\n".join(text_lines)
+
+
+def extract_text(path: str, content_type: int) -> str:
+    if content_type == PDF_CONTENT_TYPE:
+        text = extract_pdf_text(path)
+    elif content_type == YOUTUBE_VIDEO_CONTENT_TYPE:
+        text = extract_transcript_text(path)
+    else:
+        raise ValueError(f"Unsupported content type: {content_type}")
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def chunk_text(text: str, chunk_size: int, chunk_overlap: int) -> list:
+    """Splits text into (start, end, chunk) tuples of at most chunk_size characters, consecutive chunks sharing
+    chunk_overlap characters. Chunk ends are moved back to the last space when one is available in the second half
+    of the chunk, so that words are not cut."""
+    if chunk_overlap >= chunk_size:
+        raise ValueError(f"chunk_overlap ({chunk_overlap}) must be smaller than chunk_size ({chunk_size})")
+    chunks = []
+    start = 0
+    text_length = len(text)
+    while start < text_length:
+        end = min(start + chunk_size, text_length)
+        if end < text_length:
+            split_at = text.rfind(" ", start + chunk_size // 2, end)
+            if split_at != -1:
+                end = split_at
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append((start, end, chunk))
+        if end >= text_length:
+            break
+        start = max(end - chunk_overlap, start + 1)
+    return chunks
+
+
+def get_file_hash(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def parse_and_chunk(task: tuple) -> tuple:
+    """Process pool entry point. Returns (content_reference_id, chunks, content_hash, error)."""
+    content_reference_id, path, content_type, chunk_size, chunk_overlap = task
+    try:
+        content_hash = get_file_hash(path)
+        chunks = chunk_text(extract_text(path, content_type), chunk_size, chunk_overlap)
+        return content_reference_id, chunks, content_hash, None
+    except Exception as exc:
+        return content_reference_id, [], None, f"{type(exc).__name__}: {exc}"
@@ -0,0 +1,173 @@
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+
+from OpenAIService.embedding_service import EmbeddingService
+from OpenAIService.llm_classes.EmbeddingConfig import GLOBAL_LOADED_EMBEDDING_CONFIGS
+from OpenAIService.models import KnowledgeRepository
+from OpenAIService.rag.bm25_index import BM25Index
+from OpenAIService.rag.vector_index import VectorIndex, read_current_generation
+
+logger = logging.getLogger(__name__)
+
+RRF_K = 60
+# Rough token estimate for budgeting tool output without loading a tokenizer.
+CHARS_PER_TOKEN = 4
+MIN_SNIPPET_TOKENS = 32
+
+
+class KnowledgeIndex:
+    """Dense and lexical index of one generation of a knowledge repository index, searched together."""
+
+    def __init__(self, generation_path: str):
+        self.generation_path = generation_path
+        self.vector_index = VectorIndex(generation_path)
+        self.bm25_index = BM25Index(generation_path)
+        self.embedding_model = self.vector_index.embedding_model
+        self._course_masks = {}
+
+    @classmethod
+    def open(cls, index_path: str) -> "KnowledgeIndex":
+        generation_name = read_current_generation(index_path)
+        if generation_name is None:
+            raise FileNotFoundError(f"No knowledge index found at {index_path}")
+        return cls(os.path.join(index_path, generation_name))
+
+    def get_row_mask(self, course_id: int | None) -> np.ndarray | None:
+        """Rows that may be returned: live (not tombstoned) rows, of course_id if given. None if all rows may be."""
+        if course_id not in self._course_masks:
+            row_mask = self.vector_index.live_mask
+            if course_id is not None:
+                course_mask = np.asarray(self.vector_index.rows["course_id"] == course_id)
+                row_mask = course_mask if row_mask is None else course_mask & row_mask
+            self._course_masks[course_id] = row_mask
+        return self._course_masks[course_id]
+
+    def hybrid_search(self, query: str, query_embedding=None, *, k: int = 5, course_id: int | None = None,
+                      candidates: int = 50) -> list:
+        """Fuses the dense and BM25 rankings of query with reciprocal rank fusion.
+
+        :param query: query text, used for BM25
+        :param query_embedding: embedding of query from the index's embedding model, dense ranking is skipped if None
+        :param k: number of hits returned
+        :param course_id: only rows of this course are returned if given
+        :param candidates: depth of each ranking taken into the fusion
+        :return: list of row dicts (see VectorIndex.get_row) with score, dense_rank and lexical_rank, best first
+        """
+        row_mask = self.get_row_mask(course_id)
+        rankings = {}
+        _, lexical_row_ids = self.bm25_index.search(query, k=candidates, row_mask=row_mask)
+        rankings["lexical_rank"] = lexical_row_ids
+        if query_embedding is not None:
+            _, dense_row_ids = self.vector_index.search(query_embedding, k=candidates, row_mask=row_mask)
+            rankings["dense_rank"] = dense_row_ids[0]
+
+        fused = {}
+        for ranking_name, row_ids in rankings.items():
+            for rank, row_id in enumerate(row_ids.tolist()):
+                hit = fused.setdefault(row_id, {"score": 0.0, "dense_rank": None, "lexical_rank": None})
+                hit["score"] += 1.0 / (RRF_K + rank + 1)
+                hit[ranking_name] = rank
+        best_row_ids = sorted(fused, key=lambda row_id: fused[row_id]["score"], reverse=True)[:k]
+        return [{**self.vector_index.get_row(row_id), **fused[row_id]} for row_id in best_row_ids]
+
+
+class KnowledgeIndexRegistry:
+    """Process wide cache of opened knowledge indexes, so that tool calls reuse memory mapped indexes instead of
+    opening them per call. CURRENT of each index is re-read at most every KNOWLEDGE_INDEX_RELOAD_INTERVAL seconds, and
+    a new generation written by a re-index is swapped in without affecting searches running on the old one."""
+
+    _indexes = {}
+    _checked_at = {}
+    _course_index_paths = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_reload_interval(cls) -> float:
+        return getattr(settings, "KNOWLEDGE_INDEX_RELOAD_INTERVAL", 5)
+
+    @classmethod
+    def get(cls, index_path: str) -> KnowledgeIndex:
+        cached = cls._indexes.get(index_path)
+        if cached is not None and time.monotonic() - cls._checked_at[index_path] < cls.get_reload_interval():
+            return cached[1]
+        generation_name = read_current_generation(index_path)
+        if generation_name is None:
+            raise FileNotFoundError(f"No knowledge index found at {index_path}")
+        with cls._lock:
+            cached = cls._indexes.get(index_path)
+            if cached is None or cached[0] != generation_name:
+                cached = (generation_name, KnowledgeIndex(os.path.join(index_path, generation_name)))
+                cls._indexes[index_path] = cached
+            cls._checked_at[index_path] = time.monotonic()
+        return cached[1]
+
+    @classmethod
+    def get_course_index_paths(cls, course_id: int) -> list:
+        cached = cls._course_index_paths.get(course_id)
+        if cached is not None and time.monotonic() - cached[0] < cls.get_reload_interval():
+            return cached[1]
+        index_paths = list(KnowledgeRepository.objects.filter(
+            Q(course_id=course_id) | Q(contentreference__course_id=course_id)
+        ).exclude(index_path="").values_list("index_path", flat=True).distinct())
+        cls._course_index_paths[course_id] = (time.monotonic(), index_paths)
+        return index_paths
+
+    @classmethod
+    def preload(cls) -> None:
+        """Opens every built index up front, e.g. from a gunicorn post_fork hook or when PRELOAD_KNOWLEDGE_INDEXES
+        is set, so the first tool call of a worker does not pay for it."""
+        for index_path in KnowledgeRepository.objects.exclude(index_path="").values_list("index_path", flat=True):
+            try:
+                cls.get(index_path)
+            except FileNotFoundError:
+                logger.warning(f"Knowledge index {index_path} is not built yet, not preloading it")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def format_snippets(hits: list, token_budget: int) -> str:
+    """Numbered snippets, best first, cut to fit token_budget."""
+    snippets = []
+    used_tokens = 0
+    for hit in hits:
+        remaining_tokens = token_budget - used_tokens
+        if remaining_tokens < MIN_SNIPPET_TOKENS:
+            break
+        text = hit["text"]
+        if estimate_tokens(text) > remaining_tokens:
+            text = text[:remaining_tokens * CHARS_PER_TOKEN].rsplit(" ", 1)[0] + " ..."
+        snippet = f"[{len(snippets) + 1}] {text}"
+        snippets.append(snippet)
+        used_tokens += estimate_tokens(snippet)
+    return "\n\n".join(snippets)
+
+
+def search_course_knowledge(query: str, course_id: int, *, k: int | None = None,
+                            token_budget: int | None = None) -> str:
+    """Hybrid search over every index holding content of course_id, formatted for an LLM tool response."""
+    k = k or getattr(settings, "KNOWLEDGE_TOOL_TOP_K", 5)
+    token_budget = token_budget or getattr(settings, "KNOWLEDGE_TOOL_TOKEN_BUDGET", 1500)
+    hits = []
+    for index_path in KnowledgeIndexRegistry.get_course_index_paths(course_id):
+        try:
+            index = KnowledgeIndexRegistry.get(index_path)
+        except FileNotFoundError:
+            logger.error(f"Knowledge index {index_path} of course {course_id} is not built")
+            continue
+        query_embedding = None
+        if index.embedding_model in GLOBAL_LOADED_EMBEDDING_CONFIGS:
+            query_embedding = EmbeddingService.get(index.embedding_model).embed_query(query)
+        else:
+            logger.error(f"Embedding config {index.embedding_model} of index {index_path} is not loaded, "
+                         f"using lexical search only")
+        hits.extend(index.hybrid_search(query, query_embedding, k=k, course_id=course_id))
+    hits.sort(key=lambda hit: hit["score"], reverse=True)
+    return format_snippets(hits[:k], token_budget) or "No relevant course content found."
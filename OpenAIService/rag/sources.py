@@ -0,0 +1,43 @@
+import abc
+import os
+
+from OpenAIService.models import KnowledgeRepository, ContentReference
+
+
+class KnowledgeSource:
+    """Gives the ingestion pipeline local access to the files behind ContentReferences of a KnowledgeRepository.
+    Cloud sources (Azure Blob, S3, Google Drive) are expected to download into a local cache in fetch()."""
+
+    def __init__(self, knowledge_repository: KnowledgeRepository):
+        self.knowledge_repository = knowledge_repository
+
+    @abc.abstractmethod
+    def fetch(self, content_reference: ContentReference) -> str:
+        """Returns a local filesystem path with the content of the reference."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stat(self, content_reference: ContentReference) -> dict:
+        """Returns cheap change markers of the reference (path, size, mtime, etag), without fetching its content.
+        Re-indexing only hashes and re-parses references whose markers changed."""
+        raise NotImplementedError
+
+
+class LocalFileSystemSource(KnowledgeSource):
+    def fetch(self, content_reference: ContentReference) -> str:
+        path = os.path.join(self.knowledge_repository.source_path, content_reference.path)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(f"Content reference {content_reference.id} points to missing file {path}")
+        return path
+
+    def stat(self, content_reference: ContentReference) -> dict:
+        stat_result = os.stat(self.fetch(content_reference))
+        return {"path": content_reference.path, "size": stat_result.st_size, "mtime": stat_result.st_mtime_ns,
+                "etag": None}
+
+
+def get_knowledge_source(knowledge_repository: KnowledgeRepository) -> KnowledgeSource:
+    if knowledge_repository.source_type == KnowledgeRepository.SourceType.LOCAL_FILESYSTEM:
+        return LocalFileSystemSource(knowledge_repository)
+    raise NotImplementedError(f"Ingestion is not supported yet for source type "
+                              f"{knowledge_repository.get_source_type_display()}")
@@ -0,0 +1,358 @@
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+
+import numpy as np
+
+from OpenAIService.rag.bm25_index import BM25Index, BM25IndexWriter
+
+FORMAT_VERSION = 2
+CURRENT_FILE = "CURRENT"
+HEADER_FILE = "index.json"
+VECTORS_FILE = "vectors.bin"
+SCALES_FILE = "scales.f32"
+ROWS_FILE = "rows.bin"
+TEXTS_FILE = "texts.bin"
+TOMBSTONES_FILE = "tombstones.u8"
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+APPEND_ONLY_FILES = (VECTORS_FILE, SCALES_FILE, ROWS_FILE, TEXTS_FILE)
+
+SUPPORTED_DTYPES = ("float32", "float16", "int8")
+
+# One fixed size record per index row, mapping it back to the chunk of the content reference it was embedded from.
+# course_id is -1 for rows without a course.
+ROW_DTYPE = np.dtype([
+    ("content_reference_id", "<i8"),
+    ("course_id", "<i8"),
+    ("start", "<i4"),
+    ("end", "<i4"),
+    ("text_offset", "<i8"),
+    ("text_length", "<i4"),
+])
+
+
+def get_generation_name(generation: int) -> str:
+    return f"gen-{generation:06d}"
+
+
+def read_current_generation(index_path: str) -> str | None:
+    try:
+        with open(os.path.join(index_path, CURRENT_FILE)) as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def write_current_generation(index_path: str, generation_name: str) -> None:
+    # os.replace is atomic, so readers see either the old or the new generation, never a partial write.
+    tmp_path = os.path.join(index_path, f"{CURRENT_FILE}.tmp")
+    with open(tmp_path, "w") as file:
+        file.write(generation_name)
+    os.replace(tmp_path, os.path.join(index_path, CURRENT_FILE))
+
+
+@contextlib.contextmanager
+def index_write_lock(index_path: str):
+    """Serializes builds, re-indexes and compactions of one index across processes."""
+    os.makedirs(index_path, exist_ok=True)
+    with open(os.path.join(index_path, LOCK_FILE), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def quantize_int8(matrix: np.ndarray) -> tuple:
+    """Symmetric per row quantization. Returns (int8 matrix, float32 scales) with row ~= int8_row * scale."""
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+    quantized = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+    return quantized, scales
+
+
+class VectorIndexWriter:
+    """Streams embedded chunks into a new generation directory of a vector index:
+        index_path/CURRENT                  - name of the generation readers should open
+        index_path/gen-NNNNNN/index.json    - header with embedding model, dimension, dtype and row count
+        index_path/gen-NNNNNN/vectors.bin   - row major matrix of L2 normalized embeddings (float32, float16 or int8)
+        index_path/gen-NNNNNN/scales.f32    - per row scales, only for int8
+        index_path/gen-NNNNNN/rows.bin      - ROW_DTYPE records, one per row
+        index_path/gen-NNNNNN/texts.bin     - utf-8 chunk texts, addressed by text_offset/text_length of rows.bin
+        index_path/gen-NNNNNN/bm25*         - lexical index over the same rows, see BM25IndexWriter
+        index_path/gen-NNNNNN/tombstones.u8 - 1 for rows replaced or deleted since they were written
+        index_path/gen-NNNNNN/manifest.json - per content reference source state and row range, for re-indexing
+    CURRENT is switched on close(), so readers never see a partially written generation.
+
+    With base, the new generation starts from the rows of base instead of being empty: the append only files are
+    hard linked and appended to, which leaves base readable since its readers never look past base.count rows."""
+
+    def __init__(self, index_path: str, *, embedding_model: str, dtype: str = "float32",
+                 base: "VectorIndex | None" = None):
+        if base is not None:
+            embedding_model, dtype = base.embedding_model, base.dtype
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported index dtype {dtype}. Supported: {SUPPORTED_DTYPES}")
+        self.index_path = index_path
+        self.embedding_model = embedding_model
+        self.dtype = dtype
+        self.dim = None
+        self.count = 0
+        self._text_offset = 0
+        self.manifest = {}
+        self._tombstones = np.zeros(0, dtype=np.uint8)
+        os.makedirs(index_path, exist_ok=True)
+        current_generation = read_current_generation(index_path)
+        self.previous_generation_name = current_generation
+        generation = int(current_generation.split("-")[1]) + 1 if current_generation else 1
+        self.generation_name = get_generation_name(generation)
+        self.generation_path = os.path.join(index_path, self.generation_name)
+        shutil.rmtree(self.generation_path, ignore_errors=True)
+        os.makedirs(self.generation_path)
+        self._bm25_writer = BM25IndexWriter(self.generation_path)
+        if base is not None:
+            self._start_from(base)
+        mode = "ab" if base is not None else "wb"
+        self._vectors_file = open(os.path.join(self.generation_path, VECTORS_FILE), mode)
+        self._scales_file = open(os.path.join(self.generation_path, SCALES_FILE), mode) if dtype == "int8" else None
+        self._rows_file = open(os.path.join(self.generation_path, ROWS_FILE), mode)
+        self._texts_file = open(os.path.join(self.generation_path, TEXTS_FILE), mode)
+
+    def _start_from(self, base: "VectorIndex") -> None:
+        self.dim = base.dim or None
+        self.count = base.count
+        self._text_offset = base.texts_size
+        self.manifest = dict(base.manifest)
+        self._tombstones = base.tombstones.copy()
+        expected_sizes = {VECTORS_FILE: base.vectors.nbytes, SCALES_FILE: 4 * base.count,
+                          ROWS_FILE: base.rows.nbytes, TEXTS_FILE: base.texts_size}
+        for filename in APPEND_ONLY_FILES:
+            base_file_path = os.path.join(base.generation_path, filename)
+            if not os.path.exists(base_file_path):
+                continue
+            file_path = os.path.join(self.generation_path, filename)
+            try:
+                os.link(base_file_path, file_path)
+            except OSError:
+                shutil.copyfile(base_file_path, file_path)
+            # Drops whatever an interrupted writer appended after the rows base knows about.
+            os.truncate(file_path, expected_sizes[filename])
+        # Tombstoned rows keep their position with no postings, so BM25 row ids stay aligned with the vectors.
+        self._bm25_writer.start_from(BM25Index(base.generation_path), row_mask=self._tombstones == 0)
+
+    def tombstone(self, row_start: int, row_end: int) -> None:
+        self._tombstones[row_start:min(row_end, self.count)] = 1
+
+    @property
+    def tombstone_count(self) -> int:
+        return int(self._tombstones[:self.count].sum())
+
+    def _reserve_tombstones(self, count: int) -> None:
+        # Grown geometrically, so that adding many small batches stays linear in the row count.
+        if count > len(self._tombstones):
+            tombstones = np.zeros(max(count, 2 * len(self._tombstones)), dtype=np.uint8)
+            tombstones[:self.count] = self._tombstones[:self.count]
+            self._tombstones = tombstones
+
+    def add(self, vectors, chunks: list, normalized: bool = False) -> None:
+        """chunks are dicts with content_reference_id, course_id, start, end and text, one per row of vectors."""
+        matrix = np.asarray(vectors, dtype=np.float32)
+        if matrix.ndim != 2 or matrix.shape[0] != len(chunks):
+            raise ValueError(f"Expected {len(chunks)} embeddings, got array of shape {matrix.shape}")
+        if self.dim is None:
+            self.dim = matrix.shape[1]
+        elif matrix.shape[1] != self.dim:
+            raise ValueError(f"Embedding dimension changed from {self.dim} to {matrix.shape[1]}")
+        if not normalized:
+            matrix = _normalize_rows(matrix)
+        if self.dtype == "int8":
+            self.add_stored(*quantize_int8(matrix), chunks)
+        else:
+            self.add_stored(matrix.astype(self.dtype), None, chunks)
+
+    def add_stored(self, stored_vectors: np.ndarray, scales: np.ndarray | None, chunks: list) -> None:
+        """Appends vectors already in the storage dtype of the index, e.g. copied from another generation."""
+        if self.dim is None:
+            self.dim = stored_vectors.shape[1]
+        self._vectors_file.write(np.ascontiguousarray(stored_vectors).tobytes())
+        if scales is not None:
+            self._scales_file.write(np.ascontiguousarray(scales, dtype=np.float32).tobytes())
+        rows = np.zeros(len(chunks), dtype=ROW_DTYPE)
+        encoded_texts = [chunk["text"].encode("utf-8") for chunk in chunks]
+        for i, (chunk, encoded_text) in enumerate(zip(chunks, encoded_texts)):
+            course_id = chunk.get("course_id")
+            rows[i] = (chunk["content_reference_id"], -1 if course_id is None else course_id, chunk["start"],
+                       chunk["end"], self._text_offset, len(encoded_text))
+            self._text_offset += len(encoded_text)
+        self._rows_file.write(rows.tobytes())
+        self._texts_file.write(b"".join(encoded_texts))
+        self._bm25_writer.add([chunk["text"] for chunk in chunks])
+        self._reserve_tombstones(self.count + len(chunks))
+        self.count += len(chunks)
+
+    def close(self) -> None:
+        for file in (self._vectors_file, self._scales_file, self._rows_file, self._texts_file):
+            if file is not None:
+                file.close()
+        self._bm25_writer.close()
+        self._tombstones[:self.count].tofile(os.path.join(self.generation_path, TOMBSTONES_FILE))
+        with open(os.path.join(self.generation_path, MANIFEST_FILE), "w") as file:
+            json.dump(self.manifest, file)
+        with open(os.path.join(self.generation_path, HEADER_FILE), "w") as file:
+            json.dump({"format_version": FORMAT_VERSION, "embedding_model": self.embedding_model, "dim": self.dim,
+                       "count": self.count, "dtype": self.dtype, "tombstone_count": self.tombstone_count}, file)
+        write_current_generation(self.index_path, self.generation_name)
+        self._remove_stale_generations()
+
+    def _remove_stale_generations(self) -> None:
+        # The previous generation is kept, so processes that read CURRENT just before the switch can still open it.
+        # Older ones may still be mapped by long running readers, which is fine on POSIX since unlinked files stay
+        # readable until unmapped.
+        keep = {self.generation_name, self.previous_generation_name}
+        for name in os.listdir(self.index_path):
+            if name.startswith("gen-") and name not in keep:
+                shutil.rmtree(os.path.join(self.index_path, name), ignore_errors=True)
+
+
+class VectorIndex:
+    """Read only view of one generation of a vector index. All files are opened with np.memmap, so every process
+    opening the same index shares a single copy of it through the OS page cache."""
+
+    def __init__(self, generation_path: str):
+        self.generation_path = generation_path
+        with open(os.path.join(generation_path, HEADER_FILE)) as file:
+            self.header = json.load(file)
+        if self.header.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"Index at {generation_path} has format version {self.header.get('format_version')}, "
+                             f"expected {FORMAT_VERSION}. Rebuild it with build_knowledge_index.")
+        self.embedding_model = self.header["embedding_model"]
+        self.dim = self.header["dim"] or 0
+        self.count = self.header["count"]
+        self.dtype = self.header["dtype"]
+        self.vectors = self._memmap(VECTORS_FILE, np.dtype(self.dtype), (self.count, self.dim))
+        self.scales = self._memmap(SCALES_FILE, np.dtype(np.float32), (self.count,)) if self.dtype == "int8" else None
+        self.rows = self._memmap(ROWS_FILE, ROW_DTYPE, (self.count,))
+        self.texts_size = int(self.rows[-1]["text_offset"] + self.rows[-1]["text_length"]) if self.count else 0
+        self._texts = np.memmap(os.path.join(generation_path, TEXTS_FILE), dtype=np.uint8, mode="r",
+                                shape=(self.texts_size,)) if self.texts_size else np.zeros(0, dtype=np.uint8)
+        self.tombstone_count = self.header.get("tombstone_count", 0)
+        self.tombstones = np.fromfile(os.path.join(generation_path, TOMBSTONES_FILE), dtype=np.uint8,
+                                      count=self.count)
+        # None when there is nothing to filter, which spares search() the masking work.
+        self.live_mask = self.tombstones == 0 if self.tombstone_count else None
+        self._manifest = None
+
+    @classmethod
+    def open(cls, index_path: str) -> "VectorIndex":
+        generation_name = read_current_generation(index_path)
+        if generation_name is None:
+            raise FileNotFoundError(f"No vector index found at {index_path}")
+        return cls(os.path.join(index_path, generation_name))
+
+    def _memmap(self, filename: str, dtype: np.dtype, shape: tuple) -> np.ndarray:
+        if self.count == 0:
+            # np.memmap cannot map empty files.
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.generation_path, filename), dtype=dtype, mode="r", shape=shape)
+
+    @property
+    def manifest(self) -> dict:
+        if self._manifest is None:
+            with open(os.path.join(self.generation_path, MANIFEST_FILE)) as file:
+                self._manifest = json.load(file)
+        return self._manifest
+
+    def get_text(self, row_id: int) -> str:
+        row = self.rows[row_id]
+        offset = int(row["text_offset"])
+        return self._texts[offset:offset + int(row["text_length"])].tobytes().decode("utf-8")
+
+    def get_row(self, row_id: int) -> dict:
+        row = self.rows[row_id]
+        return {"row_id": int(row_id), "content_reference_id": int(row["content_reference_id"]),
+                "course_id": None if row["course_id"] == -1 else int(row["course_id"]),
+                "start": int(row["start"]), "end": int(row["end"]), "text": self.get_text(row_id)}
+
+    def _score_block(self, queries: np.ndarray, block_start: int, block_end: int) -> np.ndarray:
+        block = self.vectors[block_start:block_end]
+        if self.dtype != "float32":
+            # BLAS has no float16/int8 kernels; upcasting one block at a time keeps the extra memory bounded.
+            block = block.astype(np.float32)
+        scores = queries @ block.T
+        if self.scales is not None:
+            scores *= self.scales[block_start:block_end]
+        return scores
+
+    def search(self, queries, k: int = 10, row_mask: np.ndarray | None = None, block_rows: int = 65536) -> tuple:
+        """Cosine similarity top-k for a batch of query embeddings.
+
+        :param queries: (n_queries, dim) or (dim,) array like
+        :param k: number of results per query
+        :param row_mask: optional boolean array of length count, rows where it is False are never returned.
+            Tombstoned rows are never returned either.
+        :param block_rows: rows scored per matmul, bounds the temporary score matrix to n_queries * block_rows
+        :return: (scores, row_ids), both (n_queries, k') sorted by descending score, k' = min(k, eligible rows)
+        """
+        queries = _normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if self.live_mask is not None:
+            row_mask = self.live_mask if row_mask is None else row_mask & self.live_mask
+        n_queries = queries.shape[0]
+        best_scores = np.empty((n_queries, 0), dtype=np.float32)
+        best_ids = np.empty((n_queries, 0), dtype=np.int64)
+        for block_start in range(0, self.count, block_rows):
+            block_end = min(block_start + block_rows, self.count)
+            scores = self._score_block(queries, block_start, block_end)
+            ids = np.arange(block_start, block_end, dtype=np.int64)
+            if row_mask is not None:
+                block_mask = row_mask[block_start:block_end]
+                scores = scores[:, block_mask]
+                ids = ids[block_mask]
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                ids = ids[top]
+            else:
+                ids = np.broadcast_to(ids, scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_ids = np.concatenate([best_ids, ids], axis=1)
+            if best_scores.shape[1] > k:
+                top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+                best_ids = np.take_along_axis(best_ids, top, axis=1)
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+
+def compact_index(index_path: str, block_rows: int = 65536) -> dict:
+    """Rewrites the current generation without its tombstoned rows. Stored vectors are copied as they are, nothing
+    is re-parsed or re-embedded."""
+    with index_write_lock(index_path):
+        base = VectorIndex.open(index_path)
+        writer = VectorIndexWriter(index_path, embedding_model=base.embedding_model, dtype=base.dtype)
+        live = base.tombstones == 0
+        new_row_ids = np.cumsum(live) - 1
+        for block_start in range(0, base.count, block_rows):
+            block_end = min(block_start + block_rows, base.count)
+            row_ids = np.flatnonzero(live[block_start:block_end]) + block_start
+            if not len(row_ids):
+                continue
+            chunks = [base.get_row(row_id) for row_id in row_ids.tolist()]
+            writer.add_stored(base.vectors[row_ids], base.scales[row_ids] if base.scales is not None else None,
+                              chunks)
+        for content_reference_id, entry in base.manifest.items():
+            if entry["row_end"] > entry["row_start"]:
+                entry = {**entry, "row_start": int(new_row_ids[entry["row_start"]]),
+                         "row_end": int(new_row_ids[entry["row_end"] - 1]) + 1}
+            else:
+                entry = {**entry, "row_start": 0, "row_end": 0}
+            writer.manifest[content_reference_id] = entry
+        writer.close()
+    return {"rows_before": base.count, "rows_after": writer.count}
@@ -1,18 +1,31 @@
+import bisect
 import re
 import typing
-from datetime import datetime
-import random
+from datetime import datetime, timezone as dt_timezone
+import time
 from string import Template
 import logging
 import json
 
 from OpenAIService.llm_classes.LLMConfig import GLOBAL_LOADED_LLM_CONFIGS, LLMConfig
-from OpenAIService.models import OpenAIAssistant, PromptTemplate, ChatHistory,Tool, KnowledgeRepository, ContentReference
+from OpenAIService.cascade import get_cascade_verifier
+from OpenAIService.llm_messages import REPLACED_RANGE_KEY, LLMMessageProjection, get_replaced_positions
+from OpenAIService.models import OpenAIAssistant, PromptTemplate, ChatHistory, ChatDisplayMessage, ChatMessageFeedback, Tool, KnowledgeRepository, ContentReference, PromptUsageRollup
 from OpenAIService.openai_service import OpenAIService
+from OpenAIService.summarization import SUMMARY_RANGE_KEY, ChatSummarizer, estimate_msg_tokens, needs_summary
+from OpenAIService.tool_call_stream import ToolCallRunner, ToolCallStreamAssembler, get_delta_value
+from OpenAIService.tool_executor import ToolExecutor
+from OpenAIService.write_behind import get_write_behind_queue
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
+# Key of user msgs sent with an idempotency key, e.g. by a job that may be retried after its turn was committed.
+IDEMPOTENCY_KEY = "idempotency_key"
+
 
 class OpenAIAssistantRepository:
     @staticmethod
@@ -99,11 +112,29 @@ class ValidPromptTemplates:
 
 class ChatHistoryRepository:
 
-    def __init__(self, chat_history_id: int | None) -> None:
+    def __init__(self, chat_history_id: int | None, prompt_template_name: str = "", owner_key: str = "") -> None:
+        # Changes made since the last commit, applied to the stored chat on commit_chat_to_db.
+        self.pending_msgs = []
+        self.pending_system_msg = None
+        # LLM facing msgs of chat_history_obj, kept in step with it.
+        self.llm_msgs = LLMMessageProjection()
         if chat_history_id is None:
-            self.chat_history_obj = ChatHistory.objects.create()
+            self.chat_history_obj = ChatHistory.objects.create(prompt_template_name=prompt_template_name,
+                                                               owner_key=owner_key)
         else:
-            self.chat_history_obj = ChatHistory.objects.get(id=chat_history_id)
+            write_behind_queue = get_write_behind_queue()
+            if write_behind_queue is None:
+                self.chat_history_obj = ChatHistory.objects.get(id=chat_history_id)
+            else:
+                self.chat_history_obj, pending_changes = \
+                    write_behind_queue.get_chat_with_pending_changes(chat_history_id)
+                # Changes of earlier requests that are still queued.
+                for pending_msgs, pending_system_msg, queued_prompt_template_name in pending_changes:
+                    self.apply_pending_changes(self.chat_history_obj, pending_msgs, pending_system_msg,
+                                               queued_prompt_template_name)
+            if prompt_template_name and not self.chat_history_obj.prompt_template_name:
+                # Saved with the next commit of the chat.
+                self.chat_history_obj.prompt_template_name = prompt_template_name
 
     @staticmethod
     def create_new_chat_history(*, initialize=True) -> ChatHistory:
@@ -114,22 +145,183 @@ class ChatHistoryRepository:
     def is_chat_history_empty(self):
         return len(self.chat_history_obj.chat_history) == 0
 
-    def commit_chat_to_db(self):        
-        self.chat_history_obj.save()
+    @staticmethod
+    def apply_pending_changes(chat_history_obj: ChatHistory, pending_msgs: list, pending_system_msg: str | None,
+                              prompt_template_name: str = "") -> None:
+        """Applies the msgs and system msg update of one request to chat_history_obj, the stored chat (locked by
+        the caller) or a copy of it."""
+        chat_history = chat_history_obj.chat_history
+        if chat_history and pending_msgs and pending_msgs[0]["role"] == "system":
+            # Another request initialized the chat first, its system and initial msgs are kept.
+            pending_msgs = [msg for msg in pending_msgs
+                            if msg["role"] != "system" and not msg.get("system_generated")]
+        if pending_system_msg is not None and chat_history and chat_history[0]["role"] == "system":
+            chat_history[0]["content"] = pending_system_msg
+        for position, msg in enumerate(pending_msgs, len(chat_history)):
+            msg["id"] = ChatHistoryRepository.get_msg_id(position)
+        chat_history.extend(pending_msgs)
+        if prompt_template_name and not chat_history_obj.prompt_template_name:
+            chat_history_obj.prompt_template_name = prompt_template_name
+        chat_history_obj.version += 1
+
+    @staticmethod
+    def get_msg_id(position: int) -> int:
+        """Id of the msg at position of a chat history. The history is only appended to, so ids are a per chat
+        sequence in commit order, and a msg is found by its id without a scan. Msgs saved before ids were given this
+        way carry a random id, which is ignored."""
+        return position + 1
+
+    def get_msg_by_id(self, msg_id: int) -> dict | None:
+        """Msg of the chat with the given id, None if there is none. Msgs added since the last commit have no id yet."""
+        position = msg_id - 1
+        chat_history = self.chat_history_obj.chat_history
+        if 0 <= position < len(chat_history) - len(self.pending_msgs):
+            return chat_history[position]
+        return None
+
+    @staticmethod
+    def update_metadata(chat_history_obj: ChatHistory, *, full: bool = False) -> None:
+        """Updates the msg count, token count and last msg time of chat_history_obj with the msgs appended since its
+        last save, or with all msgs when full or when the counts do not match the saved msgs (e.g. chats saved
+        before the counts were kept)."""
+        chat_history = chat_history_obj.chat_history
+        start = chat_history_obj.display_projected_upto
+        if not full and chat_history_obj.message_count == start and start <= len(chat_history):
+            chat_history_obj.token_count += estimate_msg_tokens(chat_history[start:])
+        else:
+            chat_history_obj.token_count = estimate_msg_tokens(chat_history)
+        chat_history_obj.message_count = len(chat_history)
+        for msg in reversed(chat_history):
+            if msg.get("timestamp") and SUMMARY_RANGE_KEY not in msg:
+                last_message_at = datetime.fromtimestamp(msg["timestamp"], tz=dt_timezone.utc)
+                chat_history_obj.last_message_at = last_message_at if settings.USE_TZ else \
+                    timezone.make_naive(last_message_at)
+                break
+
+    @staticmethod
+    def save_with_display_msgs(chat_history_obj: ChatHistory) -> None:
+        """Saves chat_history_obj with its metadata and the display msgs of msgs appended since its last save. Call
+        in a transaction."""
+        ChatHistoryRepository.update_metadata(chat_history_obj)
+        new_display_msgs = ChatHistoryRepository.get_unprojected_display_msgs(chat_history_obj)
+        chat_history_obj.save()
+        ChatDisplayMessage.objects.bulk_create(new_display_msgs, ignore_conflicts=True)
+
+    def commit_chat_to_db(self):
+        """Appends the msgs added since the last commit to the stored chat while holding its row lock, so that
+        concurrent requests on one chat (double submits, several tabs) do not overwrite each other's msgs. Msgs of
+        one request stay together, in commit order. Afterwards chat_history_obj also holds the msgs committed by
+        other requests meanwhile.
+
+        With CHAT_WRITE_BEHIND_QUEUE_PATH set, the changes are queued instead and written by a background flush."""
+        write_behind_queue = get_write_behind_queue()
+        if write_behind_queue is not None and (self.pending_msgs or self.pending_system_msg is not None):
+            write_behind_queue.enqueue(self.chat_history_obj.id, self.pending_msgs, self.pending_system_msg,
+                                       self.chat_history_obj.prompt_template_name)
+        else:
+            with transaction.atomic():
+                chat_history_obj = ChatHistory.objects.select_for_update().get(id=self.chat_history_obj.id)
+                if chat_history_obj.version != self.chat_history_obj.version:
+                    # Msgs of other requests were committed meanwhile, so the positions of ours change.
+                    self.llm_msgs.reset()
+                self.apply_pending_changes(chat_history_obj, self.pending_msgs, self.pending_system_msg,
+                                           self.chat_history_obj.prompt_template_name)
+                self.chat_history_obj = chat_history_obj
+                self.save_with_display_msgs(chat_history_obj)
+        self.pending_msgs = []
+        self.pending_system_msg = None
+
+    DISPLAY_ROLE_MAPPING = {"user": "user", "assistant": "bot"}
+
+    @staticmethod
+    def get_display_msg(chat_history: list, position: int) -> dict | None:
+        """Returns the UI projection of the msg at position, or None if it is not shown to the user.
+        tool_data is always filled in; callers strip it for non superusers."""
+        msg = chat_history[position]
+        if msg.get("show_in_user_history", True) == False:
+            return None
+        # Check if the message role is valid and it is not a tool call or initial message
+        if msg["role"] not in ChatHistoryRepository.DISPLAY_ROLE_MAPPING or msg.get("tool_calls") \
+                or msg.get("initial_message", None):
+            return None
+        tool_data = {}
+        if position > 0 and chat_history[position - 1]["role"] == "tool":
+            tool_data = {
+                "used_tool": chat_history[position - 1]["name"],
+                "tool_calls": chat_history[position - 2].get("tool_calls", []),
+                "tool_content": chat_history[position - 1]["content"]
+            }
+        return {
+            "message": msg["content"],
+            "type": ChatHistoryRepository.DISPLAY_ROLE_MAPPING[msg["role"]],
+            "tool_data": tool_data
+        }
+
+    @staticmethod
+    def get_unprojected_display_msgs(chat_history_obj: ChatHistory) -> typing.List[ChatDisplayMessage]:
+        # Only msgs appended since the last commit are projected, so the cost of a commit does not grow with
+        # the length of the chat.
+        chat_history = chat_history_obj.chat_history
+        start = chat_history_obj.display_projected_upto
+        if start > len(chat_history):
+            # History was rewritten since the projection was made, drop the stale tail.
+            ChatDisplayMessage.objects.filter(chat_history_id=chat_history_obj.id,
+                                              position__gte=len(chat_history)).delete()
+            start = len(chat_history)
+        display_msgs = {}
+        for position in range(start, len(chat_history)):
+            if REPLACED_RANGE_KEY in chat_history[position]:
+                replaced_start, replaced_end = chat_history[position][REPLACED_RANGE_KEY]
+                if replaced_start < start:
+                    ChatDisplayMessage.objects.filter(chat_history_id=chat_history_obj.id,
+                                                      position__gte=replaced_start,
+                                                      position__lt=min(replaced_end, start)).delete()
+                for replaced_position in range(max(replaced_start, start), replaced_end):
+                    display_msgs.pop(replaced_position, None)
+            display_msg = ChatHistoryRepository.get_display_msg(chat_history, position)
+            if display_msg is not None:
+                display_msgs[position] = ChatDisplayMessage(chat_history=chat_history_obj, position=position,
+                                                            **display_msg)
+        chat_history_obj.display_projected_upto = len(chat_history)
+        return list(display_msgs.values())
 
     @staticmethod
-    def _generate_12_digit_random_id():
-        min_num = 10 ** 11
-        max_num = (10 ** 12) - 1
-        return random.randint(min_num, max_num)
+    def get_display_msgs_page(chat_history_id: int, *, is_superuser: bool, cursor: int | None = None,
+                              page_size: int = 20) -> dict:
+        """Returns a page of display msgs, newest first. Pass the returned next_cursor to get the next (older)
+        page; it is None once the start of the chat is reached."""
+        display_msgs = ChatDisplayMessage.objects.filter(chat_history_id=chat_history_id)
+        if cursor is not None:
+            display_msgs = display_msgs.filter(position__lt=cursor)
+        page = display_msgs.order_by('-position').values('position', 'type', 'message', 'tool_data')[:page_size + 1]
+        rows = list(page)
+        if not rows and cursor is None and ChatHistory.objects.filter(id=chat_history_id,
+                                                                      display_projected_upto=0).exists():
+            # Chats created before the projection existed are backfilled on first read. Empty chats have nothing to
+            # backfill.
+            chat_history_repository = ChatHistoryRepository(chat_history_id=chat_history_id)
+            if chat_history_repository.chat_history_obj.chat_history:
+                chat_history_repository.commit_chat_to_db()
+                rows = list(page.all())
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+        return {
+            "messages": [{"id": ChatHistoryRepository.get_msg_id(row["position"]),
+                          "message": row["message"],
+                          "type": row["type"],
+                          "tool_data": row["tool_data"] if is_superuser else {}} for row in rows],
+            "next_cursor": rows[-1]["position"] if has_more else None,
+        }
 
     def add_msgs_to_chat_history(self, msg_list: typing.List, timestamp: float = None, commit_to_db: bool = False) -> None:
+        # Msgs get their ids when they are committed, see get_msg_id.
         if not timestamp:
             timestamp = round(datetime.now().timestamp(), 1)
         for msg in msg_list:
             msg["timestamp"] = timestamp
-            msg["id"]= self._generate_12_digit_random_id(),
         self.chat_history_obj.chat_history.extend(msg_list)
+        self.pending_msgs.extend(msg_list)
+        self.llm_msgs.sync(self.chat_history_obj.chat_history)
         if commit_to_db:
             self.commit_chat_to_db()
 
@@ -137,33 +329,25 @@ class ChatHistoryRepository:
         self._add_msg_to_chat_history(msg_content=msg_content, msg_type="user",
                                       msg_timestamp=msg_timestamp)
 
-    def get_msg_list_for_llm(self) -> list:
-        msg_list = []
-        for msg in self.chat_history_obj.chat_history:
-            if msg["role"] in ["user", "assistant", "system"]:
-                new_msg = {"content": msg["content"], "role": msg["role"]}
-            elif msg["role"] == "tool":
-                new_msg = {"content": msg["content"],
-                           "role": "tool",
-                           "tool_call_id": msg["tool_call_id"],
-                           "name": msg["name"]
-                           }
-            else:
-                raise ValueError(f"Unexpected msg role: {msg['role']}")
-
-            if "tool_calls" in msg:
-                new_msg["tool_calls"] = msg["tool_calls"]
-            msg_list.append(new_msg)
-        return msg_list
+    def get_msg_list_for_llm(self, upto: int | None = None) -> list:
+        """Msgs to send to the LLM, those before position upto if given. The msgs covered by the latest summary of
+        the chat, if any, are replaced by it. The list is new, but its msgs are shared with later calls and must not
+        be modified."""
+        self.llm_msgs.sync(self.chat_history_obj.chat_history)
+        return self.llm_msgs.get_payloads(upto)
 
     def add_or_update_system_msg(self, new_system_msg):
         if len(self.chat_history_obj.chat_history) > 0:
             if self.chat_history_obj.chat_history[0]["role"] == "system":
                 self.chat_history_obj.chat_history[0]["content"] = new_system_msg
+                self.pending_system_msg = new_system_msg
+                self.llm_msgs.refresh(self.chat_history_obj.chat_history, 0)
             else:
                 raise ValueError(f"Unexpected: First msg is not a system msg. Chat id: {self.chat_history_obj.id}")
         else:
-            self.chat_history_obj.chat_history = [{"role": "system", "content": new_system_msg}]
+            system_msg = {"role": "system", "content": new_system_msg}
+            self.chat_history_obj.chat_history = [system_msg]
+            self.pending_msgs.append(system_msg)
 
 
 class LLMCommunicationWrapper:
@@ -222,19 +406,23 @@ class LLMCommunicationWrapper:
         return self.chat_history_repository.chat_history_obj
 
     def __init__(self, *, prompt_name, chat_history_id=None,
-                 initialize=True, initializing_context_vars=None):
+                 initialize=True, initializing_context_vars=None, owner_key=""):
         self.prompt_name = prompt_name
         valid_templates = ValidPromptTemplates().get_all_valid_prompts()
         if prompt_name not in valid_templates:
             raise ValueError(f"Invalid prompt name: {prompt_name}")
         self.prompt_template = PromptTemplate.objects.get(name=prompt_name)
-        self.chat_history_repository = ChatHistoryRepository(chat_history_id=chat_history_id)
-
-        self.tool_json_specs = [{"type": "function", "function": tool.tool_json_spec} for tool in
-                                self.prompt_template.tools.all()]
-        self.tool_callables = {tool.name: LLMCommunicationWrapper.convert_to_function(tool.tool_code) for tool in
-                               self.prompt_template.tools.all()}
-        self.context_params = {tool.name: tool.context_params for tool in self.prompt_template.tools.all()}
+        self.chat_history_repository = ChatHistoryRepository(chat_history_id=chat_history_id,
+                                                             prompt_template_name=prompt_name, owner_key=owner_key)
+
+        tools = list(self.prompt_template.tools.all())
+        self.tool_json_specs = [{"type": "function", "function": tool.tool_json_spec} for tool in tools]
+        self.tool_executor = ToolExecutor(tools)
+        self.context_params = {tool.name: tool.context_params for tool in tools}
+        self.tools = tools
+        self.tool_selector = None
+        self.turn_usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        self.turn_cascade_stats = {}
 
         llm_config_instance: LLMConfig = GLOBAL_LOADED_LLM_CONFIGS[self.prompt_template.llm_config_name]
         self.llm_config_params = llm_config_instance.get_config_dict()
@@ -243,6 +431,13 @@ class LLMCommunicationWrapper:
         elif len(self.tool_json_specs):
             raise ValueError(f"Tools not enabled in LLM config but used in LLM Prompt - {self.prompt_name}. "
                              f"LLM config name - {llm_config_instance.name}")
+        self.cascade_llm_config_params = None
+        if self.prompt_template.cascade_llm_config_name:
+            cascade_llm_config: LLMConfig = GLOBAL_LOADED_LLM_CONFIGS[self.prompt_template.cascade_llm_config_name]
+            if len(self.tool_json_specs) and not cascade_llm_config.are_tools_enabled():
+                raise ValueError(f"Tools not enabled in cascade LLM config but used in LLM Prompt - "
+                                 f"{self.prompt_name}. LLM config name - {cascade_llm_config.name}")
+            self.cascade_llm_config_params = cascade_llm_config.get_config_dict()
         self.to_be_logged_context_vars = self.prompt_template.logged_context_vars
         if initialize:
             if chat_history_id is not None:
@@ -265,49 +460,80 @@ class LLMCommunicationWrapper:
         if commit_to_db:
             self.chat_history_repository.commit_chat_to_db()
 
-    def handle_tool_call(self, choice_from_llm,context_vars):
+    def get_llm_config_params_for_turn(self, user_msg: str, msg_list: list) -> dict:
+        """llm_config_params with only the tools picked by the tool selector of the template, if it selects tools.
+        Without the tools key when none were picked, since the API rejects an empty tools list."""
+        if self.prompt_template.tool_selection_mode == PromptTemplate.ToolSelectionMode.ALL or not self.tools:
+            return self.llm_config_params
+        # Imported here so that only templates selecting their tools load numpy and the embedding stack.
+        from OpenAIService.tool_selection import get_tool_selector, get_tool_selection_query
+        if self.tool_selector is None:
+            self.tool_selector = get_tool_selector(self.prompt_template, self.tools)
+        selected_tools = self.tool_selector.select(get_tool_selection_query(user_msg, msg_list))
+        logger.info(f"Selected tools {[tool.name for tool in selected_tools]} for prompt {self.prompt_name}")
+        llm_config_params = {key: value for key, value in self.llm_config_params.items() if key != "tools"}
+        if selected_tools:
+            llm_config_params["tools"] = [{"type": "function", "function": tool.tool_json_spec}
+                                          for tool in selected_tools]
+        return llm_config_params
+
+    def handle_tool_call(self, choice_from_llm,context_vars, llm_config_params=None):
+        if llm_config_params is None:
+            llm_config_params = self.llm_config_params
         if choice_from_llm["message"].get("tool_calls") is None:
             return {}
         tool_call_message = choice_from_llm["message"]
         tool_call_instancd = tool_call_message["tool_calls"][0]
         result = tool_call_instancd["function"]
-        tool_call_id = tool_call_instancd["id"]
         tool_function_name = result.get("name", None)
-        if tool_function_name not in self.tool_callables:
+        if tool_function_name not in self.tool_executor:
             logger.error(
                 f"Unexpected tool call - {tool_function_name}. Chat id - {self.chat_history_repository.chat_history_obj.id}")
             return {}
         json_tool_function_params = result.get("arguments", {})
+        tool_call_result = self.run_tool_call(tool_function_name, json_tool_function_params, context_vars)
+        return self.answer_after_tool_calls([(tool_call_instancd.dict(), tool_call_result)], llm_config_params)
+
+    def run_tool_call(self, tool_function_name, json_tool_function_params, context_vars) -> tuple:
+        """(context params, packaged tool output) of a tool call of the template."""
         tool_function_params = LLMCommunicationWrapper.parse_json(json_tool_function_params)
         context_params = self.context_params[tool_function_name]
         # Initialize context_params_json as an empty dictionary
         context_params_json = LLMCommunicationWrapper.get_tool_context_params(tool_function_name, context_vars,context_params)
         try:
-            tool_output = self.tool_callables[tool_function_name](**context_params_json,**tool_function_params)
+            tool_output = self.tool_executor.execute(tool_function_name, tool_function_params, context_params_json,
+                                                     self.chat_history_repository.chat_history_obj.id)
             logger.info(f"Got tool output of {tool_function_name} - {tool_output}")
             tool_output_packaged = LLMCommunicationWrapper.package_function_response(True, str(tool_output))
             logger.info(f"Generated packaged tool response = f{tool_output_packaged}")
         except Exception as exc:
             logger.error(f"Error in tool call - {exc}. Chat id - {self.chat_history_repository.chat_history_obj.id}")
             tool_output_packaged = LLMCommunicationWrapper.package_function_response(False, "Got error in tool call")
+        return context_params_json, tool_output_packaged
 
+    def answer_after_tool_calls(self, tool_call_results: list, llm_config_params: dict):
+        """Sends the tool calls, as dicts, and their (context params, packaged output) to the LLM, and commits them
+        with its answer."""
+        tool_calls = [tool_call for tool_call, _ in tool_call_results]
         tool_call_msg = {
             "role": "assistant",
             "content": "",
-            "tool_calls": [tool_call_instancd.dict()],
-            "tool_call_id": tool_call_id,
+            "tool_calls": tool_calls,
+            "tool_call_id": tool_calls[0]["id"],
         }
-        
-        our_tool_response = {
+        our_tool_responses = [{
             "role": "tool",
-            "tool_call_id": tool_call_id,
-            "name": tool_function_name,
+            "tool_call_id": tool_call["id"],
+            "name": tool_call["function"]["name"],
             "content": tool_output_packaged
-        }
-        existing_msg_list = self.chat_history_repository.get_msg_list_for_llm()
-        new_msg_list = existing_msg_list + [tool_call_msg, our_tool_response]
+        } for tool_call, (_, tool_output_packaged) in tool_call_results]
+        context_params_json = {}
+        for _, (tool_context_params, _) in tool_call_results:
+            context_params_json.update(tool_context_params)
+        new_msg_list = self.chat_history_repository.get_msg_list_for_llm()
+        new_msg_list += [tool_call_msg, *our_tool_responses]
         a_time = datetime.now().timestamp()
-        post_tool_call_response = OpenAIService.send_messages_and_get_response(new_msg_list, self.llm_config_params)
+        post_tool_call_response = self.send_messages(new_msg_list, llm_config_params)
         post_tool_call_response_dict = {
             "role": "assistant",
             "message_generation_time": round(datetime.now().timestamp() - a_time, 1),
@@ -315,16 +541,56 @@ class LLMCommunicationWrapper:
         }
         tool_call_msg['context_params']=context_params_json
         self.chat_history_repository.add_msgs_to_chat_history(
-            [tool_call_msg, our_tool_response, post_tool_call_response_dict])
+            [tool_call_msg, *our_tool_responses, post_tool_call_response_dict])
         self.chat_history_repository.commit_chat_to_db()
         tool_data = {
-                        "used_tool": tool_function_name,
-                        "tool_calls": [tool_call_instancd.dict()],
-                        "tool_content": tool_output_packaged
+                        "used_tool": tool_calls[0]["function"]["name"],
+                        "tool_calls": tool_calls,
+                        "tool_content": "\n".join(tool_response["content"] for tool_response in our_tool_responses)
                     }
         modified_message_content = {"type":"bot","message":post_tool_call_response["message"]["content"],"tool_data":tool_data}
         return modified_message_content
 
+    def stream_tool_calls_enabled(self, llm_config_params: dict) -> bool:
+        """Whether the first completion of a turn is streamed so that tool calls start before it ends. Cascade
+        templates keep the buffered path, since the fast answer has to be verified whole."""
+        return (getattr(settings, "STREAM_TOOL_CALLS", False) and bool(llm_config_params.get("tools"))
+                and self.cascade_llm_config_params is None)
+
+    def stream_completion_choice(self, msg_list: list, llm_config_params: dict, context_vars: dict) -> tuple:
+        """Streams the completion of msg_list, starting each tool call on the ToolCallRunner as soon as its arguments
+        are complete, so that tools run while the rest of the completion is generated. Returns the choice, as
+        get_completion_choice, and the (tool call, future of run_tool_call) of the tool calls of the template."""
+        def dispatch(tool_call: dict):
+            tool_function_name = tool_call["function"]["name"]
+            if tool_function_name not in self.tool_executor:
+                logger.error(f"Unexpected tool call - {tool_function_name}. "
+                             f"Chat id - {self.chat_history_repository.chat_history_obj.id}")
+                return None
+            logger.info(f"Starting streamed tool call {tool_function_name}")
+            return ToolCallRunner.get().submit(self.run_tool_call, tool_function_name,
+                                               tool_call["function"]["arguments"], context_vars)
+
+        tool_call_assembler = ToolCallStreamAssembler(dispatch)
+        content_chunks = []
+        chunks = []
+        for chunk in OpenAIService.stream_completion(msg_list, llm_config_params):
+            chunks.append(chunk)
+            choices = get_delta_value(chunk, "choices")
+            if not choices:
+                continue
+            delta = get_delta_value(choices[0], "delta")
+            if get_delta_value(delta, "content"):
+                content_chunks.append(get_delta_value(delta, "content"))
+            tool_call_assembler.add_deltas(get_delta_value(delta, "tool_calls"))
+        prompt_tokens, completion_tokens = OpenAIService.get_streamed_token_usage(chunks, msg_list)
+        self.turn_usage["prompt_tokens"] += prompt_tokens
+        self.turn_usage["completion_tokens"] += completion_tokens
+
+        dispatched_tool_calls = tool_call_assembler.finish()
+        tool_calls = [tool_call for tool_call, _ in dispatched_tool_calls] if tool_call_assembler else None
+        return {"message": {"role": "assistant", "content": "".join(content_chunks),
+                            "tool_calls": tool_calls}}, dispatched_tool_calls
 
     def get_one_time_completion(self, kwargs):
         # Fetch the prompt template from the database by name
@@ -361,7 +627,16 @@ class LLMCommunicationWrapper:
             user_prompt = Template(self.prompt_template.user_prompt_template).substitute(**context_vars, user_msg=user_msg)
         return {"role":"user", "content":user_prompt}
 
-    def send_user_message_and_get_response(self, user_msg: str, context_vars=None) -> str:
+    def send_user_message_and_get_response(self, user_msg: str, context_vars=None, *,
+                                           replaced_range: list | None = None, idempotency_key: str | None = None):
+        """With idempotency_key, the turn is only sent once: the key is committed with the user msg, and sending
+        again with the same key returns the committed response instead."""
+        if idempotency_key is not None:
+            stored_response = self.get_stored_response(idempotency_key)
+            if stored_response is not None:
+                logger.info(f"Turn {idempotency_key} of chat {self.chat_history_repository.chat_history_obj.id} "
+                            f"was already committed, returning its response")
+                return stored_response
         if context_vars is None:
             context_vars = {}
         required_keys = self.prompt_template.required_kwargs
@@ -374,18 +649,42 @@ class LLMCommunicationWrapper:
         
         filtered_context_vars = {key: value for key, value in context_vars.items() if key in logged_context_vars}
         self.update_chat_history(context_vars)
-        new_msg_list = self.chat_history_repository.get_msg_list_for_llm()
+        new_msg_list = self.chat_history_repository.get_msg_list_for_llm(
+            upto=replaced_range[0] if replaced_range else None)
+        llm_config_params = self.get_llm_config_params_for_turn(user_msg, new_msg_list)
         new_msg_list += [self.get_final_user_message(user_msg, context_vars=context_vars)]
 
         # The user msg is added here, but in case of tool call we are committing to db only post handling of tool
         # call. ALSO, User msg in history and the one sent to llm finally are intentionally different
-        self.chat_history_repository.add_msgs_to_chat_history(
-            [{"role": "user", "content": user_msg, "context_vars": filtered_context_vars}])
+        user_msg_dict = {"role": "user", "content": user_msg, "context_vars": filtered_context_vars}
+        if replaced_range:
+            user_msg_dict[REPLACED_RANGE_KEY] = replaced_range
+        if idempotency_key is not None:
+            user_msg_dict[IDEMPOTENCY_KEY] = idempotency_key
+        self.chat_history_repository.add_msgs_to_chat_history([user_msg_dict])
         a_time = datetime.now().timestamp()
-        choice_response = OpenAIService.send_messages_and_get_response(new_msg_list, self.llm_config_params)
-
-        if choice_response["message"].get("tool_calls") is not None:
-            return self.handle_tool_call(choice_response,context_vars)
+        self.turn_usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        self.turn_cascade_stats = {}
+        if self.stream_tool_calls_enabled(llm_config_params):
+            choice_response, dispatched_tool_calls = self.stream_completion_choice(new_msg_list, llm_config_params,
+                                                                                   context_vars)
+        else:
+            choice_response = self.send_messages(new_msg_list, llm_config_params)
+            dispatched_tool_calls = None
+
+        if choice_response["message"].get("tool_calls") is not None and dispatched_tool_calls is not None:
+            if not dispatched_tool_calls:
+                return {}
+            response = self.answer_after_tool_calls(
+                [(tool_call, future.result()) for tool_call, future in dispatched_tool_calls], llm_config_params)
+            self.record_turn_usage(datetime.now().timestamp() - a_time, tool_call_count=len(dispatched_tool_calls))
+            self.schedule_summarization_if_needed()
+            return response
+        elif choice_response["message"].get("tool_calls") is not None:
+            response = self.handle_tool_call(choice_response,context_vars, llm_config_params)
+            self.record_turn_usage(datetime.now().timestamp() - a_time, tool_call_count=1)
+            self.schedule_summarization_if_needed()
+            return response
         else:
             response_msg_content = choice_response["message"]["content"]
             self.chat_history_repository.add_msgs_to_chat_history(
@@ -393,8 +692,136 @@ class LLMCommunicationWrapper:
                   "message_generation_time": round(datetime.now().timestamp() - a_time,1),
                   "content": response_msg_content}])
             self.chat_history_repository.commit_chat_to_db()
+            self.record_turn_usage(datetime.now().timestamp() - a_time, tool_call_count=0)
+            self.schedule_summarization_if_needed()
             return response_msg_content
 
+    def get_stored_response(self, idempotency_key: str):
+        """Response of the committed turn whose user msg has idempotency_key, as send_user_message_and_get_response
+        returned it, or None if there is no such turn."""
+        chat_history = self.chat_history_repository.chat_history_obj.chat_history
+        turn_start = next((position for position in range(len(chat_history) - 1, -1, -1)
+                           if chat_history[position].get(IDEMPOTENCY_KEY) == idempotency_key), None)
+        if turn_start is None:
+            return None
+        tool_call_msg = answer_msg = None
+        tool_responses = []
+        for msg in chat_history[turn_start + 1:]:
+            if msg["role"] == "user":
+                break
+            if msg["role"] == "tool":
+                tool_responses.append(msg)
+            elif msg["role"] == "assistant" and msg.get("tool_calls"):
+                tool_call_msg = msg
+            elif msg["role"] == "assistant":
+                answer_msg = msg
+        if answer_msg is None:
+            return {}
+        if tool_call_msg is None:
+            return answer_msg["content"]
+        tool_data = {
+            "used_tool": tool_call_msg["tool_calls"][0]["function"]["name"],
+            "tool_calls": tool_call_msg["tool_calls"],
+            "tool_content": "\n".join(tool_response["content"] for tool_response in tool_responses)
+        }
+        return {"type": "bot", "message": answer_msg["content"], "tool_data": tool_data}
+
+    def regenerate_response(self, msg_id: int, context_vars=None):
+        """Asks the user msg of the latest turn again, for a new answer in place of msg_id, an answer of that turn.
+        The old turn stays in the history, but is no longer sent to the LLM or displayed. context_vars are needed
+        again, as for send_user_message_and_get_response, which gives the return value."""
+        chat_history_obj = self.chat_history_repository.chat_history_obj
+        msg = self.chat_history_repository.get_msg_by_id(msg_id)
+        if msg is None or msg["role"] != "assistant":
+            raise ValueError(f"No answer with id {msg_id} in chat {chat_history_obj.id}")
+        chat_history = chat_history_obj.chat_history
+        turn_start = len(chat_history) - 1
+        while turn_start >= 0 and chat_history[turn_start]["role"] != "user":
+            turn_start -= 1
+        if turn_start < 0 or msg_id - 1 < turn_start:
+            raise ValueError(f"Msg {msg_id} is not an answer of the latest turn of chat {chat_history_obj.id}")
+        # A summary appended after the turn stays in use, along with the range it summarized.
+        turn_end = len(chat_history)
+        while SUMMARY_RANGE_KEY in chat_history[turn_end - 1]:
+            turn_end -= 1
+        return self.send_user_message_and_get_response(chat_history[turn_start]["content"], context_vars,
+                                                       replaced_range=[turn_start, turn_end])
+
+    def get_last_response_id(self) -> int | None:
+        """Id of the latest committed answer of the chat, e.g. to rate the response just returned."""
+        chat_history_repository = self.chat_history_repository
+        chat_history = chat_history_repository.chat_history_obj.chat_history
+        for position in range(len(chat_history) - len(chat_history_repository.pending_msgs) - 1, -1, -1):
+            if chat_history[position]["role"] == "assistant" and not chat_history[position].get("tool_calls"):
+                return ChatHistoryRepository.get_msg_id(position)
+        return None
+
+    def get_completion_choice(self, msg_list: list, llm_config_params: dict):
+        """Sends msg_list to the LLM, adding the token usage of the completion to the usage of the current turn."""
+        response = OpenAIService.get_completion(msg_list, llm_config_params)
+        prompt_tokens, completion_tokens = OpenAIService.get_token_usage(response)
+        self.turn_usage["prompt_tokens"] += prompt_tokens
+        self.turn_usage["completion_tokens"] += completion_tokens
+        return response["choices"][0]
+
+    def send_messages(self, msg_list: list, llm_config_params: dict):
+        """Sends msg_list to the LLM config of the prompt template or, for cascade templates, first to the fast
+        config, escalating to the prompt template's config when the cascade verifier rejects the answer. Tool calls
+        of the fast config are kept as is; the answer after the tool call is verified again."""
+        if self.cascade_llm_config_params is None:
+            return self.get_completion_choice(msg_list, llm_config_params)
+        verifier = get_cascade_verifier(self.prompt_template.cascade_verifier)
+        verifier_params = self.prompt_template.cascade_verifier_params or {}
+        fast_llm_config_params = dict(self.cascade_llm_config_params)
+        if "tools" in llm_config_params:
+            fast_llm_config_params["tools"] = llm_config_params["tools"]
+
+        started_at = time.monotonic()
+        fast_choice = self.get_completion_choice(verifier.prepare_messages(msg_list, verifier_params),
+                                                 fast_llm_config_params)
+        fast_latency_ms = int((time.monotonic() - started_at) * 1000)
+        if fast_choice["message"].get("tool_calls") is not None:
+            accepted, reason = True, "tool call"
+        else:
+            accepted, reason = verifier.verify(fast_choice["message"]["content"] or "", verifier_params)
+        if accepted:
+            self.add_cascade_stats(cascade_accepted_count=1, cascade_accepted_latency_ms=fast_latency_ms)
+            if fast_choice["message"].get("tool_calls") is not None:
+                return fast_choice
+            return {"message": {"role": "assistant",
+                                "content": verifier.clean_response(fast_choice["message"]["content"] or "",
+                                                                   verifier_params)}}
+
+        logger.info(f"Escalating answer of {self.prompt_template.cascade_llm_config_name} for prompt "
+                    f"{self.prompt_name}: {reason}")
+        started_at = time.monotonic()
+        choice = self.get_completion_choice(msg_list, llm_config_params)
+        self.add_cascade_stats(cascade_escalated_count=1, cascade_escalated_fast_latency_ms=fast_latency_ms,
+                               cascade_escalated_strong_latency_ms=int((time.monotonic() - started_at) * 1000))
+        return choice
+
+    def add_cascade_stats(self, **increments) -> None:
+        for field, value in increments.items():
+            self.turn_cascade_stats[field] = self.turn_cascade_stats.get(field, 0) + value
+
+    def schedule_summarization_if_needed(self) -> None:
+        """Schedules a background summary of older turns once the msgs sent for the chat exceed the summarization
+        threshold of the prompt template."""
+        if not self.prompt_template.summarization_threshold_tokens:
+            return
+        if needs_summary(self.prompt_template, self.chat_history_repository.get_msg_list_for_llm()):
+            ChatSummarizer.get().schedule(self.chat_history_repository.chat_history_obj.id, self.prompt_template)
+
+    def record_turn_usage(self, latency_seconds: float, tool_call_count: int) -> None:
+        # Usage tracking must never fail a user msg.
+        try:
+            PromptUsageRollupRepository.record_message(
+                prompt_template_name=self.prompt_name, llm_config_name=self.prompt_template.llm_config_name,
+                latency_seconds=latency_seconds, tool_call_count=tool_call_count,
+                cascade_stats=self.turn_cascade_stats, **self.turn_usage)
+        except Exception as exc:
+            logger.error(f"Failed to record usage of prompt {self.prompt_name}: {exc}")
+
     def update_chat_history(self, context_vars: None):
         if context_vars is None:
             context_vars = {}
@@ -418,36 +845,47 @@ class LLMCommunicationWrapper:
     @staticmethod
     def get_processed_chat_messages(chat_history,is_superuser):
         messages_list = []  # Initialize list to store processed messages
-        mapping = {"user": "user", "assistant": "bot"}
-        for i, msg in enumerate(chat_history):
-            if msg.get("show_in_user_history", True) == False:
-                    continue
-            # Check if the message role is valid and it is not a tool call or initial message
-            if msg["role"] in mapping and not msg.get("tool_calls") and not msg.get("initial_message", None):
-                msg_type = mapping[msg["role"]]  # Map the role to its type
-                message_content = msg["content"]
-                extra = {}  # Initialize extra information dictionary
-
-                # If the user is a superuser, include tool information
-                if is_superuser and i > 0 and chat_history[i-1]["role"] == "tool":
-                    used_tool = chat_history[i-1]["name"]
-                    tool_calls = chat_history[i-2].get("tool_calls", [])
-                    content = chat_history[i-1]["content"]
-                    extra = {
-                        "used_tool": used_tool,
-                        "tool_calls": tool_calls,
-                        "tool_content": content
-                    }
-
-                # Append the message and additional information to the list
-                messages_list.append({
-                    "message": message_content,
-                    "type": msg_type,
-                    "tool_data": extra
-                })
+        replaced_positions = get_replaced_positions(chat_history)
+        for i in range(len(chat_history)):
+            if i in replaced_positions:
+                continue
+            display_msg = ChatHistoryRepository.get_display_msg(chat_history, i)
+            if display_msg is None:
+                continue
+            display_msg["id"] = ChatHistoryRepository.get_msg_id(i)
+            # If the user is a superuser, include tool information
+            if not is_superuser:
+                display_msg["tool_data"] = {}
+            messages_list.append(display_msg)
 
         return messages_list
 
+    @staticmethod
+    def get_processed_chat_messages_page(chat_history_id, is_superuser, cursor=None, page_size=20):
+        return ChatHistoryRepository.get_display_msgs_page(chat_history_id, is_superuser=is_superuser,
+                                                           cursor=cursor, page_size=page_size)
+
+
+class ChatMessageFeedbackRepository:
+    @staticmethod
+    def set_feedback(*, chat_history_id: int, msg_id: int, rating: int, comment: str = "") -> ChatMessageFeedback:
+        """Records the rating of the answer msg_id of a chat, replacing an earlier rating of it."""
+        if not ChatDisplayMessage.objects.filter(chat_history_id=chat_history_id, position=msg_id - 1,
+                                                 type=ChatHistoryRepository.DISPLAY_ROLE_MAPPING["assistant"]).exists():
+            # Not projected yet, e.g. still in the write behind queue.
+            msg = ChatHistoryRepository(chat_history_id=chat_history_id).get_msg_by_id(msg_id)
+            if msg is None or msg["role"] != "assistant":
+                raise ValueError(f"No answer with id {msg_id} in chat {chat_history_id}")
+        feedback, _ = ChatMessageFeedback.objects.update_or_create(
+            chat_history_id=chat_history_id, msg_id=msg_id, defaults={"rating": rating, "comment": comment})
+        return feedback
+
+    @staticmethod
+    def get_feedback(chat_history_id: int) -> dict:
+        """Ratings of the chat by msg id."""
+        return {feedback.msg_id: feedback
+                for feedback in ChatMessageFeedback.objects.filter(chat_history_id=chat_history_id)}
+
 
 class KnowledgeRepositoryRepository:
     @staticmethod
@@ -482,3 +920,118 @@ class ContentReferenceRepository:
     @staticmethod
     def get(id):
         return ContentReference.objects.get(id=id)
+
+
+class PromptUsageRollupRepository:
+    PERCENTILES = (0.5, 0.95, 0.99)
+
+    @staticmethod
+    def get_hour_bucket(timestamp: datetime) -> datetime:
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+
+    @staticmethod
+    def record_message(*, prompt_template_name: str, llm_config_name: str, latency_seconds: float,
+                       prompt_tokens: int = 0, completion_tokens: int = 0, tool_call_count: int = 0,
+                       cascade_stats: dict | None = None) -> None:
+        """Adds one user msg to the rollup of its hour with F() increments, so concurrent workers do not overwrite
+        each other.
+
+        :param cascade_stats: increments of the cascade_* fields by the completions of the msg
+        """
+        latency_ms = int(latency_seconds * 1000)
+        bucket_field = PromptUsageRollup.LATENCY_BUCKET_FIELDS[
+            bisect.bisect_left(PromptUsageRollup.LATENCY_BUCKET_BOUNDS_MS, latency_ms)]
+        increments = {"message_count": 1, "tool_call_count": tool_call_count, "prompt_tokens": prompt_tokens,
+                      "completion_tokens": completion_tokens, "total_latency_ms": latency_ms, bucket_field: 1,
+                      **(cascade_stats or {})}
+        key = {"prompt_template_name": prompt_template_name, "llm_config_name": llm_config_name,
+               "hour": PromptUsageRollupRepository.get_hour_bucket(timezone.now())}
+        updates = {field: F(field) + value for field, value in increments.items()}
+        if PromptUsageRollup.objects.filter(**key).update(**updates):
+            return
+        try:
+            with transaction.atomic():
+                PromptUsageRollup.objects.create(**key, **increments)
+        except IntegrityError:
+            # Another worker created the row of this hour first.
+            PromptUsageRollup.objects.filter(**key).update(**updates)
+
+    @staticmethod
+    def estimate_percentile(bucket_counts: list, percentile: float) -> float | None:
+        """Latency in ms below which percentile of the msgs fall, interpolated linearly within its bucket. The
+        lower bound of the last, unbounded bucket is returned for msgs falling in it."""
+        total = sum(bucket_counts)
+        if not total:
+            return None
+        rank = percentile * total
+        cumulative = 0
+        lower_bound = 0
+        for bound_index, count in enumerate(bucket_counts):
+            if count and cumulative + count >= rank:
+                if bound_index == len(PromptUsageRollup.LATENCY_BUCKET_BOUNDS_MS):
+                    return float(lower_bound)
+                upper_bound = PromptUsageRollup.LATENCY_BUCKET_BOUNDS_MS[bound_index]
+                return lower_bound + (upper_bound - lower_bound) * (rank - cumulative) / count
+            cumulative += count
+            if bound_index < len(PromptUsageRollup.LATENCY_BUCKET_BOUNDS_MS):
+                lower_bound = PromptUsageRollup.LATENCY_BUCKET_BOUNDS_MS[bound_index]
+        return float(lower_bound)
+
+    @staticmethod
+    def summarize(bucket_counts: list, totals: dict) -> dict:
+        message_count = totals["message_count"] or 0
+        summary = {
+            "message_count": message_count,
+            "tool_call_count": totals["tool_call_count"] or 0,
+            "prompt_tokens": totals["prompt_tokens"] or 0,
+            "completion_tokens": totals["completion_tokens"] or 0,
+            "avg_latency_ms": (totals["total_latency_ms"] or 0) / message_count if message_count else None,
+        }
+        for percentile in PromptUsageRollupRepository.PERCENTILES:
+            summary[f"p{int(percentile * 100)}_latency_ms"] = PromptUsageRollupRepository.estimate_percentile(
+                bucket_counts, percentile)
+        summary.update(PromptUsageRollupRepository.summarize_cascade(totals))
+        return summary
+
+    @staticmethod
+    def summarize_cascade(totals: dict) -> dict:
+        """Escalation rate of cascade completions and the estimated latency saved by answers of the fast config:
+        what they would have taken at the average latency of the strong config, less their latency and the latency
+        of the rejected fast answers."""
+        accepted_count = totals.get("cascade_accepted_count") or 0
+        escalated_count = totals.get("cascade_escalated_count") or 0
+        cascade_count = accepted_count + escalated_count
+        summary = {
+            "cascade_completion_count": cascade_count,
+            "cascade_escalation_rate": escalated_count / cascade_count if cascade_count else None,
+            "cascade_latency_saved_ms": None,
+        }
+        if escalated_count:
+            avg_strong_latency_ms = (totals.get("cascade_escalated_strong_latency_ms") or 0) / escalated_count
+            summary["cascade_latency_saved_ms"] = accepted_count * avg_strong_latency_ms \
+                - (totals.get("cascade_accepted_latency_ms") or 0) \
+                - (totals.get("cascade_escalated_fast_latency_ms") or 0)
+        return summary
+
+    @staticmethod
+    def get_usage(*, prompt_template_name: str | None = None, llm_config_name: str | None = None,
+                  start: datetime | None = None, end: datetime | None = None) -> dict:
+        """Usage summed over the matching hour buckets, with latency percentiles estimated from the histogram.
+
+        :param start: first hour included, rounded down to its hour
+        :param end: hours starting at or after end are excluded
+        """
+        rollups = PromptUsageRollup.objects.all()
+        if prompt_template_name is not None:
+            rollups = rollups.filter(prompt_template_name=prompt_template_name)
+        if llm_config_name is not None:
+            rollups = rollups.filter(llm_config_name=llm_config_name)
+        if start is not None:
+            rollups = rollups.filter(hour__gte=PromptUsageRollupRepository.get_hour_bucket(start))
+        if end is not None:
+            rollups = rollups.filter(hour__lt=end)
+        sum_fields = ("message_count", "tool_call_count", "prompt_tokens", "completion_tokens", "total_latency_ms") + \
+            PromptUsageRollup.LATENCY_BUCKET_FIELDS + PromptUsageRollup.CASCADE_FIELDS
+        totals = rollups.aggregate(**{field: Sum(field) for field in sum_fields})
+        bucket_counts = [totals[field] or 0 for field in PromptUsageRollup.LATENCY_BUCKET_FIELDS]
+        return PromptUsageRollupRepository.summarize(bucket_counts, totals)
@@ -0,0 +1,225 @@
+import asyncio
+import copy
+import hashlib
+import json
+import logging
+import threading
+import time
+import weakref
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from OpenAIService.models import LLMRequestLock
+
+logger = logging.getLogger(__name__)
+
+PROCESS_MODE = "process"
+DATABASE_MODE = "database"
+
+
+def get_single_flight_mode() -> str | None:
+    """LLM_SINGLE_FLIGHT: "process" coalesces identical requests within a process, "database" also across workers
+    through LLMRequestLock rows, None (default) disables coalescing. Off by default since coalesced sampled requests
+    (temperature > 0) all get the same answer instead of one each."""
+    return getattr(settings, "LLM_SINGLE_FLIGHT", None) or None
+
+
+def get_request_fingerprint(messages: list, llm_config_params: dict) -> str:
+    request = {"messages": messages, "params": llm_config_params}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """Runs one call per key at a time within the process: callers arriving while a call with their key is running
+    wait for it and get a copy of its result, or its exception."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+        if not is_leader:
+            call.done.wait()
+            if call.exception is not None:
+                raise call.exception
+            return copy.deepcopy(call.result)
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as exc:
+            call.exception = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines, per event loop."""
+
+    def __init__(self):
+        self._calls_by_loop = weakref.WeakKeyDictionary()
+
+    async def do(self, key: str, fn):
+        """:param fn: callable returning the coroutine to run"""
+        calls = self._calls_by_loop.setdefault(asyncio.get_running_loop(), {})
+        future = calls.get(key)
+        if future is not None:
+            # Shielded, so that a cancelled follower does not cancel the call of the others.
+            return copy.deepcopy(await asyncio.shield(future))
+        future = calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn()
+            future.set_result(result)
+            return result
+        except BaseException as exc:
+            future.set_exception(exc)
+            # Retrieved here so that a call without followers does not log "exception was never retrieved".
+            future.exception()
+            raise
+        finally:
+            del calls[key]
+
+
+class DatabaseSingleFlight:
+    """Coalesces calls across workers through LLMRequestLock rows. The first worker creates the row, makes the call
+    and stores the result in it for SINGLE_FLIGHT_RESULT_TTL seconds; the others poll the row every
+    SINGLE_FLIGHT_POLL_INTERVAL seconds. If the call fails, the row is deleted and each waiting worker makes the call
+    itself; if its worker dies, the row expires after SINGLE_FLIGHT_LOCK_TIMEOUT seconds and is taken over.
+
+    Results are stored as JSON, so calls must return JSON serializable values; dump and load convert them."""
+
+    def __init__(self, dump=None, load=None):
+        self.dump = dump or (lambda result: result)
+        self.load = load or (lambda data: data)
+
+    @staticmethod
+    def is_usable() -> bool:
+        # Within a transaction the lock row is not visible to other workers until the transaction ends, and their
+        # inserts of the same fingerprint would block until then.
+        return not transaction.get_connection().in_atomic_block
+
+    @staticmethod
+    def _try_acquire(key: str) -> bool:
+        now = timezone.now()
+        LLMRequestLock.objects.filter(fingerprint=key, expires_at__lt=now).delete()
+        try:
+            with transaction.atomic():
+                LLMRequestLock.objects.create(fingerprint=key, expires_at=now + timedelta(
+                    seconds=getattr(settings, "SINGLE_FLIGHT_LOCK_TIMEOUT", 120)))
+            return True
+        except IntegrityError:
+            return False
+
+    @staticmethod
+    def _get_response(key: str):
+        """(True, response) once the call is done, (False, None) while it runs or when it has to be made again."""
+        row = LLMRequestLock.objects.filter(fingerprint=key).values_list("response", "expires_at").first()
+        if row is None:
+            return True, None
+        response, expires_at = row
+        if response is not None:
+            return True, response
+        # The worker making the call died, once expired the row is taken over.
+        return expires_at < timezone.now(), None
+
+    def _publish(self, key: str, result) -> None:
+        now = timezone.now()
+        LLMRequestLock.objects.filter(fingerprint=key).update(response=self.dump(result), expires_at=now + timedelta(
+            seconds=getattr(settings, "SINGLE_FLIGHT_RESULT_TTL", 5)))
+        LLMRequestLock.objects.filter(expires_at__lt=now).delete()
+
+    @staticmethod
+    def _release(key: str) -> None:
+        LLMRequestLock.objects.filter(fingerprint=key, response__isnull=True).delete()
+
+    def _lead(self, key: str, fn):
+        try:
+            result = fn()
+        except BaseException:
+            self._release(key)
+            raise
+        self._publish(key, result)
+        return result
+
+    def do(self, key: str, fn):
+        poll_interval = getattr(settings, "SINGLE_FLIGHT_POLL_INTERVAL", 0.1)
+        while True:
+            if self._try_acquire(key):
+                return self._lead(key, fn)
+            while True:
+                time.sleep(poll_interval)
+                is_done, response = self._get_response(key)
+                if is_done:
+                    break
+            if response is not None:
+                return self.load(response)
+            # The call failed or its row expired, take it over.
+
+    async def do_async(self, key: str, fn):
+        """:param fn: callable returning the coroutine to run"""
+        poll_interval = getattr(settings, "SINGLE_FLIGHT_POLL_INTERVAL", 0.1)
+        while True:
+            if await sync_to_async(self._try_acquire)(key):
+                try:
+                    result = await fn()
+                except BaseException:
+                    await sync_to_async(self._release)(key)
+                    raise
+                await sync_to_async(self._publish)(key, result)
+                return result
+            while True:
+                await asyncio.sleep(poll_interval)
+                is_done, response = await sync_to_async(self._get_response)(key)
+                if is_done:
+                    break
+            if response is not None:
+                return self.load(response)
+
+
+_single_flight = SingleFlight()
+_async_single_flight = AsyncSingleFlight()
+
+
+def run_single_flight(key: str, fn, *, dump=None, load=None):
+    """Runs fn, or waits for a running call with the same key (see get_single_flight_mode)."""
+    mode = get_single_flight_mode()
+    if mode is None:
+        return fn()
+    if mode == DATABASE_MODE:
+        database_single_flight = DatabaseSingleFlight(dump, load)
+        if database_single_flight.is_usable():
+            return _single_flight.do(key, lambda: database_single_flight.do(key, fn))
+        logger.debug("In a transaction, coalescing LLM requests within the process only")
+    return _single_flight.do(key, fn)
+
+
+async def run_single_flight_async(key: str, fn, *, dump=None, load=None):
+    """run_single_flight for coroutines, fn returns the coroutine to run."""
+    mode = get_single_flight_mode()
+    if mode is None:
+        return await fn()
+    if mode == DATABASE_MODE:
+        database_single_flight = DatabaseSingleFlight(dump, load)
+        # Checked in the thread that runs the DB queries of do_async.
+        if await sync_to_async(database_single_flight.is_usable)():
+            return await _async_single_flight.do(key, lambda: database_single_flight.do_async(key, fn))
+        logger.debug("In a transaction, coalescing LLM requests within the process only")
+    return await _async_single_flight.do(key, fn)
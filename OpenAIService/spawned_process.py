@@ -0,0 +1,16 @@
+import os
+from importlib import import_module
+
+
+def django_process_main(settings_module: str, target: str, *args) -> None:
+    """Entry point of processes started with the spawn method. Spawned processes unpickle their target before Django
+    is set up, so the target is given as a dotted path and only imported after django.setup(); this module must not
+    import models."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    import django
+    django.setup()
+    module_path, name = target.rsplit(".", 1)
+    try:
+        getattr(import_module(module_path), name)(*args)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,40 @@
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+from OpenAIService.llm_classes.ConfigRegistry import get_config_directory_fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+def validate_prompt_configuration() -> None:
+    """Raises ValueError when prompt templates required by code or LLM configs are missing from the DB."""
+    from OpenAIService.repositories import ValidLLMConfigs, ValidPromptTemplates
+    ValidPromptTemplates().check_prompts_in_db()
+    ValidLLMConfigs.check_llm_configs_in_db()
+
+
+def get_validation_fingerprint() -> str:
+    """Changes with the prompts required by code and the LLM config files, i.e. with each deployment of either."""
+    from OpenAIService.repositories import ValidPromptTemplates
+    fingerprint_data = {
+        "prompts": sorted(ValidPromptTemplates.get_all_valid_prompts()),
+        "llm_configs": get_config_directory_fingerprint(settings.LLM_CONFIGS_PATH),
+    }
+    return hashlib.sha256(json.dumps(fingerprint_data, default=str).encode("utf-8")).hexdigest()
+
+
+def validate_prompt_configuration_once() -> None:
+    """Runs validate_prompt_configuration once per fingerprint instead of in every process. Passing validations are
+    remembered for STARTUP_VALIDATION_CACHE_TIMEOUT seconds (default 1 hour) in the Django cache
+    STARTUP_VALIDATION_CACHE_ALIAS, so with a shared cache only the first worker of a deployment queries the DB."""
+    cache = caches[getattr(settings, "STARTUP_VALIDATION_CACHE_ALIAS", "default")]
+    cache_key = f"openai_service_validation:{get_validation_fingerprint()}"
+    if cache.get(cache_key):
+        return
+    validate_prompt_configuration()
+    cache.set(cache_key, True, timeout=getattr(settings, "STARTUP_VALIDATION_CACHE_TIMEOUT", 3600))
+    logger.info("Validated prompt templates and LLM configs")
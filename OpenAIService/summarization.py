@@ -0,0 +1,172 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from OpenAIService.llm_classes.LLMConfig import GLOBAL_LOADED_LLM_CONFIGS
+from OpenAIService.models import ChatHistory, PromptTemplate
+from OpenAIService.openai_service import OpenAIService
+
+logger = logging.getLogger(__name__)
+
+# Key of summary msgs, holding the [start, end) range of chat_history positions they replace for the LLM.
+SUMMARY_RANGE_KEY = "summary_of"
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_INSTRUCTIONS = (
+    "You summarize a tutoring conversation so that it can be continued without the full transcript. Keep the "
+    "student's questions, the explanations and answers given, code, decisions, and anything left open. Write it "
+    "as compact notes. If a previous summary is given, merge it with the new part of the conversation."
+)
+# Rough token estimate, see rag.retrieval.
+CHARS_PER_TOKEN = 4
+MAX_TOOL_OUTPUT_CHARS = 1000
+
+
+def estimate_msg_tokens(msg_list: list) -> int:
+    chars = 0
+    for msg in msg_list:
+        content = msg.get("content") or ""
+        chars += len(content if isinstance(content, str) else json.dumps(content))
+        if msg.get("tool_calls"):
+            chars += len(json.dumps(msg["tool_calls"], default=str))
+    return chars // CHARS_PER_TOKEN + 4 * len(msg_list)
+
+
+def get_latest_summary(chat_history: list) -> dict | None:
+    for msg in reversed(chat_history):
+        if SUMMARY_RANGE_KEY in msg:
+            return msg
+    return None
+
+
+def get_summary_start(chat_history: list) -> int:
+    """First position that may be summarized, after the system msg and the initial msgs of the prompt template."""
+    start = 1
+    while start < len(chat_history) and chat_history[start].get("system_generated") \
+            and SUMMARY_RANGE_KEY not in chat_history[start]:
+        start += 1
+    return start
+
+
+def get_summary_end(chat_history: list, start: int, keep_recent_msgs: int) -> int:
+    """Exclusive end of the range to summarize: the start of a turn (a user msg), so that tool calls are never
+    separated from their results, leaving at least keep_recent_msgs msgs out. start if there is nothing to
+    summarize."""
+    end = len(chat_history) - max(keep_recent_msgs, 0)
+    while end > start and end < len(chat_history) and chat_history[end]["role"] != "user":
+        end -= 1
+    return max(end, start)
+
+
+def format_transcript(msgs: list) -> str:
+    lines = []
+    for msg in msgs:
+        content = msg.get("content")
+        if SUMMARY_RANGE_KEY in msg or not content:
+            continue
+        if msg["role"] == "user":
+            lines.append(f"Student: {content}")
+        elif msg["role"] == "assistant":
+            lines.append(f"Tutor: {content}")
+        elif msg["role"] == "tool":
+            lines.append(f"Tool {msg.get('name')} returned: {str(content)[:MAX_TOOL_OUTPUT_CHARS]}")
+    return "\n\n".join(lines)
+
+
+def needs_summary(prompt_template: PromptTemplate, msg_list: list) -> bool:
+    """Whether msg_list, the msgs sent to the LLM for a chat of prompt_template, is over its summarization threshold."""
+    threshold = prompt_template.summarization_threshold_tokens
+    return bool(threshold) and estimate_msg_tokens(msg_list) > threshold
+
+
+def summarize_chat(chat_history_id: int, prompt_template: PromptTemplate) -> bool:
+    """Summarizes the msgs of the chat not covered by its latest summary yet, up to the recent msgs kept as is, and
+    appends the summary msg covering everything summarized so far. Msgs replaced by a regenerated turn are left
+    out. Returns whether a summary was added."""
+    from OpenAIService.llm_messages import get_replaced_positions
+    from OpenAIService.repositories import ChatHistoryRepository
+    chat_history = ChatHistory.objects.values_list("chat_history", flat=True).get(id=chat_history_id)
+    previous_summary = get_latest_summary(chat_history)
+    if previous_summary is not None:
+        start, summarized_upto = previous_summary[SUMMARY_RANGE_KEY]
+    else:
+        start = summarized_upto = get_summary_start(chat_history)
+    end = get_summary_end(chat_history, summarized_upto, prompt_template.summarization_keep_recent_msgs)
+    replaced_positions = get_replaced_positions(chat_history)
+    transcript = format_transcript([chat_history[position] for position in range(summarized_upto, end)
+                                    if position not in replaced_positions])
+    if not transcript:
+        return False
+
+    request = f"Conversation:\n{transcript}"
+    if previous_summary is not None:
+        request = f"Previous summary:\n{previous_summary['content'].removeprefix(SUMMARY_PREFIX)}\n\n{request}"
+    llm_config_name = prompt_template.summarization_llm_config_name or prompt_template.llm_config_name
+    response = OpenAIService.get_completion(
+        [{"role": "system", "content": SUMMARY_INSTRUCTIONS}, {"role": "user", "content": request}],
+        GLOBAL_LOADED_LLM_CONFIGS[llm_config_name].get_config_dict())
+    summary_msg = {
+        "role": "system",
+        "content": SUMMARY_PREFIX + response["choices"][0]["message"]["content"],
+        "system_generated": True,
+        "show_in_user_history": False,
+        "timestamp": datetime.now().timestamp(),
+        SUMMARY_RANGE_KEY: [start, end],
+    }
+
+    with transaction.atomic():
+        chat_history_obj = ChatHistory.objects.select_for_update().get(id=chat_history_id)
+        latest_summary = get_latest_summary(chat_history_obj.chat_history)
+        if latest_summary is not None and latest_summary[SUMMARY_RANGE_KEY][1] >= end:
+            # Another job summarized at least as far meanwhile.
+            return False
+        summary_msg["id"] = ChatHistoryRepository.get_msg_id(len(chat_history_obj.chat_history))
+        chat_history_obj.chat_history.append(summary_msg)
+        chat_history_obj.version += 1
+        ChatHistoryRepository.save_with_display_msgs(chat_history_obj)
+    logger.info(f"Summarized msgs {start} to {end} of chat {chat_history_id} with {llm_config_name}")
+    return True
+
+
+class ChatSummarizer:
+    """Process wide pool of SUMMARIZATION_WORKERS threads (default 1) running summarize_chat off the response path,
+    at most one job per chat at a time."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat-summarizer")
+        self._scheduled_chat_ids = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "ChatSummarizer":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(getattr(settings, "SUMMARIZATION_WORKERS", 1))
+        return cls._instance
+
+    def schedule(self, chat_history_id: int, prompt_template: PromptTemplate) -> bool:
+        with self._lock:
+            if chat_history_id in self._scheduled_chat_ids:
+                return False
+            self._scheduled_chat_ids.add(chat_history_id)
+        self._executor.submit(self._run, chat_history_id, prompt_template)
+        return True
+
+    def _run(self, chat_history_id: int, prompt_template: PromptTemplate) -> None:
+        try:
+            summarize_chat(chat_history_id, prompt_template)
+        except Exception as exc:
+            # Retried after the next turn of the chat.
+            logger.error(f"Failed to summarize chat {chat_history_id}: {exc}")
+        finally:
+            with self._lock:
+                self._scheduled_chat_ids.discard(chat_history_id)
+            close_old_connections()
@@ -1,3 +1,167 @@
+import atexit
+import os
+import tempfile
+import time
+from unittest import mock
+
+import numpy as np
 from django.test import TestCase
 
-# Create your tests here.
+from OpenAIService.models import ChatHistory, ContentReference, KnowledgeRepository
+from OpenAIService.rag.ingestion import IngestionPipeline
+from OpenAIService.repositories import ChatHistoryRepository
+from OpenAIService.rag.sources import LocalFileSystemSource
+from OpenAIService.rag.vector_index import VectorIndex
+from OpenAIService.tool_executor import ToolProcessPool, ToolTimeoutError
+from OpenAIService.write_behind import ChatWriteBehindQueue
+
+
+class ChatWriteBehindQueueTests(TestCase):
+
+    def setUp(self):
+        self.chat_history_obj = ChatHistory.objects.create()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def make_queue(self, name: str) -> ChatWriteBehindQueue:
+        write_behind_queue = ChatWriteBehindQueue(os.path.join(self.directory, name), flush_interval=3600)
+        self.addCleanup(atexit.unregister, write_behind_queue.shutdown)
+        self.addCleanup(write_behind_queue.shutdown)
+        return write_behind_queue
+
+    def commit(self, write_behind_queue: ChatWriteBehindQueue, content: str) -> None:
+        with mock.patch("OpenAIService.repositories.get_write_behind_queue", return_value=write_behind_queue):
+            chat_history_repository = ChatHistoryRepository(self.chat_history_obj.id)
+            chat_history_repository.add_msgs_to_chat_history([{"role": "user", "content": content}],
+                                                             commit_to_db=True)
+
+    def load_contents(self, write_behind_queue: ChatWriteBehindQueue) -> list:
+        with mock.patch("OpenAIService.repositories.get_write_behind_queue", return_value=write_behind_queue):
+            chat_history_obj = ChatHistoryRepository(self.chat_history_obj.id).chat_history_obj
+        return [msg["content"] for msg in chat_history_obj.chat_history]
+
+    def get_contents(self) -> list:
+        return [msg["content"] for msg in ChatHistory.objects.get(id=self.chat_history_obj.id).chat_history]
+
+    def test_entries_of_a_host_with_a_slower_clock_are_applied(self):
+        fast_queue = self.make_queue("fast.db")
+        slow_queue = self.make_queue("slow.db")
+        # The clock of the first host is an hour ahead.
+        with mock.patch("OpenAIService.write_behind.time.time_ns", return_value=time.time_ns() + 3600 * 10 ** 9):
+            self.commit(fast_queue, "from fast host")
+        self.assertEqual(fast_queue.flush(), 1)
+        self.commit(slow_queue, "from slow host")
+
+        self.assertEqual(self.load_contents(slow_queue), ["from fast host", "from slow host"])
+        self.assertEqual(slow_queue.flush(), 1)
+        self.assertEqual(self.get_contents(), ["from fast host", "from slow host"])
+        self.assertEqual(slow_queue.pending_count(), 0)
+
+    def test_applied_entries_are_not_applied_again(self):
+        write_behind_queue = self.make_queue("queue.db")
+        self.commit(write_behind_queue, "first")
+        apply = ChatWriteBehindQueue._apply
+
+        def apply_and_die(queue, chat_history_id, entries):
+            apply(queue, chat_history_id, entries)
+            raise RuntimeError("Flusher died before removing the entries from the queue")
+
+        with mock.patch.object(ChatWriteBehindQueue, "_apply", apply_and_die), self.assertRaises(RuntimeError):
+            write_behind_queue.flush()
+        self.assertEqual(write_behind_queue.pending_count(), 1)
+
+        self.assertEqual(self.load_contents(write_behind_queue), ["first"])
+        self.assertEqual(write_behind_queue.flush(), 1)
+        self.assertEqual(self.get_contents(), ["first"])
+
+    def test_entries_flushed_while_the_chat_loads_are_kept(self):
+        write_behind_queue = self.make_queue("queue.db")
+        self.commit(write_behind_queue, "first")
+        self.commit(write_behind_queue, "second")
+        get_queued_entries = ChatWriteBehindQueue._get_queued_entries
+
+        def flush_then_get_queued_entries(queue, chat_history_id):
+            # The flusher of another process runs as the chat is loaded.
+            queue.flush()
+            return get_queued_entries(queue, chat_history_id)
+
+        with mock.patch.object(ChatWriteBehindQueue, "_get_queued_entries", flush_then_get_queued_entries):
+            self.assertEqual(self.load_contents(write_behind_queue), ["first", "second"])
+        self.assertEqual(self.get_contents(), ["first", "second"])
+
+    def test_queue_id_is_kept_in_the_queue_file(self):
+        write_behind_queue = self.make_queue("queue.db")
+        reopened_queue = self.make_queue("queue.db")
+        self.assertEqual(reopened_queue.queue_id, write_behind_queue.queue_id)
+        self.assertNotEqual(self.make_queue("other.db").queue_id, write_behind_queue.queue_id)
+
+
+class IngestionPipelineReindexTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source_path = os.path.join(directory.name, "source")
+        os.makedirs(source_path)
+        self.knowledge_repository = KnowledgeRepository.objects.create(
+            type=KnowledgeRepository.Type.COURSE, source_type=KnowledgeRepository.SourceType.LOCAL_FILESYSTEM,
+            source_path=source_path, index_path=os.path.join(directory.name, "index"), course_id=1)
+        self.content_references = []
+        for i in range(2):
+            with open(os.path.join(source_path, f"doc{i}.txt"), "w") as file:
+                file.write(" ".join(f"doc{i}word{j}" for j in range(100)))
+            self.content_references.append(ContentReference.objects.create(
+                content_type=2, path=f"doc{i}.txt", knowledge_repository_id=self.knowledge_repository))
+
+    def get_pipeline(self) -> IngestionPipeline:
+        return IngestionPipeline(self.knowledge_repository, embedder=lambda texts: np.ones((len(texts), 4)),
+                                 embedding_model="test", chunk_size=200, chunk_overlap=20, max_workers=1)
+
+    def get_live_row_count(self, content_reference: ContentReference) -> int:
+        index = VectorIndex.open(self.knowledge_repository.index_path)
+        rows_of_reference = index.rows["content_reference_id"] == content_reference.id
+        return int((rows_of_reference & (index.tombstones == 0)).sum())
+
+    def test_reference_failing_to_stat_keeps_its_rows(self):
+        self.get_pipeline().reindex()
+        failing_reference = self.content_references[0]
+        row_count = self.get_live_row_count(failing_reference)
+        self.assertGreater(row_count, 0)
+        stat = LocalFileSystemSource.stat
+
+        def failing_stat(source, content_reference):
+            if content_reference.id == failing_reference.id:
+                raise OSError("Storage unavailable")
+            return stat(source, content_reference)
+
+        with open(os.path.join(self.knowledge_repository.source_path, "doc1.txt"), "a") as file:
+            file.write(" appended")
+        with mock.patch.object(LocalFileSystemSource, "stat", failing_stat):
+            stats = self.get_pipeline().reindex()
+
+        self.assertEqual((stats["failed_documents"], stats["deleted_documents"], stats["documents"]), (1, 0, 1))
+        self.assertEqual(self.get_live_row_count(failing_reference), row_count)
+        self.assertIn(str(failing_reference.id), VectorIndex.open(self.knowledge_repository.index_path).manifest)
+
+
+class ToolProcessPoolTests(TestCase):
+
+    def setUp(self):
+        self.pool = ToolProcessPool(1, 100)
+        self.addCleanup(self.stop_workers)
+
+    def stop_workers(self):
+        while not self.pool._idle_workers.empty():
+            worker = self.pool._idle_workers.get()
+            if worker is not None:
+                worker.stop()
+
+    def test_timed_out_call_does_not_wait_for_a_replacement_worker(self):
+        self.assertEqual(self.pool.run("def add(a, b):\n    return a + b", {"a": 1, "b": 2}, timeout_seconds=30), "3")
+        start = time.monotonic()
+        with self.assertRaises(ToolTimeoutError):
+            self.pool.run("def slow():\n    import time\n    time.sleep(30)", {}, timeout_seconds=1)
+        self.assertLess(time.monotonic() - start, 1.5)
+
+        self.assertEqual(self.pool.run("def add(a, b):\n    return a + b", {"a": 3, "b": 4}, timeout_seconds=30), "7")
@@ -0,0 +1,154 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+def get_delta_value(delta, key: str):
+    """Field of a streamed delta, which litellm gives as an object and some providers as a dict."""
+    if delta is None:
+        return None
+    if isinstance(delta, dict):
+        return delta.get(key)
+    return getattr(delta, key, None)
+
+
+class JSONObjectTracker:
+    """Tells when streamed text closes its top level JSON object or array. Each chunk is scanned once, keeping the
+    nesting depth outside of strings, instead of parsing the whole text again per chunk."""
+
+    __slots__ = ("_depth", "_in_string", "_escaped", "_started", "complete")
+
+    def __init__(self):
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._started = False
+        self.complete = False
+
+    def feed(self, text: str) -> bool:
+        for char in text:
+            if self.complete:
+                break
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+                self._started = True
+            elif char in "}]":
+                self._depth -= 1
+                self.complete = self._started and self._depth == 0
+        return self.complete
+
+
+class StreamedToolCall:
+    __slots__ = ("index", "id", "name", "argument_chunks", "tracker", "dispatched", "handle")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.id = None
+        self.name = None
+        self.argument_chunks = []
+        self.tracker = JSONObjectTracker()
+        self.dispatched = False
+        self.handle = None
+
+    def to_dict(self) -> dict:
+        return {"id": self.id, "type": "function",
+                "function": {"name": self.name, "arguments": "".join(self.argument_chunks) or "{}"}}
+
+
+class ToolCallStreamAssembler:
+    """Assembles the tool calls of a streamed completion from their deltas, and calls dispatch with each tool call as
+    soon as its name is known and its arguments form a complete JSON object, while the rest of the completion is
+    still streaming. dispatch returns a handle for the running call, such as a future, or None to skip the call."""
+
+    def __init__(self, dispatch: Callable[[dict], object]):
+        self._dispatch = dispatch
+        self._tool_calls = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._tool_calls)
+
+    def add_deltas(self, tool_call_deltas) -> None:
+        for delta in tool_call_deltas or ():
+            index = get_delta_value(delta, "index") or 0
+            tool_call = self._tool_calls.get(index)
+            if tool_call is None:
+                tool_call = self._tool_calls[index] = StreamedToolCall(index)
+            if get_delta_value(delta, "id"):
+                tool_call.id = get_delta_value(delta, "id")
+            function = get_delta_value(delta, "function")
+            if get_delta_value(function, "name"):
+                tool_call.name = get_delta_value(function, "name")
+            arguments = get_delta_value(function, "arguments")
+            if arguments:
+                tool_call.argument_chunks.append(arguments)
+                if tool_call.tracker.feed(arguments):
+                    self._dispatch_if_ready(tool_call)
+
+    def _dispatch_if_ready(self, tool_call: StreamedToolCall) -> None:
+        if tool_call.dispatched or tool_call.name is None:
+            return
+        try:
+            json.loads("".join(tool_call.argument_chunks))
+        except ValueError:
+            # Left to finish, which dispatches it with the full arguments.
+            return
+        tool_call.dispatched = True
+        tool_call.handle = self._dispatch(tool_call.to_dict())
+
+    def finish(self) -> list:
+        """(tool call, handle) of every tool call in stream order, dispatching those whose arguments never formed a
+        complete object, such as tools without parameters. Skipped calls are left out."""
+        dispatched = []
+        for index in sorted(self._tool_calls):
+            tool_call = self._tool_calls[index]
+            if not tool_call.dispatched:
+                tool_call.dispatched = True
+                tool_call.handle = self._dispatch(tool_call.to_dict())
+            if tool_call.handle is not None:
+                dispatched.append((tool_call.to_dict(), tool_call.handle))
+        return dispatched
+
+
+class ToolCallRunner:
+    """Process wide pool of TOOL_CALL_STREAM_WORKERS threads (default 8) running tool calls dispatched from a
+    streamed completion."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool-call")
+
+    @classmethod
+    def get(cls) -> "ToolCallRunner":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(getattr(settings, "TOOL_CALL_STREAM_WORKERS", 8))
+        return cls._instance
+
+    def submit(self, function, *args):
+        return self._executor.submit(self._run, function, *args)
+
+    @staticmethod
+    def _run(function, *args):
+        try:
+            return function(*args)
+        finally:
+            close_old_connections()
@@ -0,0 +1,292 @@
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from OpenAIService.models import Tool
+from OpenAIService.spawned_process import django_process_main
+
+logger = logging.getLogger(__name__)
+
+
+class ToolExecutionError(Exception):
+    pass
+
+
+class ToolTimeoutError(ToolExecutionError):
+    pass
+
+
+def compile_tool_code(source_code: str):
+    match = re.search(r'def\s+(\w+)\s*\(', source_code)
+    if not match:
+        raise ValueError("No valid function definition found in the provided source code.")
+    namespace = {}
+    exec(source_code, namespace)
+    return namespace[match.group(1)]
+
+
+def _get_address_space_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _set_memory_limit(memory_limit_mb: int | None, baseline_bytes: int) -> None:
+    """Sets the soft RLIMIT_AS to memory_limit_mb on top of the idle worker, or back to the hard limit. Only the soft
+    limit is touched so that it can be raised again for the next call."""
+    import resource
+    _, hard_limit = resource.getrlimit(resource.RLIMIT_AS)
+    soft_limit = hard_limit
+    if memory_limit_mb:
+        soft_limit = baseline_bytes + memory_limit_mb * 1024 * 1024
+        if hard_limit != resource.RLIM_INFINITY:
+            soft_limit = min(soft_limit, hard_limit)
+    resource.setrlimit(resource.RLIMIT_AS, (soft_limit, hard_limit))
+
+
+def run_tool_worker(conn) -> None:
+    baseline_bytes = _get_address_space_bytes()
+    tool_callables = {}
+    while True:
+        try:
+            tool_code, kwargs, memory_limit_mb = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            if tool_code not in tool_callables:
+                tool_callables[tool_code] = compile_tool_code(tool_code)
+            _set_memory_limit(memory_limit_mb, baseline_bytes)
+            try:
+                response = (True, str(tool_callables[tool_code](**kwargs)))
+            finally:
+                _set_memory_limit(None, baseline_bytes)
+        except MemoryError:
+            response = (False, f"MemoryError: tool exceeded its memory limit of {memory_limit_mb} MB")
+        except Exception as exc:
+            response = (False, f"{type(exc).__name__}: {exc}")
+        conn.send(response)
+
+
+class ToolWorker:
+    """One warm spawned process that runs tool calls one at a time, sent over a pipe."""
+
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=django_process_main, daemon=True, args=(
+            os.environ["DJANGO_SETTINGS_MODULE"], "OpenAIService.tool_executor.run_tool_worker", child_conn))
+        self.process.start()
+        child_conn.close()
+        self.tasks_done = 0
+
+    def run(self, tool_code: str, kwargs: dict, timeout_seconds: float, memory_limit_mb: int | None) -> str:
+        self.tasks_done += 1
+        self.conn.send((tool_code, kwargs, memory_limit_mb))
+        if not self.conn.poll(timeout_seconds):
+            raise ToolTimeoutError(f"Tool call did not finish within {timeout_seconds:.3g} seconds")
+        try:
+            was_success, result = self.conn.recv()
+        except EOFError:
+            raise ToolExecutionError(f"Tool worker died with exit code {self.process.exitcode}")
+        if not was_success:
+            raise ToolExecutionError(result)
+        return result
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def stop(self) -> None:
+        self.conn.close()
+        self.process.kill()
+        self.process.join(timeout=5)
+
+
+class ToolProcessPool:
+    """Pool of warm tool workers, started with the spawn method so that they do not inherit the locks and DB
+    connections of the threads of the web worker. A worker that hit a timeout is killed and replaced, and workers are
+    recycled after TOOL_WORKER_MAX_TASKS calls to bound leaks of tool code. Calls wait for a free worker when all are
+    busy, and that wait counts toward their timeout. Replacements are started in the background, so that the call that
+    timed out does not also wait for a new process to start."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, size: int, max_tasks_per_worker: int):
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._context = multiprocessing.get_context("spawn")
+        self._idle_workers = queue.Queue()
+        for _ in range(size):
+            self._idle_workers.put(ToolWorker(self._context))
+
+    @classmethod
+    def get(cls) -> "ToolProcessPool":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(getattr(settings, "TOOL_PROCESS_POOL_SIZE", 2),
+                                        getattr(settings, "TOOL_WORKER_MAX_TASKS", 100))
+        return cls._instance
+
+    def run(self, tool_code: str, kwargs: dict, *, timeout_seconds: float, memory_limit_mb: int | None = None) -> str:
+        deadline = time.monotonic() + timeout_seconds
+        try:
+            worker = self._idle_workers.get(timeout=timeout_seconds)
+        except queue.Empty:
+            raise ToolTimeoutError(f"No tool worker became free within {timeout_seconds} seconds")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._idle_workers.put(worker)
+            raise ToolTimeoutError(f"No tool worker became free within {timeout_seconds} seconds")
+        if worker is None:
+            # Its replacement failed to start in the background.
+            try:
+                worker = ToolWorker(self._context)
+            except BaseException:
+                self._idle_workers.put(None)
+                raise
+        needs_replacement = False
+        try:
+            return worker.run(tool_code, kwargs, remaining, memory_limit_mb)
+        except ToolTimeoutError:
+            needs_replacement = True
+            logger.warning(f"Killing tool worker {worker.process.pid} after a timeout")
+            worker.process.kill()
+            raise
+        finally:
+            if needs_replacement or worker.tasks_done >= self.max_tasks_per_worker or not worker.is_alive():
+                # Not a daemon thread, so that interpreter exit does not cut a replacement off halfway through
+                # starting it.
+                threading.Thread(target=self._replace_worker, args=(worker,), name="tool-worker-replacement").start()
+            else:
+                self._idle_workers.put(worker)
+
+    def _replace_worker(self, worker: ToolWorker) -> None:
+        worker.stop()
+        try:
+            replacement = ToolWorker(self._context)
+        except Exception as exc:
+            logger.error(f"Failed to start a tool worker, starting it on the next call instead: {exc}")
+            replacement = None
+        self._idle_workers.put(replacement)
+
+
+class ToolResultCache:
+    """Results of tools with a cache_ttl_seconds, kept in an in-process TTL LRU of TOOL_RESULT_CACHE_SIZE entries, or
+    in the Django cache TOOL_RESULT_CACHE_ALIAS when set, so that workers share them. Hits and misses are counted
+    per tool in stats."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, *, max_size: int, cache_alias: str | None = None):
+        self.max_size = max_size
+        self.cache_alias = cache_alias
+        self.stats = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls) -> "ToolResultCache":
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls(max_size=getattr(settings, "TOOL_RESULT_CACHE_SIZE", 1000),
+                                        cache_alias=getattr(settings, "TOOL_RESULT_CACHE_ALIAS", None))
+        return cls._instance
+
+    @staticmethod
+    def get_key(tool: Tool, tool_params: dict, context_params: dict, chat_history_id: int | None) -> str:
+        """Hash of the tool code (so that edited tools do not serve stale results), its arguments, the context params
+        of cache_key_context_params (all when None) and, for chat scoped tools, the chat."""
+        if tool.cache_key_context_params is not None:
+            context_params = {key: value for key, value in context_params.items()
+                              if key in tool.cache_key_context_params}
+        key_data = {
+            "tool": tool.name,
+            "code": hashlib.sha256(tool.tool_code.encode("utf-8")).hexdigest(),
+            "params": tool_params,
+            "context_params": context_params,
+            "chat_history_id": chat_history_id if tool.cache_scope == Tool.CacheScope.CHAT else None,
+        }
+        key_hash = hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return f"tool_result:{key_hash}"
+
+    def _record(self, tool_name: str, hit: bool) -> None:
+        with self._lock:
+            tool_stats = self.stats.setdefault(tool_name, {"hits": 0, "misses": 0})
+            tool_stats["hits" if hit else "misses"] += 1
+
+    def lookup(self, tool_name: str, key: str) -> str | None:
+        if self.cache_alias:
+            result = caches[self.cache_alias].get(key)
+        else:
+            with self._lock:
+                entry = self._entries.get(key)
+                result = None
+                if entry is not None:
+                    if entry[0] > time.monotonic():
+                        self._entries.move_to_end(key)
+                        result = entry[1]
+                    else:
+                        del self._entries[key]
+        self._record(tool_name, result is not None)
+        return result
+
+    def store(self, key: str, result: str, ttl_seconds: int) -> None:
+        if self.cache_alias:
+            caches[self.cache_alias].set(key, result, timeout=ttl_seconds)
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl_seconds, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+class ToolExecutor:
+    """Runs the tools of a prompt template in their configured execution mode, serving results of tools with a cache
+    policy from the ToolResultCache."""
+
+    def __init__(self, tools):
+        self.tools = {tool.name: tool for tool in tools}
+        self._tool_callables = {}
+
+    def __contains__(self, tool_name: str) -> bool:
+        return tool_name in self.tools
+
+    def execute(self, tool_name: str, tool_params: dict, context_params: dict | None = None,
+                chat_history_id: int | None = None) -> str:
+        tool = self.tools[tool_name]
+        context_params = context_params or {}
+        if not tool.cache_ttl_seconds:
+            return self._run(tool, {**context_params, **tool_params})
+        result_cache = ToolResultCache.get()
+        key = result_cache.get_key(tool, tool_params, context_params, chat_history_id)
+        result = result_cache.lookup(tool_name, key)
+        if result is None:
+            # Failed calls raise and are not cached.
+            result = self._run(tool, {**context_params, **tool_params})
+            result_cache.store(key, result, tool.cache_ttl_seconds)
+        else:
+            logger.info(f"Served {tool_name} from the tool result cache")
+        return result
+
+    def _run(self, tool: Tool, kwargs: dict) -> str:
+        tool_name = tool.name
+        if tool.execution_mode == Tool.ExecutionMode.PROCESS_POOL:
+            return ToolProcessPool.get().run(tool.tool_code, kwargs, timeout_seconds=tool.timeout_seconds,
+                                             memory_limit_mb=tool.memory_limit_mb)
+        if tool_name not in self._tool_callables:
+            self._tool_callables[tool_name] = compile_tool_code(tool.tool_code)
+        return str(self._tool_callables[tool_name](**kwargs))
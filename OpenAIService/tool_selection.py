@@ -0,0 +1,129 @@
+import logging
+import math
+import threading
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+
+from OpenAIService.embedding_service import EmbeddingService
+from OpenAIService.models import PromptTemplate
+from OpenAIService.rag.bm25_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+
+def get_tool_spec_text(tool) -> str:
+    """Text of the json spec a tool is ranked by: its name, description and parameter names and descriptions."""
+    spec = tool.tool_json_spec or {}
+    parts = [tool.name, spec.get("description") or ""]
+    for param_name, param in spec.get("parameters", {}).get("properties", {}).items():
+        parts.append(f"{param_name} {param.get('description') or ''}")
+    return "\n".join(parts)
+
+
+class ToolSelector:
+    """Picks the tools of a prompt template sent with a completion: pinned tools plus the top_k others ranked against
+    the query. Tools are ranked in the order of the template when scores tie."""
+
+    def __init__(self, tools: list, *, top_k: int, pinned_tool_names: set):
+        self.tools = tools
+        self.top_k = top_k
+        self.pinned_tool_names = pinned_tool_names
+
+    def get_scores(self, query: str) -> np.ndarray:
+        raise NotImplementedError
+
+    def select(self, query: str) -> list:
+        candidates = [i for i, tool in enumerate(self.tools) if tool.name not in self.pinned_tool_names]
+        scores = self.get_scores(query)
+        ranked = sorted(candidates, key=lambda i: -scores[i])[:self.top_k]
+        selected = set(ranked)
+        return [tool for i, tool in enumerate(self.tools) if tool.name in self.pinned_tool_names or i in selected]
+
+
+class KeywordToolSelector(ToolSelector):
+    """BM25 over the spec texts of the tools."""
+
+    def __init__(self, tools: list, *, top_k: int, pinned_tool_names: set, k1: float = 1.2, b: float = 0.75):
+        super().__init__(tools, top_k=top_k, pinned_tool_names=pinned_tool_names)
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize(get_tool_spec_text(tool))) for tool in tools]
+        self.doc_lengths = [sum(term_frequency.values()) for term_frequency in self.term_frequencies]
+        self.average_doc_length = (sum(self.doc_lengths) / len(tools)) or 1.0
+        document_frequencies = Counter(term for term_frequency in self.term_frequencies for term in term_frequency)
+        self.idf = {term: math.log(1 + (len(tools) - df + 0.5) / (df + 0.5)) for term, df in document_frequencies.items()}
+
+    def get_scores(self, query: str) -> np.ndarray:
+        scores = np.zeros(len(self.tools))
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, term_frequency in enumerate(self.term_frequencies):
+                tf = term_frequency.get(term)
+                if tf:
+                    length_norm = 1 - self.b + self.b * self.doc_lengths[i] / self.average_doc_length
+                    scores[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * length_norm)
+        return scores
+
+
+class EmbeddingToolSelector(ToolSelector):
+    """Cosine similarity of the query with embeddings of the spec texts, computed once per selector (and cached in
+    the embedding cache across processes)."""
+
+    def __init__(self, tools: list, *, top_k: int, pinned_tool_names: set, embedding_config_name: str):
+        super().__init__(tools, top_k=top_k, pinned_tool_names=pinned_tool_names)
+        self.embedding_service = EmbeddingService.get(embedding_config_name)
+        self.spec_embeddings = self._normalize(self.embedding_service.embed([get_tool_spec_text(tool)
+                                                                             for tool in tools]))
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def get_scores(self, query: str) -> np.ndarray:
+        return self.spec_embeddings @ self._normalize(self.embedding_service.embed_query(query))
+
+
+_selectors = {}
+_selectors_lock = threading.Lock()
+
+
+def get_tool_selector(prompt_template: PromptTemplate, tools: list) -> ToolSelector | None:
+    """Process wide selector of a prompt template, None when all tools are sent. Rebuilt when the template's tool
+    selection settings or any of its tools change."""
+    mode = prompt_template.tool_selection_mode
+    if mode == PromptTemplate.ToolSelectionMode.ALL or not tools:
+        return None
+    pinned_tool_names = frozenset(prompt_template.pinned_tools.values_list("name", flat=True))
+    cache_key = (prompt_template.id, mode, prompt_template.tool_selection_top_k,
+                 prompt_template.tool_selection_embedding_config, pinned_tool_names,
+                 tuple((tool.id, tool.updated_at) for tool in tools))
+    selector = _selectors.get(cache_key)
+    if selector is None:
+        with _selectors_lock:
+            selector = _selectors.get(cache_key)
+            if selector is None:
+                if mode == PromptTemplate.ToolSelectionMode.KEYWORD:
+                    selector = KeywordToolSelector(tools, top_k=prompt_template.tool_selection_top_k,
+                                                   pinned_tool_names=pinned_tool_names)
+                else:
+                    selector = EmbeddingToolSelector(
+                        tools, top_k=prompt_template.tool_selection_top_k, pinned_tool_names=pinned_tool_names,
+                        embedding_config_name=prompt_template.tool_selection_embedding_config)
+                # Entries of older versions of the template are dropped.
+                for key in [key for key in _selectors if key[0] == prompt_template.id]:
+                    del _selectors[key]
+                _selectors[cache_key] = selector
+    return selector
+
+
+def get_tool_selection_query(user_msg: str, msg_list: list) -> str:
+    """The user msg with the contents of the last TOOL_SELECTION_CONTEXT_MSGS user and assistant msgs."""
+    context_msg_count = getattr(settings, "TOOL_SELECTION_CONTEXT_MSGS", 4)
+    recent_contents = [msg["content"] for msg in msg_list
+                       if msg["role"] in ("user", "assistant") and msg.get("content")]
+    return "\n".join(recent_contents[-context_msg_count:] + [user_msg]) if context_msg_count else user_msg
@@ -1,20 +1,44 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Iterable, Iterator, TYPE_CHECKING
+
+from django.conf import settings
+
 from .repositories import OpenAIAssistantRepository
 from OpenAIService.openai_service import OpenAIService
-from typing import Any
-from openai.types.beta.assistant import Assistant
+
+if TYPE_CHECKING:
+    from openai.types.beta.assistant import Assistant
 
 class OpenAIAssistantWrapper:
     def __init__(self, assistant_name: str):
         self.assistant = OpenAIServiceWrapper.get_or_create_assistant(assistant_name)
     
     def get_response_using_file(self, file_path: str, prompt: str) -> str:
-        thread = OpenAIService().create_thread()
-        #message_file = OpenAIService().upload_file(file_path)
-        #message = OpenAIService().create_message(thread.id, prompt, message_file)
-        message = OpenAIService().create_message(thread.id, prompt)
-        run = OpenAIService().run_assistant(thread.id, self.assistant.id)
-        messages = OpenAIService().list_messages(thread.id)
-        return messages
+        openai_service = OpenAIService()
+        #message_file = openai_service.upload_file(file_path)
+        # The thread, its message and the run are created in one request. Each call gets its own thread, so that the
+        # assistant never sees the documents of other calls.
+        run = openai_service.create_thread_and_run(self.assistant.id, prompt)
+        if run is None:
+            return None
+        return openai_service.list_run_messages(run.thread_id, run.id)
+
+    def get_responses_using_files(self, requests: Iterable[tuple[str, str]],
+                                  max_concurrency: int | None = None) -> Iterator[tuple[int, str]]:
+        """Runs get_response_using_file for each (file_path, prompt) of requests, at most max_concurrency (default
+        ASSISTANT_BATCH_CONCURRENCY, 8) at a time, and yields (index in requests, response) as runs finish."""
+        max_concurrency = max_concurrency or getattr(settings, "ASSISTANT_BATCH_CONCURRENCY", 8)
+        executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="assistant-batch")
+        try:
+            futures = {executor.submit(self.get_response_using_file, file_path, prompt): index
+                       for index, (file_path, prompt) in enumerate(requests)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # Runs not started yet are dropped if the caller stops early.
+            executor.shutdown(wait=False, cancel_futures=True)
 
 class OpenAIServiceWrapper:
     def get_or_create_assistant(name: str) -> Assistant:
@@ -0,0 +1,226 @@
+import atexit
+import fcntl
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from OpenAIService.models import ChatHistory, ChatWriteBehindMarker
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_commits (
+    seq INTEGER PRIMARY KEY,
+    chat_history_id INTEGER NOT NULL,
+    payload TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_commits_chat_history_id ON pending_commits (chat_history_id, seq);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS queue_identity (id INTEGER PRIMARY KEY CHECK (id = 1), queue_id TEXT NOT NULL);
+"""
+
+
+class ChatWriteBehindQueue:
+    """Durable queue of chat commits in a local SQLite database (WAL mode), shared by the worker processes of a host,
+    so that requests return without waiting for the main DB.
+
+    Each commit gets a sequence number that only grows within the queue. The queue file holds a random queue id.
+    One process at a time flushes (guarded by a file lock): entries are applied in sequence order, all entries of a
+    chat in one transaction that also records the last applied sequence number in the ChatWriteBehindMarker of the
+    queue and chat, so an entry is applied exactly once even if the flusher dies before removing it from the queue.
+    Markers are per queue since sequence numbers of the queues of different hosts are not comparable. Requests
+    loading a chat overlay its queued entries, so follow up requests routed to the same host see their earlier
+    msgs."""
+
+    def __init__(self, path: str, *, flush_interval: float = 1.0, batch_size: int = 500):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._local = threading.local()
+        self._flush_thread = None
+        self._flush_thread_lock = threading.Lock()
+        self._stopped = threading.Event()
+        with self._connect() as connection:
+            connection.executescript(SCHEMA)
+            connection.execute("INSERT OR IGNORE INTO queue_identity (id, queue_id) VALUES (1, ?)",
+                               (f"{socket.gethostname()}:{uuid.uuid4().hex[:12]}",))
+            self.queue_id = connection.execute("SELECT queue_id FROM queue_identity").fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode, transactions are started explicitly.
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def enqueue(self, chat_history_id: int, pending_msgs: list, pending_system_msg: str | None,
+                prompt_template_name: str = "") -> int:
+        payload = json.dumps({"msgs": pending_msgs, "system_msg": pending_system_msg,
+                              "prompt_template_name": prompt_template_name}, default=str)
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = 'last_seq'").fetchone()
+            seq = max(time.time_ns() // 1000, (row[0] if row else 0) + 1)
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_seq', ?)", (seq,))
+            connection.execute("INSERT INTO pending_commits (seq, chat_history_id, payload) VALUES (?, ?, ?)",
+                               (seq, chat_history_id, payload))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        self._ensure_flush_thread()
+        return seq
+
+    def _get_queued_entries(self, chat_history_id: int) -> list:
+        return self._connect().execute(
+            "SELECT seq, payload FROM pending_commits WHERE chat_history_id = ? ORDER BY seq",
+            (chat_history_id,)).fetchall()
+
+    def get_chat_with_pending_changes(self, chat_history_id: int) -> tuple:
+        """(chat, (msgs, system msg, prompt template name) of its queued commits not applied to it yet, in order).
+
+        A flush may apply entries meanwhile. The queued entries are read first, since entries are only removed
+        after being applied, and the chat is read in one query with the marker of this queue, so both come from the
+        same snapshot. Each entry is then either in the chat or in the changes."""
+        rows = self._get_queued_entries(chat_history_id)
+        applied_upto = ChatWriteBehindMarker.objects.filter(queue_id=self.queue_id, chat_history_id=OuterRef("pk"))
+        chat_history_obj = ChatHistory.objects.annotate(
+            write_behind_applied_upto=Coalesce(Subquery(applied_upto.values("applied_upto")[:1]), 0,
+                                               output_field=models.BigIntegerField()),
+        ).get(id=chat_history_id)
+        changes = []
+        for seq, payload in rows:
+            if seq <= chat_history_obj.write_behind_applied_upto:
+                continue
+            change = json.loads(payload)
+            changes.append((change["msgs"], change["system_msg"], change["prompt_template_name"]))
+        return chat_history_obj, changes
+
+    def pending_count(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM pending_commits").fetchone()[0]
+
+    @contextmanager
+    def _flush_lock(self, blocking: bool):
+        with open(f"{self.path}.flush.lock", "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _apply(self, chat_history_id: int, entries: list) -> None:
+        from OpenAIService.repositories import ChatHistoryRepository
+        with transaction.atomic():
+            try:
+                chat_history_obj = ChatHistory.objects.select_for_update().get(id=chat_history_id)
+            except ChatHistory.DoesNotExist:
+                logger.error(f"Dropping {len(entries)} queued commits of deleted chat {chat_history_id}")
+                return
+            # The chat row lock also serializes the marker of the chat.
+            marker, _ = ChatWriteBehindMarker.objects.get_or_create(queue_id=self.queue_id,
+                                                                    chat_history=chat_history_obj)
+            entries = [(seq, change) for seq, change in entries if seq > marker.applied_upto]
+            if not entries:
+                return
+            for seq, change in entries:
+                ChatHistoryRepository.apply_pending_changes(chat_history_obj, change["msgs"], change["system_msg"],
+                                                            change["prompt_template_name"])
+            ChatHistoryRepository.save_with_display_msgs(chat_history_obj)
+            marker.applied_upto = entries[-1][0]
+            marker.save(update_fields=["applied_upto"])
+
+    def flush(self, blocking: bool = False) -> int:
+        """Writes queued commits to the main DB. Returns the number written, 0 when another process is flushing
+        and blocking is False."""
+        flushed = 0
+        with self._flush_lock(blocking) as acquired:
+            if not acquired:
+                return 0
+            connection = self._connect()
+            while True:
+                rows = connection.execute("SELECT seq, chat_history_id, payload FROM pending_commits ORDER BY seq "
+                                          "LIMIT ?", (self.batch_size,)).fetchall()
+                if not rows:
+                    break
+                entries_by_chat = OrderedDict()
+                for seq, chat_history_id, payload in rows:
+                    entries_by_chat.setdefault(chat_history_id, []).append((seq, json.loads(payload)))
+                for chat_history_id, entries in entries_by_chat.items():
+                    self._apply(chat_history_id, entries)
+                # New entries always get a higher seq, so everything up to the last row read was just applied.
+                connection.execute("DELETE FROM pending_commits WHERE seq <= ?", (rows[-1][0],))
+                flushed += len(rows)
+        if flushed:
+            logger.info(f"Flushed {flushed} queued chat commits")
+        return flushed
+
+    def _ensure_flush_thread(self) -> None:
+        if self._flush_thread is not None:
+            return
+        with self._flush_thread_lock:
+            if self._flush_thread is None:
+                self._flush_thread = threading.Thread(target=self._run_flush_thread, name="chat-write-behind",
+                                                      daemon=True)
+                self._flush_thread.start()
+                atexit.register(self.shutdown)
+
+    def _run_flush_thread(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as exc:
+                logger.error(f"Flushing queued chat commits failed, retrying: {exc}")
+            finally:
+                close_old_connections()
+
+    def shutdown(self) -> None:
+        """Stops the flush thread and writes whatever is still queued, waiting for a flush of another process."""
+        self._stopped.set()
+        if self._flush_thread is not None:
+            self._flush_thread.join(timeout=self.flush_interval + 30)
+        try:
+            self.flush(blocking=True)
+        except Exception as exc:
+            logger.error(f"Flushing queued chat commits at shutdown failed, they stay queued in {self.path}: {exc}")
+
+
+_write_behind_queue = None
+_write_behind_queue_lock = threading.Lock()
+
+
+def get_write_behind_queue() -> ChatWriteBehindQueue | None:
+    """Process wide queue, None unless CHAT_WRITE_BEHIND_QUEUE_PATH is set."""
+    global _write_behind_queue
+    path = getattr(settings, "CHAT_WRITE_BEHIND_QUEUE_PATH", None)
+    if not path:
+        return None
+    if _write_behind_queue is None:
+        with _write_behind_queue_lock:
+            if _write_behind_queue is None:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                _write_behind_queue = ChatWriteBehindQueue(
+                    path,
+                    flush_interval=getattr(settings, "CHAT_WRITE_BEHIND_FLUSH_INTERVAL", 1.0),
+                    batch_size=getattr(settings, "CHAT_WRITE_BEHIND_BATCH_SIZE", 500),
+                )
+    return _write_behind_queue